@@ -59,6 +59,12 @@ distcc_hosts:
 # portage_confdir: /etc/portage
 portage_confdir:
 
+# This overrides the compression set in catalyst.conf for the tarball of this
+# target, see there for the possible values.  It is entirely optional.
+# example:
+# compression: zstd
+compression:
+
 # This option specifies the location to a portage overlay that you would like to
 # have used when building this target.
 # example:
@@ -9,3 +9,24 @@ target:
 # example:
 # version_stamp: 2006.1
 version_stamp:
+
+# This overrides the compression set in catalyst.conf for the snapshot tarball,
+# see there for the possible values.  It is entirely optional.
+# example:
+# compression: xz
+compression:
+
+# This overrides the snapshot_format set in catalyst.conf: tarball, squashfs or
+# both.  It is entirely optional.
+# example:
+# snapshot_format: both
+snapshot_format:
+
+# The version stamp of an earlier snapshot to also write a delta against.
+# Besides the full snapshot, portage-VERSION_STAMP.delta-DELTA_BASE holds only
+# what changed since that snapshot, with a .manifest listing it and what was
+# deleted.  Stages using the snapcache apply it to their cached copy of the
+# base snapshot instead of unpacking the whole tree.  It is entirely optional.
+# example:
+# delta_base: 2006.0
+delta_base:
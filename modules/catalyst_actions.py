@@ -0,0 +1,157 @@
+"""
+The action_sequence of a target run as a dependency graph. A step needs every
+step before it in the sequence, unless the target's action_dependencies names
+the steps it needs. Steps whose needs are met run at the same time, in
+threads; what they print meanwhile, the commands they spawn included, is kept
+per step and printed in the order of the sequence once they are done.
+"""
+
+import sys
+import tempfile
+import threading
+from catalyst_support import *
+
+def action_graph(sequence,dependencies):
+	"""
+	{step: [steps it needs]} for the steps of sequence. A step of
+	dependencies needs the steps it lists there that come before it in the
+	sequence, any other step needs all of the steps before it.
+	"""
+	mygraph={}
+	for x in range(0,len(sequence)):
+		if sequence[x] in mygraph:
+			raise CatalystError,sequence[x]+" is twice in the action sequence"
+		if sequence[x] in dependencies:
+			mygraph[sequence[x]]=[y for y in dependencies[sequence[x]] \
+				if y in sequence[:x]]
+		else:
+			mygraph[sequence[x]]=sequence[:x]
+	return mygraph
+
+class ActionRunner:
+	"""
+	Runs run_action(step) for every step of sequence once the steps it needs
+	in graph are done. A step that is the only one that can run runs in the
+	calling thread with its output as is. After a step failed no others are
+	started; the error of the first failed one is raised once those running
+	are done.
+	"""
+	def __init__(self,sequence,graph,run_action):
+		self.sequence=sequence
+		self.graph=graph
+		self.run_action=run_action
+		self.started={}
+		self.running={}
+		self.done={}
+		self.failed={}
+		self.finished=0
+		self.outputs={}
+		self.condition=threading.Condition()
+
+	def ready(self):
+		""" The steps that can start, in the order of the sequence """
+		myready=[]
+		for x in self.sequence:
+			if x in self.started:
+				continue
+			if len([y for y in self.graph[x] if y not in self.done]) == 0:
+				myready.append(x)
+		return myready
+
+	def run(self):
+		mystdout=sys.stdout
+		mystderr=sys.stderr
+		if not isinstance(mystdout,StepOutput):
+			""" Steps may run steps of their own """
+			sys.stdout=StepOutput(mystdout)
+			sys.stderr=StepOutput(mystderr)
+		try:
+			while len(self.done) < len(self.sequence):
+				self.condition.acquire()
+				try:
+					myready=[]
+					if not self.failed:
+						myready=self.ready()
+					myrunning=len(self.running)
+					myfinished=self.finished
+				finally:
+					self.condition.release()
+				if not myready and not myrunning:
+					break
+				if len(myready) == 1 and not myrunning:
+					self.flush()
+					self.started[myready[0]]=True
+					self.run_action(myready[0])
+					self.done[myready[0]]=True
+					continue
+				for x in myready:
+					self.start(x)
+				self.wait(myfinished)
+			self.flush()
+		finally:
+			sys.stdout=mystdout
+			sys.stderr=mystderr
+
+		myfailed=[x for x in self.sequence if x in self.failed]
+		if myfailed:
+			for x in myfailed[1:]:
+				print "!!! catalyst: "+x+" failed as well: "+\
+					str(self.failed[x][1])
+			myerror=self.failed[myfailed[0]]
+			raise myerror[0],myerror[1],myerror[2]
+
+	def start(self,step):
+		self.outputs[step]=tempfile.TemporaryFile(bufsize=0)
+		self.started[step]=True
+		self.running[step]=threading.Thread(target=self.run_step,args=(step,))
+		self.running[step].setDaemon(True)
+		self.running[step].start()
+
+	def run_step(self,step):
+		step_output.file=self.outputs[step]
+		myerror=None
+		try:
+			self.run_action(step)
+		except:
+			myerror=sys.exc_info()
+		step_output.file=None
+		self.condition.acquire()
+		try:
+			del self.running[step]
+			self.finished+=1
+			if myerror:
+				self.failed[step]=myerror
+			else:
+				self.done[step]=True
+			self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def wait(self,finished):
+		""" Until another step is done than the finished ones """
+		self.condition.acquire()
+		try:
+			while self.finished == finished:
+				""" A timeout keeps Ctrl-C working """
+				self.condition.wait(1)
+		finally:
+			self.condition.release()
+
+	def flush(self):
+		""" Print the output of the steps that ran in threads """
+		for x in self.sequence:
+			if x not in self.outputs or x in self.running:
+				continue
+			myf=self.outputs.pop(x)
+			myf.seek(0)
+			sys.stdout.flush()
+			while True:
+				data=myf.read(65536)
+				if not data:
+					break
+				sys.stdout.write(data)
+			sys.stdout.flush()
+			myf.close()
+
+def run_actions(sequence,graph,run_action):
+	ActionRunner(sequence,graph,run_action).run()
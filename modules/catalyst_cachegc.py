@@ -0,0 +1,374 @@
+"""
+Size budgets for the snapshot cache, the package caches, the kernel caches
+and the unpacked seeds. Builds log every use of a cache entry, catalyst
+--cache-gc evicts the least recently used entries of the caches that are over
+their budget.
+"""
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+from catalyst_support import *
+import catalyst_lock
+import catalyst_pkgstore
+
+# Cache,setting holding its budget
+cache_budgets=[
+	["snapshot_cache","snapshot_cache_size"],
+	["pkgcache","pkgcache_size"],
+	["kerncache","kerncache_size"],
+	["seeds","seed_cache_size"],
+	]
+
+size_suffixes={"K":1024,"M":1024**2,"G":1024**3,"T":1024**4}
+
+def parse_size(mysize):
+	"""the bytes in a size such as 500M or 20G, a plain number is bytes"""
+	mysize=str(mysize).strip().upper()
+	if mysize.endswith("B"):
+		mysize=mysize[:-1]
+	factor=1
+	if mysize[-1:] in size_suffixes:
+		factor=size_suffixes[mysize[-1]]
+		mysize=mysize[:-1]
+	try:
+		return int(float(mysize)*factor)
+	except ValueError:
+		raise CatalystError,"Bad size "+mysize+", use a number of bytes "+\
+			"optionally followed by K, M, G or T"
+
+def format_size(mysize):
+	for x in ["T","G","M","K"]:
+		if mysize >= size_suffixes[x]:
+			return "%.1f%s" % (float(mysize)/size_suffixes[x],x)
+	return str(mysize)
+
+def inuse_lockdir(entry):
+	"""
+	Where the lock builds hold on a snapshot cache entry or a seed while
+	they use it lives. It is next to the entry rather than in it, so that
+	it can be taken before the entry is published.
+	"""
+	entry=normpath(entry).rstrip("/")
+	return normpath(os.path.dirname(entry)+"/.catalyst-inuse/"+\
+		os.path.basename(entry))
+
+def seeds_dir(settings):
+	""" Where seed tarballs are unpacked to be shared by their chroots """
+	return normpath(settings["storedir"]+"/tmp/seeds").rstrip("/")
+
+def seed_users_dir(seed):
+	seed=normpath(seed).rstrip("/")
+	return normpath(os.path.dirname(seed)+"/.catalyst-users/"+\
+		os.path.basename(seed))
+
+def add_seed_user(seed,chroot):
+	"""
+	Record that the overlay chroot has seed as a lower layer. Callers hold
+	the seed's inuse_lockdir() lock, so that it is not evicted meanwhile.
+	"""
+	mydir=seed_users_dir(seed)
+	if not os.path.exists(mydir):
+		os.makedirs(mydir,0755)
+	chroot=normpath(chroot).rstrip("/")
+	myf=open(mydir+"/"+hashlib.sha1(chroot).hexdigest(),"w")
+	myf.write(chroot+"\n")
+	myf.close()
+
+def seed_users(seed):
+	"""
+	The chroots recorded by add_seed_user() that still have seed as a
+	layer, forgetting the others, which were cleared or made anew since.
+	"""
+	seed=normpath(seed).rstrip("/")
+	mydir=seed_users_dir(seed)
+	if not os.path.isdir(mydir):
+		return []
+	myusers=[]
+	for x in os.listdir(mydir):
+		try:
+			myf=open(mydir+"/"+x,"r")
+			mychroot=myf.readline().strip()
+			myf.close()
+		except IOError:
+			continue
+		if seed in [normpath(y).rstrip("/") for y in overlay_layers(mychroot)]:
+			myusers.append(mychroot)
+		else:
+			os.unlink(mydir+"/"+x)
+	return myusers
+
+def usage_log(settings):
+	return normpath(settings["storedir"]+"/cache-usage.log")
+
+def record_cache_use(settings,cache,entry,hit):
+	"""
+	Log that a build used the entry of cache, and whether it was there
+	already. Lines are appended with a single write, so concurrent builds
+	need no lock.
+	"""
+	if hit:
+		kind="hit"
+	else:
+		kind="miss"
+	append_usage(settings,int(time.time()),cache,kind,entry)
+
+def append_usage(settings,mytime,cache,kind,entry):
+	line="%d %s %s %s\n" % (mytime,cache,kind,normpath(entry).rstrip("/"))
+	try:
+		myfd=os.open(usage_log(settings),os.O_WRONLY|os.O_APPEND|os.O_CREAT,\
+			0644)
+		try:
+			os.write(myfd,line)
+		finally:
+			os.close(myfd)
+	except OSError, e:
+		warn("Couldn't log the use of "+entry+": "+str(e))
+
+class CacheGC:
+	"""
+	Entries are the directories of the snapshot cache for every snapshot
+	digest, the package and kernel caches of every target in storedir, the
+	kernels of the kernel store and the unpacked seeds.
+	Their last use comes from the usage log, or their mtime if they were not
+	used since. A running build holds a read lock on the entries it uses,
+	the one next to it (inuse_lockdir) for the snapshot cache and the seeds
+	and the entry's own for the others; those are never evicted. Neither
+	are seeds that overlay chroots are made from (seed_users).
+	"""
+	def __init__(self,settings):
+		self.settings=settings
+		self.locks={}
+
+	def read_usage(self):
+		"""
+		Take the usage log over, builds start a new one. Returns the last
+		use of every entry and [hits,misses] of every cache.
+		"""
+		self.taken_log=usage_log(self.settings)+"."+str(os.getpid())
+		last_use={}
+		counts={}
+		try:
+			os.rename(usage_log(self.settings),self.taken_log)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			self.taken_log=None
+			return (last_use,counts)
+		myf=open(self.taken_log,"r")
+		try:
+			for line in myf:
+				mysplit=line[:-1].split(" ",3)
+				if len(mysplit) != 4 or not mysplit[0].isdigit():
+					continue
+				last_use[mysplit[3]]=max(last_use.get(mysplit[3],0),\
+					int(mysplit[0]))
+				mycounts=counts.setdefault(mysplit[1],[0,0])
+				if mysplit[2] == "hit":
+					mycounts[0]+=1
+				elif mysplit[2] == "miss":
+					mycounts[1]+=1
+		finally:
+			myf.close()
+		return (last_use,counts)
+
+	def entries(self,cache):
+		"""[entry,directory of the lock guarding it] for every entry of cache"""
+		if cache == "seeds":
+			""" Unpacked while the lock is held, under a dot name """
+			return [[x,inuse_lockdir(x)] for x in \
+				self.subdirs(seeds_dir(self.settings))]
+		if cache == "snapshot_cache":
+			mytop=self.settings["snapshot_cache"]
+		else:
+			mytop=self.settings["storedir"]+"/"+\
+				{"pkgcache":"packages","kerncache":"kerncache"}[cache]
+		myentries=[]
+		for x in self.subdirs(mytop):
+			for y in self.subdirs(x):
+				if cache == "snapshot_cache":
+					""" Taken before the entry is published """
+					myentries.append([y,inuse_lockdir(y)])
+				else:
+					myentries.append([y,y])
+		if cache == "kerncache":
+			""" The kernel store shares the kernel cache budget """
+			for x in self.subdirs(self.settings["storedir"]+"/kernels"):
+				myentries.append([x,x])
+		return myentries
+
+	def subdirs(self,path):
+		if not os.path.isdir(path):
+			return []
+		mydirs=[]
+		for x in os.listdir(path):
+			mypath=normpath(path+"/"+x).rstrip("/")
+			if not x.startswith(".") and os.path.isdir(mypath) \
+				and not os.path.islink(mypath):
+				mydirs.append(mypath)
+		return mydirs
+
+	def entry_size(self,path,seen):
+		"""
+		Disk usage of path. Files with several links are only counted
+		for the first entry they are seen in, so the size of an entry is
+		what evicting it frees while the entries seen before it remain.
+		"""
+		mysize=os.lstat(path).st_blocks*512
+		for dirpath,dirnames,filenames in os.walk(path):
+			for x in dirnames+filenames:
+				mystat=os.lstat(dirpath+"/"+x)
+				if mystat.st_nlink > 1 and not stat.S_ISDIR(mystat.st_mode):
+					if (mystat.st_dev,mystat.st_ino) in seen:
+						continue
+					seen[(mystat.st_dev,mystat.st_ino)]=1
+				mysize+=mystat.st_blocks*512
+		return mysize
+
+	def lock(self,lockdir):
+		""" One LockDir per directory and process """
+		if lockdir not in self.locks:
+			self.locks[lockdir]=catalyst_lock.LockDir(lockdir)
+		return self.locks[lockdir]
+
+	def evict(self,entry):
+		"""
+		Remove an entry unless a build holds its lock, or it is the seed of
+		a chroot. It is only renamed while we hold the lock, and deleted
+		after.
+		"""
+		mypath,mylockdir=entry
+		mylock=self.lock(mylockdir)
+		try:
+			mylock.write_lock(0)
+		except LockInUse:
+			print "Keeping "+mypath+", a build is using it"
+			return False
+		myold=normpath(os.path.dirname(mypath)+"/.gc-"+\
+			os.path.basename(mypath)+"-"+str(os.getpid()))
+		try:
+			if os.path.dirname(mypath) == seeds_dir(self.settings):
+				if seed_users(mypath):
+					print "Keeping "+mypath+", chroots are made from it"
+					return False
+				if os.path.isdir(seed_users_dir(mypath)):
+					shutil.rmtree(seed_users_dir(mypath))
+			try:
+				os.rename(mypath,myold)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				""" Pruned by a build meanwhile """
+				myold=None
+			if mylockdir == mypath and myold != None:
+				""" The lock file went along with the directory """
+				mylock.lockfile=normpath(myold+"/"+mylock.lockfilename)
+			else:
+				""" Nothing is left for it to guard """
+				mylock.remove()
+		finally:
+			if mylock.islocked():
+				mylock.unlock()
+		if myold == None:
+			return False
+		print "Evicting "+mypath
+		shutil.rmtree(myold)
+		return True
+
+	def remove_orphan_lockdirs(self,path):
+		"""
+		Remove the inuse_lockdir() locks in path whose entry is gone, but
+		for those a build holds to publish it
+		"""
+		mydir=normpath(path+"/.catalyst-inuse").rstrip("/")
+		if not os.path.isdir(mydir):
+			return
+		for x in os.listdir(mydir):
+			mylockdir=normpath(mydir+"/"+x).rstrip("/")
+			if os.path.exists(path+"/"+x) or \
+				mylockdir in catalyst_lock.LockDir.lock_dirs_in_use:
+				continue
+			mylock=self.lock(mylockdir)
+			try:
+				mylock.write_lock(0)
+			except LockInUse:
+				continue
+			if os.path.exists(path+"/"+x):
+				mylock.unlock()
+			else:
+				mylock.remove()
+
+	def evict_unused_seeds(self):
+		""" Remove every seed no build and no chroot uses """
+		for x in self.entries("seeds"):
+			self.evict(x)
+		self.remove_orphan_lockdirs(seeds_dir(self.settings))
+
+	def run(self):
+		last_use,counts=self.read_usage()
+		myseen=[]
+		myreclaimed=0
+		for cache,key in cache_budgets:
+			myentries=self.entries(cache)
+			for x in myentries:
+				x.append(max(last_use.get(x[0],0),int(os.stat(x[0]).st_mtime)))
+			""" Most recently used first """
+			myentries.sort(lambda a,b: cmp(b[2],a[2]))
+			shared={}
+			for x in myentries:
+				x.append(self.entry_size(x[0],shared))
+				x.append(cache)
+			mytotal=sum([x[3] for x in myentries])
+
+			mybudget=None
+			if key in self.settings:
+				mybudget=parse_size(self.settings[key])
+			myevicted=0
+			myfreed=0
+			for x in myentries[::-1]:
+				if mybudget == None or mytotal <= mybudget:
+					myseen.append(x)
+					continue
+				if self.evict(x[:2]):
+					mytotal-=x[3]
+					myfreed+=x[3]
+					myevicted+=1
+				else:
+					myseen.append(x)
+			myreclaimed+=myfreed
+
+			if mybudget == None:
+				mybudget="no"
+			else:
+				mybudget=format_size(mybudget)
+			hits,misses=counts.get(cache,[0,0])
+			if hits+misses:
+				myrate="%d%% (%d of %d)" % (100*hits/(hits+misses),hits,\
+					hits+misses)
+			else:
+				myrate="unknown"
+			print "%s: %d entries, %s of %s budget, %d evicted, %s reclaimed, hit rate %s" % \
+				(cache,len(myentries)-myevicted,format_size(mytotal),mybudget,\
+				myevicted,format_size(myfreed),myrate)
+
+		for x in self.subdirs(self.settings["snapshot_cache"])+\
+			[seeds_dir(self.settings)]:
+			self.remove_orphan_lockdirs(x)
+
+		""" Binpkgs whose last pkgcache was evicted """
+		if os.path.isdir(self.settings["storedir"]+"/pkgstore"):
+			myremoved,myfreed=catalyst_pkgstore.PackageStore(\
+				self.settings["storedir"]+"/pkgstore").prune()
+			myreclaimed+=myfreed
+			print "pkgstore: %d unused packages removed, %s reclaimed" % \
+				(myremoved,format_size(myfreed))
+		print "Reclaimed "+format_size(myreclaimed)+" in total"
+
+		""" Remember when the remaining entries were last used """
+		for x in myseen:
+			if x[2] > int(os.stat(x[0]).st_mtime):
+				append_usage(self.settings,x[2],x[4],"seen",x[0])
+		if self.taken_log != None:
+			os.unlink(self.taken_log)
@@ -0,0 +1,181 @@
+"""
+The file operations catalyst used to run rm, mkdir, ln, cp and mv for, done
+in-process. Every one raises CatalystError with the message it is given when
+it fails, as cmd() does for the commands. Files are copied into a temporary
+file that is renamed into place, with a reflink where the filesystem supports
+it, copy_file_range(2) otherwise.
+"""
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+from catalyst_support import *
+
+try:
+	import ctypes
+	_libc=ctypes.CDLL(None,use_errno=True)
+	_copy_file_range=getattr(_libc,"copy_file_range",None)
+	if _copy_file_range != None:
+		_copy_file_range.restype=ctypes.c_ssize_t
+except SystemExit, e:
+	raise
+except:
+	_copy_file_range=None
+
+# ioctl(dest, FICLONE, src) shares the extents of src with dest
+FICLONE=0x40049409
+
+COPY_CHUNK_SIZE=64*1024*1024
+
+def _fail(myexc,e):
+	raise CatalystError,myexc+" ("+str(e)+")"
+
+def _umask():
+	mymask=os.umask(022)
+	os.umask(mymask)
+	return mymask
+
+def _tmp_name(path):
+	return os.path.join(os.path.dirname(path),\
+		"."+os.path.basename(path)+".catalyst-"+str(os.getpid()))
+
+def remove(path,recursive=False,myexc=""):
+	""" rm -f path, or rm -rf path if recursive """
+	try:
+		if recursive and os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path)
+		else:
+			os.unlink(path)
+	except OSError, e:
+		if e.errno != errno.ENOENT:
+			_fail(myexc or "Could not remove "+path,e)
+
+def makedirs(path,mode=0755,myexc=""):
+	""" mkdir -p path """
+	try:
+		os.makedirs(path,mode)
+	except OSError, e:
+		if e.errno != errno.EEXIST or not os.path.isdir(path):
+			_fail(myexc or "Could not create "+path,e)
+
+def symlink(target,path,myexc=""):
+	""" ln -sf target path, replacing path in one step """
+	mytmp=_tmp_name(path)
+	try:
+		remove(mytmp)
+		os.symlink(target,mytmp)
+		os.rename(mytmp,path)
+	except OSError, e:
+		remove(mytmp)
+		_fail(myexc or "Could not link "+path+" to "+target,e)
+
+def move(source,dest,myexc=""):
+	""" mv -f source dest, copying across filesystems """
+	if os.path.isdir(dest) and not os.path.islink(dest):
+		dest=os.path.join(dest,os.path.basename(source.rstrip("/")))
+	try:
+		os.rename(source,dest)
+	except OSError, e:
+		if e.errno != errno.EXDEV:
+			_fail(myexc or "Could not move "+source+" to "+dest,e)
+		if os.path.isdir(source) and not os.path.islink(source):
+			copy_tree(source,dest,myexc)
+		else:
+			copy_file(source,dest,myexc)
+		remove(source,True,myexc)
+
+def _copy_data(src_fd,dest_fd,size):
+	"""
+	Share the data with a reflink if the filesystem can, have the kernel
+	copy it with copy_file_range(2) if it can't, read and write it if
+	neither works
+	"""
+	try:
+		fcntl.ioctl(dest_fd,FICLONE,src_fd)
+		return
+	except (IOError,OSError):
+		pass
+	mycopied=0
+	if _copy_file_range != None:
+		while mycopied < size:
+			retval=_copy_file_range(ctypes.c_int(src_fd),None,\
+				ctypes.c_int(dest_fd),None,\
+				ctypes.c_size_t(min(COPY_CHUNK_SIZE,size-mycopied)),\
+				ctypes.c_uint(0))
+			if retval <= 0:
+				break
+			mycopied+=retval
+	os.lseek(src_fd,mycopied,0)
+	os.lseek(dest_fd,mycopied,0)
+	while True:
+		data=os.read(src_fd,HASH_BLOCK_SIZE)
+		if not data:
+			break
+		while data:
+			data=data[os.write(dest_fd,data):]
+
+def copy_file(source,dest,myexc=""):
+	"""
+	cp source dest: dest may be a directory to copy into. The copy gets
+	the mode of source without the umask, as cp gives it.
+	"""
+	if os.path.isdir(dest):
+		dest=os.path.join(dest,os.path.basename(source))
+	mytmp=_tmp_name(dest)
+	try:
+		src_fd=os.open(source,os.O_RDONLY)
+		try:
+			mystat=os.fstat(src_fd)
+			dest_fd=os.open(mytmp,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0600)
+			try:
+				_copy_data(src_fd,dest_fd,mystat.st_size)
+				os.fchmod(dest_fd,stat.S_IMODE(mystat.st_mode) & ~_umask())
+			finally:
+				os.close(dest_fd)
+		finally:
+			os.close(src_fd)
+		os.rename(mytmp,dest)
+	except OSError, e:
+		remove(mytmp)
+		_fail(myexc or "Could not copy "+source+" to "+dest,e)
+
+def _copy_entry(source,dest,myexc):
+	mystat=os.lstat(source)
+	if stat.S_ISLNK(mystat.st_mode):
+		symlink(os.readlink(source),dest,myexc)
+	elif stat.S_ISDIR(mystat.st_mode):
+		copy_tree(source,dest,myexc)
+	elif stat.S_ISREG(mystat.st_mode):
+		copy_file(source,dest,myexc)
+	elif stat.S_ISCHR(mystat.st_mode) or stat.S_ISBLK(mystat.st_mode) or \
+		stat.S_ISFIFO(mystat.st_mode):
+		remove(dest)
+		os.mknod(dest,mystat.st_mode,mystat.st_rdev)
+
+def copy_tree(source,dest,myexc=""):
+	"""
+	cp -R source dest, when dest does not exist yet or is the directory
+	to merge source into. Symlinks are copied as symlinks.
+	"""
+	try:
+		makedirs(dest,stat.S_IMODE(os.stat(source).st_mode),myexc)
+		for x in os.listdir(source):
+			_copy_entry(os.path.join(source,x),os.path.join(dest,x),myexc)
+	except OSError, e:
+		_fail(myexc or "Could not copy "+source+" to "+dest,e)
+
+def copy_contents(source,dest,myexc=""):
+	"""
+	cp -R source/* dest: what the directory source holds, except the
+	hidden entries the glob does not match, goes into dest
+	"""
+	try:
+		makedirs(dest,0755,myexc)
+		for x in os.listdir(source):
+			if not x.startswith("."):
+				_copy_entry(os.path.join(source,x),os.path.join(dest,x),\
+					myexc)
+	except OSError, e:
+		_fail(myexc or "Could not copy "+source+" to "+dest,e)
@@ -0,0 +1,166 @@
+"""
+Persistent cache of file digests, so that unchanged seeds and snapshots do
+not have to be re-hashed on every catalyst invocation.
+"""
+
+import os
+import sys
+import errno
+import threading
+from catalyst_support import *
+import catalyst_lock
+
+class HashCache:
+	"""
+	Every entry is a small file named after the hash function and the
+	device/inode of the hashed file. It records the size, mtime and ctime
+	the file had when it was hashed, its path and the digest itself. An
+	entry is only used while all of those still match (python2's stat does
+	not expose nanosecond timestamps, the ctime makes up for that).
+
+	Entries are published with an atomic rename, so lookups need no lock.
+	Writers and the eviction of stale entries are serialized with a
+	catalyst_lock.LockDir; if another catalyst holds it we simply do not
+	cache this time around instead of waiting for it.
+	"""
+	def __init__(self,cachedir):
+		self.cachedir=normpath(cachedir)
+		if not os.path.exists(self.cachedir):
+			os.makedirs(self.cachedir,0755)
+		self.lock=catalyst_lock.LockDir(self.cachedir)
+		""" LockDir is per process, HashJob threads share it """
+		self.thread_lock=threading.Lock()
+
+	def entry_name(self,mystat,hash_function):
+		return normpath(self.cachedir+"/"+hash_function+"-"+\
+			str(mystat.st_dev)+"-"+str(mystat.st_ino))
+
+	def stat_key(self,mystat):
+		return "%d %r %r" % (mystat.st_size,mystat.st_mtime,mystat.st_ctime)
+
+	def read_entry(self,entry):
+		"""returns (stat key, path, digest) or None"""
+		try:
+			myf=open(entry,"r")
+			try:
+				key=myf.readline()[:-1]
+				path=myf.readline()[:-1]
+				digest=myf.read()
+			finally:
+				myf.close()
+		except IOError:
+			return None
+		if not key or not path:
+			return None
+		return (key,path,digest)
+
+	def lookup(self,path,hash_function):
+		try:
+			mystat=os.stat(path)
+		except OSError:
+			return None
+		entry=self.read_entry(self.entry_name(mystat,hash_function))
+		if entry == None:
+			return None
+		if entry[0] != self.stat_key(mystat) or entry[1] != path:
+			return None
+		return entry[2]
+
+	def store(self,path,hash_function,digest):
+		self.thread_lock.acquire()
+		try:
+			self._store(path,hash_function,digest)
+		finally:
+			self.thread_lock.release()
+
+	def _store(self,path,hash_function,digest):
+		try:
+			self.lock.write_lock(0)
+		except LockInUse:
+			return
+		try:
+			mystat=os.stat(path)
+			entry=self.entry_name(mystat,hash_function)
+			tmpentry=entry+".tmp-"+str(os.getpid())
+			myf=open(tmpentry,"w")
+			myf.write(self.stat_key(mystat)+"\n"+path+"\n"+digest)
+			myf.close()
+			os.rename(tmpentry,entry)
+			self.evict_stale()
+		finally:
+			self.lock.unlock()
+
+	def evict_stale(self):
+		"""drop entries whose file is gone or has changed since it was hashed"""
+		for x in os.listdir(self.cachedir):
+			if x.startswith("."):
+				continue
+			entry=normpath(self.cachedir+"/"+x)
+			mydata=self.read_entry(entry)
+			stale=True
+			if mydata != None:
+				try:
+					mystat=os.stat(mydata[1])
+					hash_function=x.split("-")[0]
+					if self.entry_name(mystat,hash_function) == entry \
+						and self.stat_key(mystat) == mydata[0]:
+						stale=False
+				except OSError:
+					pass
+			if stale:
+				try:
+					os.unlink(entry)
+				except OSError, e:
+					if e.errno != errno.ENOENT:
+						raise
+
+	def generate_hash(self,path,hash_function="crc32",verbose=False):
+		"""generate_hash(), answered from the cache when path is unchanged"""
+		digest=self.lookup(path,hash_function)
+		if digest == None:
+			digest=generate_hash(path,hash_function=hash_function,\
+				verbose=verbose)
+			self.store(path,hash_function,digest)
+		elif verbose:
+			print digest,
+		return digest
+
+class HashJob(threading.Thread):
+	"""
+	Digest a file through a HashCache in a background thread. Nothing is
+	hashed until start() or result() is called, result() waits for the
+	digest and re-raises any error from the thread.
+	"""
+	def __init__(self,hash_cache,path,hash_function):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.hash_cache=hash_cache
+		self.path=path
+		self.hash_function=hash_function
+		self.digest=None
+		self.error=None
+		self.started=False
+		self.start_lock=threading.Lock()
+
+	def start(self):
+		self.start_lock.acquire()
+		try:
+			if not self.started:
+				self.started=True
+				threading.Thread.start(self)
+		finally:
+			self.start_lock.release()
+
+	def run(self):
+		try:
+			self.digest=self.hash_cache.generate_hash(self.path,\
+				hash_function=self.hash_function)
+		except:
+			self.error=sys.exc_info()
+
+	def result(self):
+		self.start()
+		self.join()
+		if self.error:
+			raise self.error[0],self.error[1],self.error[2]
+		return self.digest
@@ -0,0 +1,385 @@
+"""
+Minimal ISO9660 reader, with Rock Ridge and Joliet support, used to list the
+contents of ISO images without running isoinfo.
+"""
+
+import os
+import mmap
+import stat
+import struct
+
+SECTOR_SIZE=2048
+
+# Offset of the name in a directory record
+DR_NAME_OFFSET=33
+
+months=["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
+
+class IsoError(Exception):
+	pass
+
+class IsoRecord:
+	"""
+	One directory record. name is the plain ISO9660 identifier (what isoinfo
+	prints without -R/-J), long_name the Rock Ridge or Joliet one if any.
+	"""
+	def __init__(self,data,offset):
+		length=ord(data[offset])
+		self.extent=struct.unpack("<I",data[offset+2:offset+6])[0]
+		self.size=struct.unpack("<I",data[offset+10:offset+14])[0]
+		self.date=[ord(x) for x in data[offset+18:offset+25]]
+		if self.date[6] > 127:
+			self.date[6]-=256
+		self.flags=ord(data[offset+25])
+		name_len=ord(data[offset+32])
+		self.raw_name=data[offset+DR_NAME_OFFSET:offset+DR_NAME_OFFSET+name_len]
+		if self.raw_name == "\0":
+			self.name="."
+		elif self.raw_name == "\1":
+			self.name=".."
+		else:
+			self.name=self.raw_name
+		self.long_name=None
+		su_start=DR_NAME_OFFSET+name_len
+		if su_start % 2:
+			su_start+=1
+		self.system_use=data[offset+su_start:offset+length]
+		self.mode=None
+		self.nlink=None
+		self.uid=None
+		self.gid=None
+		self.symlink=None
+		self.relocated=False
+		self.child_link=None
+
+	def is_dir(self):
+		return bool(self.flags & 2) or self.child_link != None
+
+	def is_dot(self):
+		return self.raw_name in ("\0","\1")
+
+	def display_name(self):
+		if self.long_name != None:
+			return self.long_name
+		return self.name
+
+class IsoImage:
+	"""
+	A read-only, mmap()ed ISO9660 image. By default names come from Rock
+	Ridge when the image has it; joliet=True reads the Joliet tree instead,
+	plain=True ignores both, like isoinfo without -R or -J.
+	"""
+	def __init__(self,path,joliet=False,plain=False):
+		self.path=path
+		self.myf=open(path,"rb")
+		try:
+			self.data=mmap.mmap(self.myf.fileno(),0,access=mmap.ACCESS_READ)
+		except (mmap.error,ValueError):
+			self.myf.close()
+			raise IsoError,path+" is not an ISO9660 image"
+		self.joliet=False
+		self.rockridge=False
+		self.su_skip=0
+		self.root=None
+
+		sector=16
+		while (sector+1)*SECTOR_SIZE <= len(self.data):
+			vd=self.data[sector*SECTOR_SIZE:(sector+1)*SECTOR_SIZE]
+			if vd[1:6] != "CD001":
+				break
+			if vd[0] == "\x01" and self.root == None:
+				self.root=IsoRecord(vd,156)
+			elif vd[0] == "\x02" and joliet and not plain \
+				and vd[88:90] == "%/" and vd[90] in "@CE":
+				self.root=IsoRecord(vd,156)
+				self.joliet=True
+			elif vd[0] == "\xff":
+				break
+			sector+=1
+		if self.root == None:
+			self.close()
+			raise IsoError,path+" is not an ISO9660 image"
+
+		if not plain and not self.joliet:
+			""" Rock Ridge is announced by an SP entry in the root's '.' """
+			for x in self.records(self.root.extent,self.root.size):
+				if x.system_use[0:2] == "SP" and x.system_use[4:6] == "\xbe\xef":
+					self.rockridge=True
+					self.su_skip=ord(x.system_use[6])
+				break
+
+	def close(self):
+		if getattr(self,"data",None) != None:
+			self.data.close()
+			self.data=None
+		self.myf.close()
+
+	def records(self,extent,size):
+		"""
+		Directory records of the directory at extent, in on-disk order,
+		including '.' and '..'. Records never span sectors; a zero length
+		record means the rest of the sector is padding.
+		"""
+		while size > 0:
+			start=extent*SECTOR_SIZE
+			sector=self.data[start:start+SECTOR_SIZE]
+			if len(sector) < SECTOR_SIZE:
+				raise IsoError,"Directory at extent "+str(extent)+\
+					" is beyond the end of "+self.path
+			i=0
+			while True:
+				length=ord(sector[i])
+				if length == 0:
+					break
+				record=IsoRecord(sector,i)
+				if self.joliet and not record.is_dot():
+					record.long_name=record.raw_name.decode("utf_16_be",\
+						"replace").encode("utf-8")
+				elif self.rockridge:
+					self.parse_rock_ridge(record)
+				yield record
+				i+=length
+				if i > SECTOR_SIZE-DR_NAME_OFFSET:
+					break
+			size-=SECTOR_SIZE
+			extent+=1
+
+	def parse_rock_ridge(self,record):
+		names=[]
+		links=[]
+		area=record.system_use[self.su_skip:]
+		areas_seen=0
+		while area:
+			continuation=None
+			i=0
+			while i+4 <= len(area):
+				sig=area[i:i+2]
+				length=ord(area[i+2])
+				if length < 4:
+					break
+				entry=area[i:i+length]
+				if sig == "PX" and len(entry) >= 36:
+					record.mode=struct.unpack("<I",entry[4:8])[0]
+					record.nlink=struct.unpack("<I",entry[12:16])[0]
+					record.uid=struct.unpack("<I",entry[20:24])[0]
+					record.gid=struct.unpack("<I",entry[28:32])[0]
+				elif sig == "NM" and len(entry) >= 5:
+					flags=ord(entry[4])
+					if flags & 2:
+						names.append(".")
+					elif flags & 4:
+						names.append("..")
+					else:
+						names.append(entry[5:])
+				elif sig == "SL" and len(entry) >= 5:
+					links.append(entry[5:])
+				elif sig == "CE" and len(entry) >= 28:
+					continuation=struct.unpack("<III",entry[4:8]+entry[12:16]+\
+						entry[20:24])
+				elif sig == "RE":
+					record.relocated=True
+				elif sig == "CL" and len(entry) >= 12:
+					record.child_link=struct.unpack("<I",entry[4:8])[0]
+				elif sig == "ST":
+					break
+				i+=length
+			area=""
+			if continuation != None and areas_seen < 64:
+				""" The entries continue in another block """
+				areas_seen+=1
+				start=continuation[0]*SECTOR_SIZE+continuation[1]
+				area=self.data[start:start+continuation[2]]
+		if names and not record.is_dot():
+			record.long_name="".join(names)
+		if links:
+			record.symlink=self.symlink_target(links)
+
+	def symlink_target(self,links):
+		components=[]
+		current=""
+		for x in links:
+			i=0
+			while i+2 <= len(x):
+				flags=ord(x[i])
+				length=ord(x[i+1])
+				content=x[i+2:i+2+length]
+				i+=2+length
+				if flags & 2:
+					content="."
+				elif flags & 4:
+					content=".."
+				elif flags & 8:
+					components=[""]
+					content=None
+				current+=content or ""
+				if content != None and not flags & 1:
+					components.append(current)
+					current=""
+		if current:
+			components.append(current)
+		if components == [""]:
+			return "/"
+		return "/".join(components)
+
+	def directory_size(self,extent):
+		for x in self.records(extent,SECTOR_SIZE):
+			return x.size
+		return SECTOR_SIZE
+
+	def walk(self):
+		"""
+		Yield (dirname, records) for every directory, breadth first like
+		isoinfo, dirname ending with a '/'. With Rock Ridge, relocated
+		directories show up where they belong instead of under rr_moved.
+		"""
+		todo=[("/",self.root.extent,self.root.size)]
+		while todo:
+			dirname,extent,size=todo.pop(0)
+			myrecords=[]
+			for x in self.records(extent,size):
+				if x.relocated:
+					continue
+				myrecords.append(x)
+				if x.is_dot():
+					continue
+				if x.child_link != None:
+					todo.append((dirname+x.display_name()+"/",x.child_link,\
+						self.directory_size(x.child_link)))
+				elif x.flags & 2:
+					todo.append((dirname+x.display_name()+"/",x.extent,x.size))
+			yield dirname,myrecords
+
+	def find(self,path):
+		"""
+		Look up a path, comparing names case insensitively and without ISO
+		version numbers, so '/image.squashfs' also finds IMAGE.SQUASHFS;1.
+		"""
+		wanted=[x for x in path.split("/") if x]
+		extent=self.root.extent
+		size=self.root.size
+		found=self.root
+		for component in wanted:
+			found=None
+			for x in self.records(extent,size):
+				if x.is_dot() or x.relocated:
+					continue
+				name=x.display_name()
+				if x.long_name == None:
+					name=name.split(";")[0]
+					if name.endswith("."):
+						name=name[:-1]
+				if name.lower() == component.lower():
+					found=x
+					break
+			if found == None:
+				return None
+			if found.child_link != None:
+				extent=found.child_link
+				size=self.directory_size(found.child_link)
+			else:
+				extent=found.extent
+				size=found.size
+		return found
+
+def _put(outline,pos,text):
+	""" sprintf() into a fixed buffer, including the terminating NUL """
+	for x in range(0,len(text)):
+		outline[pos+x]=text[x]
+	outline[pos+len(text)]="\0"
+
+def isoinfo_line(record,use_rock=False):
+	"""
+	Format a record exactly like isoinfo's -l listing. Without use_rock
+	isoinfo knows nothing but the directory flag, so the mode, link count
+	and ids are blank.
+	"""
+	mode=None
+	if use_rock:
+		mode=record.mode
+	if mode == None:
+		if record.flags & 2:
+			mode=stat.S_IFDIR
+		else:
+			mode=stat.S_IFREG
+	outline=[" "]*80
+	if stat.S_ISREG(mode):
+		outline[0]="-"
+	elif stat.S_ISDIR(mode):
+		outline[0]="d"
+	elif stat.S_ISLNK(mode):
+		outline[0]="l"
+	elif stat.S_ISCHR(mode):
+		outline[0]="c"
+	elif stat.S_ISBLK(mode):
+		outline[0]="b"
+	elif stat.S_ISFIFO(mode):
+		outline[0]="f"
+	elif stat.S_ISSOCK(mode):
+		outline[0]="s"
+	else:
+		outline[0]="?"
+	for x in range(0,9):
+		if mode & (0400 >> x):
+			outline[1+x]="rwxrwxrwx"[x]
+		else:
+			outline[1+x]="-"
+
+	nlink=uid=gid=0
+	if use_rock and record.mode != None:
+		nlink,uid,gid=record.nlink,record.uid,record.gid
+	_put(outline,11,"%3d" % nlink)
+	_put(outline,15,"%4o" % uid)
+	_put(outline,20,"%4o" % gid)
+	_put(outline,30,"%10d" % record.size)
+	if record.date[1] >= 1 and record.date[1] <= 12:
+		outline[41:44]=list(months[record.date[1]-1])
+	_put(outline,45,"%2d" % record.date[2])
+	outline[63]="\0"
+	_put(outline,48,"%4d" % (record.date[0]+1900))
+	_put(outline,53,"[%7d" % record.extent)
+	_put(outline,61," %02X]" % record.flags)
+	outline="".join(outline[:66]).replace("\0"," ")
+
+	name=record.name
+	xname=""
+	if use_rock:
+		name=record.display_name()
+		if record.symlink != None:
+			xname="-> "+record.symlink
+	return outline+" "+name+" "+xname+"\n"
+
+def isoinfo_listing(path,find=False,use_rock=False):
+	"""
+	Yield the lines of 'isoinfo -l -i path' ('isoinfo -f -i path' with find,
+	adding -R with use_rock) one at a time.
+	"""
+	myiso=IsoImage(path,plain=not use_rock)
+	try:
+		for dirname,myrecords in myiso.walk():
+			if not find:
+				yield "\nDirectory listing of "+dirname+"\n"
+			for x in myrecords:
+				if find:
+					if not x.is_dot():
+						if use_rock:
+							yield dirname+x.display_name()+"\n"
+						else:
+							yield dirname+x.name+"\n"
+				else:
+					yield isoinfo_line(x,use_rock)
+	finally:
+		myiso.close()
+
+def find_file_offset(path,name):
+	"""
+	Return (offset,size) in bytes of the file name inside the ISO at path,
+	or None if there is no such file.
+	"""
+	myiso=IsoImage(path)
+	try:
+		record=myiso.find(name)
+		if record == None or record.is_dir():
+			return None
+		return (record.extent*SECTOR_SIZE,record.size)
+	finally:
+		myiso.close()
@@ -0,0 +1,114 @@
+"""
+Built kernels, keyed by everything that goes into them. A kernel built with
+the same config, sources, extraversion, genkernel arguments, splash theme,
+initramfs overlay, profile, USE and compiler settings as an earlier one is
+installed from the store instead of being built again.
+"""
+
+import os
+import re
+import errno
+import shutil
+import hashlib
+from catalyst_support import *
+
+# The artifacts genkernel leaves in /tmp/kerncache, as
+# <kname>-<artifact>-<version_stamp>.tar.bz2
+kernel_artifacts=["kernel-initrd","modules"]
+
+def _sha256_file(path):
+	mysha=hashlib.sha256()
+	myf=open(path,"rb")
+	try:
+		while True:
+			data=myf.read(HASH_BLOCK_SIZE)
+			if not data:
+				break
+			mysha.update(data)
+	finally:
+		myf.close()
+	return mysha.hexdigest()
+
+def tree_digest(path):
+	"""
+	Digest of the names, modes and contents of everything below path, or
+	of path itself if it is a file. Timestamps do not count, a copy of an
+	overlay has the same digest as the original.
+	"""
+	if not os.path.isdir(path):
+		return _sha256_file(path)
+	mysha=hashlib.sha256()
+	mytop=normpath(path).rstrip("/")
+	for dirpath,dirnames,filenames in os.walk(mytop):
+		dirnames.sort()
+		for x in sorted(dirnames+filenames):
+			myfile=dirpath+"/"+x
+			mystat=os.lstat(myfile)
+			if stat.S_ISLNK(mystat.st_mode):
+				mycontents=os.readlink(myfile)
+			elif stat.S_ISREG(mystat.st_mode):
+				mycontents=_sha256_file(myfile)
+			else:
+				mycontents=""
+			mysha.update("%s %o %s\n" % (myfile[len(mytop):],\
+				stat.S_IMODE(mystat.st_mode)|stat.S_IFMT(mystat.st_mode),\
+				mycontents))
+	return mysha.hexdigest()
+
+def atom_package(atom):
+	"""category/package of an atom such as >=sys-kernel/gentoo-sources-3.2:3.2"""
+	mypackage=re.sub("^[<>=~!]*","",atom.strip())
+	mypackage=re.split("[:\[]",mypackage)[0].rstrip("*")
+	return re.sub("-[0-9][^/]*$","",mypackage)
+
+class KernelStore:
+	"""
+	Every entry is a directory named after the digest of a kernel's inputs,
+	holding the kernel_artifacts and the inputs themselves. Entries are
+	created under a temporary name and renamed into place, and never
+	changed afterwards.
+	"""
+	def __init__(self,storedir):
+		self.storedir=normpath(storedir)
+		if not os.path.exists(self.storedir):
+			os.makedirs(self.storedir,0755)
+
+	def key(self,inputs):
+		"""inputs is a list of lines naming every input of a kernel"""
+		return hashlib.sha256("".join([x+"\n" for x in inputs])).hexdigest()
+
+	def entry(self,key):
+		return normpath(self.storedir+"/"+key).rstrip("/")
+
+	def lookup(self,key):
+		""" The entry for key, None if that kernel was not built yet """
+		mypath=self.entry(key)
+		if os.path.exists(mypath+"/kernel-initrd.tar.bz2"):
+			return mypath
+		return None
+
+	def store(self,key,inputs,artifacts):
+		"""
+		Keep the artifacts, {name: path} for kernel_artifacts, of the
+		kernel built from inputs
+		"""
+		mypath=self.entry(key)
+		if os.path.exists(mypath):
+			return mypath
+		mytmp=normpath(self.storedir+"/.tmp-"+key+"-"+str(os.getpid()))
+		if os.path.exists(mytmp):
+			shutil.rmtree(mytmp)
+		os.makedirs(mytmp,0755)
+		try:
+			for x in kernel_artifacts:
+				if x in artifacts and os.path.exists(artifacts[x]):
+					shutil.copy2(artifacts[x],mytmp+"/"+x+".tar.bz2")
+			myf=open(mytmp+"/inputs","w")
+			myf.write("".join([x+"\n" for x in inputs]))
+			myf.close()
+			os.rename(mytmp,mypath)
+		except OSError, e:
+			shutil.rmtree(mytmp,True)
+			if e.errno not in [errno.EEXIST,errno.ENOTEMPTY]:
+				raise
+		return mypath
@@ -5,16 +5,159 @@ import errno
 import sys
 import string
 import time
+import struct
+import select
+import threading
 from catalyst_support import *
 
 def writemsg(mystr):
 	sys.stderr.write(mystr)
 	sys.stderr.flush()
 
+# Open file description locks (Linux 3.15): fcntl locks owned by the open
+# file rather than the process, so threads and forks do not share them
+F_OFD_GETLK=36
+F_OFD_SETLK=37
+F_OFD_SETLKW=38
+
+# Byte 0 of the lockfile is the lock. Byte 1 is a turnstile every locker
+# passes through: a writer holds it while it waits for the lock, so that
+# readers arriving after it queue behind it instead of starving it.
+LOCK_BYTE=0
+TURNSTILE_BYTE=1
+
+def _ofd_struct(locktype,start):
+	""" struct flock for one byte, l_pid must be 0 """
+	return struct.pack("hhqqi4x",locktype,0,start,1,0)
+
+def ofd_supported(fd):
+	if os.uname()[0] != "Linux" or struct.calcsize("P") != 8:
+		return False
+	try:
+		fcntl.fcntl(fd,F_OFD_GETLK,_ofd_struct(fcntl.F_WRLCK,LOCK_BYTE))
+	except IOError:
+		return False
+	return True
+
+def ofd_lock(fd,locktype,byte,blocking):
+	""" False if someone else holds byte and blocking is off """
+	while True:
+		try:
+			if blocking:
+				fcntl.fcntl(fd,F_OFD_SETLKW,_ofd_struct(locktype,byte))
+			else:
+				fcntl.fcntl(fd,F_OFD_SETLK,_ofd_struct(locktype,byte))
+			return True
+		except IOError, e:
+			if e.errno == errno.EINTR:
+				continue
+			if not blocking and e.errno in [errno.EAGAIN,errno.EACCES]:
+				return False
+			raise
+
+def ofd_acquire(fd,shared,blocking):
+	""" Take the lock through the turnstile, False if it is busy """
+	if not ofd_lock(fd,fcntl.F_WRLCK,TURNSTILE_BYTE,blocking):
+		return False
+	try:
+		if shared:
+			return ofd_lock(fd,fcntl.F_RDLCK,LOCK_BYTE,blocking)
+		return ofd_lock(fd,fcntl.F_WRLCK,LOCK_BYTE,blocking)
+	finally:
+		ofd_lock(fd,fcntl.F_UNLCK,TURNSTILE_BYTE,False)
+
+class LockWaiter(threading.Thread):
+	"""
+	Wait for an OFD lock on a file description of our own, in the kernel's
+	queue, so that the caller can stop waiting after a timeout. A waiter
+	given up on lets go of the lock as soon as it gets it.
+	"""
+	def __init__(self,lockfile,shared):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.fd=os.open(lockfile,os.O_RDWR)
+		self.shared=shared
+		self.acquired=False
+		self.abandoned=False
+		self.error=None
+		self.condition=threading.Condition()
+		self.start()
+
+	def run(self):
+		try:
+			ofd_acquire(self.fd,self.shared,True)
+		except:
+			self.error=sys.exc_info()
+		self.condition.acquire()
+		try:
+			if self.abandoned or self.error:
+				os.close(self.fd)
+			else:
+				self.acquired=True
+			self.condition.notify()
+		finally:
+			self.condition.release()
+
+	def result(self,timeout):
+		""" The fd holding the lock, None if it was not ours in time """
+		self.condition.acquire()
+		try:
+			myend=time.time()+timeout
+			while not self.acquired and not self.error and time.time() < myend:
+				self.condition.wait(myend-time.time())
+			if self.error:
+				raise self.error[0],self.error[1],self.error[2]
+			if not self.acquired:
+				self.abandoned=True
+				return None
+			return self.fd
+		finally:
+			self.condition.release()
+
+# inotify(7), to wake hardlock waiters when the lockfile goes away
+IN_ATTRIB=0x4
+IN_MOVED_FROM=0x40
+IN_DELETE=0x200
+IN_NONBLOCK=04000
+IN_CLOEXEC=02000000
+
+def inotify_watch(path,mask):
+	""" An inotify fd watching path, None without inotify """
+	try:
+		import ctypes
+		mylibc=ctypes.CDLL(None,use_errno=True)
+		myfd=mylibc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+	except SystemExit, e:
+		raise
+	except:
+		return None
+	if myfd < 0:
+		return None
+	if mylibc.inotify_add_watch(myfd,path,mask) < 0:
+		os.close(myfd)
+		return None
+	return myfd
+
+def wait_for_event(fd,timeout):
+	""" Sleep until fd has events or timeout seconds passed """
+	if fd == None:
+		time.sleep(timeout)
+		return
+	mypoller=select.poll()
+	mypoller.register(fd,select.POLLIN)
+	if mypoller.poll(int(timeout*1000)):
+		try:
+			while os.read(fd,4096):
+				pass
+		except OSError:
+			pass
+
 class LockDir:
 	locking_method=fcntl.flock
 	lock_dirs_in_use=[]
 	die_on_failed_lock=True
+	# Seconds a lock held by someone else is waited for before LockInUse
+	lock_wait=0
 	def __del__(self):
 		self.clean_my_hardlocks()
 		self.delete_lock_from_path_list()
@@ -23,7 +166,10 @@ class LockDir:
 
 	def __init__(self,lockdir):
 		self.locked=False
+		self.locktype=None
 		self.myfd=None
+		self.ofd=None
+		self.waited=0
 		self.set_gid(250)
 		self.locking_method=LockDir.locking_method
 		self.set_lockdir(lockdir)
@@ -38,14 +184,9 @@ class LockDir:
 		self.hardlock_paths={}
 
 	def delete_lock_from_path_list(self):
-		i=0
 		try:
-			if LockDir.lock_dirs_in_use:
-				for x in LockDir.lock_dirs_in_use:
-					if LockDir.lock_dirs_in_use[i] == self.lockdir:
-						del LockDir.lock_dirs_in_use[i]
-						break
-						i=i+1
+			if self.lockdir in LockDir.lock_dirs_in_use:
+				LockDir.lock_dirs_in_use.remove(self.lockdir)
 		except AttributeError:
 			pass
 
@@ -86,17 +227,21 @@ class LockDir:
 #			if "DEBUG" in self.settings:
 #				print "setting lockfile to", self.lockfile
 
-	def read_lock(self):
+	def read_lock(self,wait=None):
+		"""
+		wait is how many seconds to wait for a lock someone else holds,
+		lock_wait by default, 0 to raise LockInUse at once
+		"""
 		if not self.locking_method == "HARDLOCK":
-			self.fcntl_lock("read")
+			self.fcntl_lock("read",wait)
 		else:
 			print "HARDLOCKING doesnt support shared-read locks"
 			print "using exclusive write locks"
 			self.hard_lock()
 
-	def write_lock(self):
+	def write_lock(self,wait=None):
 		if not self.locking_method == "HARDLOCK":
-			self.fcntl_lock("write")
+			self.fcntl_lock("write",wait)
 		else:
 			self.hard_lock()
 
@@ -106,61 +251,162 @@ class LockDir:
 		else:
 			self.hard_unlock()
 
-	def fcntl_lock(self,locktype):
+	def wait_time(self,wait):
+		""" None is forever """
+		if wait == None:
+			if not LockDir.die_on_failed_lock:
+				return None
+			return LockDir.lock_wait
+		return wait
+
+	def fcntl_lock(self,locktype,wait=None):
 		if self.myfd==None:
 			if not os.path.exists(os.path.dirname(self.lockdir)):
 				raise DirectoryNotFound, os.path.dirname(self.lockdir)
-			if not os.path.exists(self.lockfile):
-				old_mask=os.umask(000)
-				self.myfd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR,0660)
+			if not os.path.isdir(self.lockdir):
+				""" Taken away by remove() along with what it guarded """
 				try:
-					if os.stat(self.lockfile).st_gid != self.gid:
-						os.chown(self.lockfile,os.getuid(),self.gid)
-				except SystemExit, e:
-					raise
+					os.makedirs(self.lockdir)
 				except OSError, e:
-					if e[0] == 2: #XXX: No such file or directory
-						return self.fcntl_locking(locktype)
-					else:
-						writemsg("Cannot chown a lockfile. This could cause inconvenience later.\n")
-
-				os.umask(old_mask)
-			else:
-				self.myfd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR,0660)
+					if e.errno != errno.EEXIST:
+						raise
+			try:
+				if not os.path.exists(self.lockfile):
+					old_mask=os.umask(000)
+					try:
+						self.myfd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR,0660)
+					finally:
+						os.umask(old_mask)
+					try:
+						if os.stat(self.lockfile).st_gid != self.gid:
+							os.chown(self.lockfile,os.getuid(),self.gid)
+					except SystemExit, e:
+						raise
+					except OSError, e:
+						if e[0] == 2: #XXX: No such file or directory
+							return self.fcntl_lock(locktype,wait)
+						else:
+							writemsg("Cannot chown a lockfile. This could cause inconvenience later.\n")
+				else:
+					self.myfd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR,0660)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				""" The lock directory was removed meanwhile """
+				return self.fcntl_lock(locktype,wait)
 
+		mystart=time.time()
 		try:
-			if locktype == "read":
-				self.locking_method(self.myfd,fcntl.LOCK_SH|fcntl.LOCK_NB)
+			if self.ofd == None:
+				self.ofd=self.locking_method == fcntl.flock and \
+					ofd_supported(self.myfd)
+			if self.ofd:
+				self.ofd_lock(locktype,self.wait_time(wait))
+				self.flock_after_ofd(locktype,self.wait_time(wait),mystart)
 			else:
-				self.locking_method(self.myfd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+				self.flock_lock(locktype,self.wait_time(wait))
 		except IOError, e:
 			if "errno" not in dir(e):
 				raise
-			if e.errno == errno.EAGAIN:
-				if not LockDir.die_on_failed_lock:
-					# Resource temp unavailable; eg, someone beat us to the lock.
-					writemsg("waiting for lock on %s\n" % self.lockfile)
-
-					# Try for the exclusive or shared lock again.
-					if locktype == "read":
-						self.locking_method(self.myfd,fcntl.LOCK_SH)
-					else:
-						self.locking_method(self.myfd,fcntl.LOCK_EX)
-				else:
-					raise LockInUse,self.lockfile
-			elif e.errno == errno.ENOLCK:
+			if e.errno == errno.ENOLCK:
 				pass
 			else:
 				raise
-		if not os.path.exists(self.lockfile):
+		self.waited=time.time()-mystart
+		if not self.lockfile_current():
 			os.close(self.myfd)
 			self.myfd=None
 			#writemsg("lockfile recurse\n")
-			self.fcntl_lock(locktype)
+			self.fcntl_lock(locktype,wait)
 		else:
 			self.locked=True
+			self.locktype=locktype
 			#writemsg("Lockfile obtained\n")
 
+	def lockfile_current(self):
+		""" False if the lockfile was removed or replaced while we waited """
+		try:
+			return os.path.samestat(os.fstat(self.myfd),os.stat(self.lockfile))
+		except OSError:
+			return False
+
+	def ofd_lock(self,locktype,wait):
+		"""
+		Take the lock if it is free, else wait in the kernel's queue for
+		it, for up to wait seconds
+		"""
+		if ofd_acquire(self.myfd,locktype == "read",False):
+			return
+		if wait == 0 or (self.locked and wait != None):
+			""" A waiter's description would wait for ours too """
+			raise LockInUse,self.lockfile
+		writemsg("waiting for lock on %s\n" % self.lockfile)
+		if wait == None:
+			ofd_acquire(self.myfd,locktype == "read",True)
+			return
+		try:
+			mywaiter=LockWaiter(self.lockfile,locktype == "read")
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			""" Removed meanwhile, fcntl_lock starts over on a new one """
+			return
+		myfd=mywaiter.result(wait)
+		if myfd == None:
+			raise LockInUse,self.lockfile
+		os.close(self.myfd)
+		self.myfd=myfd
+
+	def flock_after_ofd(self,locktype,wait,mystart):
+		"""
+		Older catalysts and other scripts flock the lockfile, and OFD locks
+		don't exclude flock on Linux, so it is taken as well. It comes
+		second, so that builds waiting for each other keep their turn in
+		the OFD queue; only a flock holder is waited for by polling, for
+		what is left of wait.
+		"""
+		if wait != None:
+			wait=max(0,wait-(time.time()-mystart))
+		try:
+			self.flock_lock(locktype,wait)
+		except LockInUse:
+			if self.locked and self.locktype == "read":
+				ofd_lock(self.myfd,fcntl.F_RDLCK,LOCK_BYTE,False)
+			elif not self.locked:
+				ofd_lock(self.myfd,fcntl.F_UNLCK,LOCK_BYTE,False)
+			raise
+
+	def flock_lock(self,locktype,wait):
+		"""
+		flock(2) can't wait with a timeout, so when there is one it is
+		retried with growing intervals
+		"""
+		if locktype == "read":
+			myop=fcntl.LOCK_SH
+		else:
+			myop=fcntl.LOCK_EX
+		myend=None
+		if wait != None:
+			myend=time.time()+wait
+		myinterval=0.01
+		while True:
+			try:
+				if wait == None and myinterval > 0.01:
+					self.locking_method(self.myfd,myop)
+				else:
+					self.locking_method(self.myfd,myop|fcntl.LOCK_NB)
+				return
+			except IOError, e:
+				if e.errno != errno.EAGAIN:
+					raise
+			if myend != None and time.time() >= myend:
+				raise LockInUse,self.lockfile
+			if myinterval == 0.01:
+				writemsg("waiting for lock on %s\n" % self.lockfile)
+			if myend != None:
+				time.sleep(min(myinterval,max(0,myend-time.time())))
+			myinterval=min(myinterval*2,1)
+
 	def fcntl_unlock(self):
 		import fcntl
 		unlinkfile = 1
@@ -230,6 +476,30 @@ class LockDir:
 			self.locked=False
 			time.sleep(.0001)
 
+	def remove(self):
+		"""
+		Unlock and remove the lock directory, once what the lock guards is
+		gone. Called with the write lock held, so that whoever waits for it
+		finds the lockfile gone when they get it, and makes a new one.
+		"""
+		if self.locking_method == "HARDLOCK":
+			self.hard_unlock()
+		else:
+			try:
+				os.unlink(self.lockfile)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+			if self.myfd != None:
+				os.close(self.myfd)
+				self.myfd=None
+			self.locked=False
+		try:
+			os.rmdir(self.lockdir)
+		except OSError:
+			""" Somebody made a new lockfile in it already """
+			pass
+
 	def hard_lock(self,max_wait=14400):
 		"""Does the NFS, hardlink shuffle to ensure locking on the disk.
 		We create a PRIVATE lockfile, that is just a placeholder on the disk.
@@ -243,6 +513,9 @@ class LockDir:
 
 		start_time = time.time()
 		reported_waiting = False
+		# Woken when the lockfile is unlinked here, the timeout still
+		# catches other NFS clients unlinking it
+		mywatch = None
 
 		while(time.time() < (start_time + max_wait)):
 			# We only need it to exist.
@@ -266,6 +539,9 @@ class LockDir:
 				# We have the lock.
 				if reported_waiting:
 					print
+				if mywatch != None:
+					os.close(mywatch)
+				self.waited = time.time() - start_time
 				return True
 
 			if reported_waiting:
@@ -273,10 +549,16 @@ class LockDir:
 			else:
 				reported_waiting = True
 				print
-				print "Waiting on (hardlink) lockfile: (one '.' per 3 seconds)"
+				print "Waiting on (hardlink) lockfile: (one '.' per retry)"
 				print "Lockfile: " + self.lockfile
-			time.sleep(3)
-
+				mywatch = inotify_watch(self.lockdir,\
+					IN_DELETE|IN_MOVED_FROM|IN_ATTRIB)
+				# It may have gone before the watch was there
+				continue
+			wait_for_event(mywatch, 3)
+
+		if mywatch != None:
+			os.close(mywatch)
 		os.unlink(self.myhardlock)
 		return False
 
@@ -0,0 +1,301 @@
+"""
+Binary packages shared by the package caches of every target. Each binpkg is
+stored once, named after its sha256, and hard linked into the package caches
+of the builds it suits, so that targets built with the same CHOST and flags
+do not build or keep the same package twice.
+"""
+
+import os
+import errno
+import struct
+import shutil
+import hashlib
+from catalyst_support import *
+
+# The settings a binpkg has to agree with a build on to be used by it. USE is
+# left to portage, which rebuilds binpkgs whose USE does not match.
+compatibility_keys=["CHOST","CFLAGS","CXXFLAGS","LDFLAGS"]
+
+# Metadata kept next to every object
+metadata_keys=["CATEGORY","PF"]+compatibility_keys+["USE"]
+
+def read_xpak(path):
+	"""
+	The metadata portage appends to a .tbz2 binpkg, as {key: value}, or
+	None if path has none. The tbz2 ends with the xpak, its length and
+	"STOP"; the xpak has an index of (name, offset, length) entries into
+	its data.
+	"""
+	myf=open(path,"rb")
+	try:
+		myf.seek(0,2)
+		if myf.tell() < 8:
+			return None
+		myf.seek(-8,2)
+		trailer=myf.read(8)
+		if trailer[4:] != "STOP":
+			return None
+		xpak_len=struct.unpack(">I",trailer[:4])[0]
+		if xpak_len+8 > myf.tell():
+			return None
+		myf.seek(-8-xpak_len,2)
+		xpak=myf.read(xpak_len)
+	finally:
+		myf.close()
+	if xpak[:8] != "XPAKPACK" or xpak[-8:] != "XPAKSTOP":
+		return None
+	index_len,data_len=struct.unpack(">II",xpak[8:16])
+	index=xpak[16:16+index_len]
+	data=xpak[16+index_len:16+index_len+data_len]
+	metadata={}
+	i=0
+	while i+4 <= len(index):
+		name_len=struct.unpack(">I",index[i:i+4])[0]
+		name=index[i+4:i+4+name_len]
+		offset,length=struct.unpack(">II",index[i+4+name_len:i+12+name_len])
+		metadata[name]=data[offset:offset+length].strip()
+		i+=12+name_len
+	return metadata
+
+def _flags(value):
+	""" Compare flags word by word, not by their spacing """
+	return " ".join(value.split())
+
+def build_flags(settings):
+	"""
+	The compatibility_keys a build compiles with, as chroot_setup writes
+	them to make.conf: CXXFLAGS is CFLAGS unless it is set, and a key that
+	is not set at all is left to the profile, None here.
+	"""
+	myflags={}
+	for x in compatibility_keys:
+		if x in settings:
+			myflags[x]=_flags(settings[x])
+		else:
+			myflags[x]=None
+	if "CXXFLAGS" not in settings:
+		myflags["CXXFLAGS"]=myflags["CFLAGS"]
+	return myflags
+
+class PackageStore:
+	"""
+	objects/XX/SHA256.tbz2 is a binpkg, objects/XX/SHA256.meta its
+	metadata_keys, the build_flags() of the build that made it as BUILD_KEY
+	lines, or the keys it left to the profile in PROFILE_FLAGS, and the
+	size and mtime it was stored with. Objects are
+	created with an atomic link or rename and never changed, so the store
+	needs no lock.
+	"""
+	def __init__(self,storedir):
+		self.storedir=normpath(storedir)
+		self.objects=normpath(self.storedir+"/objects")
+		if not os.path.exists(self.objects):
+			os.makedirs(self.objects,0755)
+
+	def object_path(self,sha):
+		return normpath(self.objects+"/"+sha[:2]+"/"+sha+".tbz2")
+
+	def metadata(self):
+		""" Yield [object,{metadata}] for every object """
+		for x in os.listdir(self.objects):
+			mydir=normpath(self.objects+"/"+x)
+			if not os.path.isdir(mydir):
+				continue
+			for y in os.listdir(mydir):
+				if not y.endswith(".meta"):
+					continue
+				mymeta={}
+				try:
+					myf=open(mydir+"/"+y,"r")
+					try:
+						for line in myf:
+							mysplit=line[:-1].split("=",1)
+							if len(mysplit) == 2:
+								mymeta[mysplit[0]]=mysplit[1]
+					finally:
+						myf.close()
+				except IOError:
+					continue
+				yield [normpath(mydir+"/"+y[:-len(".meta")]+".tbz2"),mymeta]
+
+	def intact(self,myobject,mymeta):
+		"""
+		Is the object still what was stored. Portage rewrites the xpak of
+		a binpkg in place when packages move, which would change every
+		hard link of it.
+		"""
+		try:
+			mystat=os.stat(myobject)
+		except OSError:
+			return False
+		return str(mystat.st_size) == mymeta.get("SIZE") \
+			and str(int(mystat.st_mtime)) == mymeta.get("MTIME")
+
+	def populate(self,pkgdir,settings):
+		"""
+		Link the binpkgs built with the build_flags() of settings into
+		pkgdir as CATEGORY/PF.tbz2, the newest one if there are several,
+		unless pkgdir has that binpkg already. Portage adds them to its
+		Packages index when it finds them. Returns how many were linked.
+		"""
+		myflags=build_flags(settings)
+		mybest={}
+		for myobject,mymeta in self.metadata():
+			if "CATEGORY" not in mymeta or "PF" not in mymeta:
+				continue
+			if self.build_flags(mymeta) != myflags:
+				continue
+			mykey=mymeta["CATEGORY"]+"/"+mymeta["PF"]
+			if mykey not in mybest or \
+				int(mymeta.get("MTIME",0)) > int(mybest[mykey][1].get("MTIME",0)):
+				mybest[mykey]=[myobject,mymeta]
+
+		mycount=0
+		for mykey in mybest.keys():
+			myobject,mymeta=mybest[mykey]
+			mytarget=normpath(pkgdir+"/"+mykey+".tbz2")
+			if os.path.lexists(mytarget):
+				continue
+			if not self.intact(myobject,mymeta):
+				warn("Dropping "+myobject+" from the package store, it was "+\
+					"modified after it was stored")
+				self.remove(myobject)
+				continue
+			if not os.path.exists(os.path.dirname(mytarget)):
+				os.makedirs(os.path.dirname(mytarget),0755)
+			self.link(myobject,mytarget)
+			mycount+=1
+		return mycount
+
+	def build_flags(self,mymeta):
+		""" The build_flags() an object was stored with """
+		myflags={}
+		myprofile=mymeta.get("PROFILE_FLAGS","").split()
+		for x in compatibility_keys:
+			if x in myprofile:
+				myflags[x]=None
+			else:
+				myflags[x]=mymeta.get("BUILD_"+x)
+		return myflags
+
+	def link(self,source,target):
+		"""
+		Hard link source to target atomically, copying it when they are on
+		different filesystems
+		"""
+		mytmp=target+".catalyst-"+str(os.getpid())
+		try:
+			os.link(source,mytmp)
+		except OSError, e:
+			if e.errno != errno.EXDEV:
+				raise
+			shutil.copy2(source,mytmp)
+		os.rename(mytmp,target)
+
+	def remove(self,myobject):
+		for x in [myobject,myobject[:-len(".tbz2")]+".meta"]:
+			try:
+				os.unlink(x)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+
+	def ingest(self,pkgdir,settings):
+		"""
+		Store the binpkgs of pkgdir the store does not have yet, as built
+		with the build_flags() of settings, and replace copies of stored
+		binpkgs with links to them. Returns how many binpkgs were new.
+		"""
+		myflags=build_flags(settings)
+		myinodes={}
+		for myobject,mymeta in self.metadata():
+			try:
+				mystat=os.stat(myobject)
+			except OSError:
+				continue
+			myinodes[(mystat.st_dev,mystat.st_ino)]=1
+
+		mycount=0
+		for dirpath,dirnames,filenames in os.walk(pkgdir):
+			for x in filenames:
+				mypath=normpath(dirpath+"/"+x)
+				if not x.endswith(".tbz2") or os.path.islink(mypath):
+					continue
+				mystat=os.stat(mypath)
+				if (mystat.st_dev,mystat.st_ino) in myinodes:
+					continue
+				if self.store(mypath,myflags):
+					mycount+=1
+		return mycount
+
+	def store(self,path,myflags):
+		"""
+		Add the binpkg at path, built with myflags, unless it has no
+		metadata or its metadata shows other flags, as for binpkgs an
+		earlier build with other settings left in the package cache. If the
+		store has it already, path becomes a link to it. Returns whether it
+		was new.
+		"""
+		mymeta=read_xpak(path)
+		if mymeta == None:
+			return False
+		for x in compatibility_keys:
+			""" What the profile set is only known to the binpkg """
+			if myflags[x] != None and _flags(mymeta.get(x,"")) != myflags[x]:
+				return False
+		mysha=hashlib.sha256()
+		myf=open(path,"rb")
+		try:
+			while True:
+				data=myf.read(HASH_BLOCK_SIZE)
+				if not data:
+					break
+				mysha.update(data)
+		finally:
+			myf.close()
+		myobject=self.object_path(mysha.hexdigest())
+		if os.path.exists(myobject):
+			self.link(myobject,path)
+			return False
+
+		if not os.path.exists(os.path.dirname(myobject)):
+			os.makedirs(os.path.dirname(myobject),0755)
+		self.link(path,myobject)
+		mystat=os.stat(myobject)
+		mylines=[]
+		for x in metadata_keys:
+			if x in mymeta:
+				mylines.append(x+"="+" ".join(mymeta[x].split())+"\n")
+		myprofile=[]
+		for x in compatibility_keys:
+			if myflags[x] == None:
+				myprofile.append(x)
+			else:
+				mylines.append("BUILD_"+x+"="+myflags[x]+"\n")
+		mylines.append("PROFILE_FLAGS="+" ".join(myprofile)+"\n")
+		mylines.append("SIZE="+str(mystat.st_size)+"\n")
+		mylines.append("MTIME="+str(int(mystat.st_mtime))+"\n")
+		mymetafile=myobject[:-len(".tbz2")]+".meta"
+		myf=open(mymetafile+".tmp-"+str(os.getpid()),"w")
+		myf.write("".join(mylines))
+		myf.close()
+		os.rename(mymetafile+".tmp-"+str(os.getpid()),mymetafile)
+		return True
+
+	def prune(self):
+		"""
+		Remove the objects no package cache links to any more. Returns
+		[objects,bytes] removed.
+		"""
+		myremoved=[0,0]
+		for myobject,mymeta in self.metadata():
+			try:
+				mystat=os.stat(myobject)
+			except OSError:
+				self.remove(myobject)
+				continue
+			if mystat.st_nlink == 1:
+				self.remove(myobject)
+				myremoved[0]+=1
+				myremoved[1]+=mystat.st_blocks*512
+		return myremoved
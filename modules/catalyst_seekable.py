@@ -0,0 +1,429 @@
+"""
+Seekable zstd tarballs. The tarball is cut into independently compressed
+frames, followed by an index of its members and by a seek table laid out as
+in zstd's seekable format. Plain zstd decompresses it like any other .tar.zst,
+catalyst can also list it or read single members or subtrees of it without
+decompressing the rest, and decompress it with one thread per frame.
+"""
+
+import sys
+import struct
+import Queue
+import threading
+import subprocess
+
+# How much of the tarball goes in one frame
+FRAME_SIZE=16*1024*1024
+
+SKIPPABLE_MAGIC=0x184D2A50
+SEEK_TABLE_MAGIC=0x184D2A5E
+SEEKABLE_MAGIC=0x8F92EAB1
+SEEK_TABLE_FOOTER_SIZE=9
+
+INDEX_TAG="catalyst-member-index-1\n"
+INDEX_ENTRY="<QQI"
+
+# How much of a member tar_members() reads for its headers at first
+HEADER_READ=64*1024
+
+class SeekableError(Exception):
+	pass
+
+def _run_filter(mycmd,data):
+	"""run data through mycmd, returns its output"""
+	myproc=subprocess.Popen(mycmd,stdin=subprocess.PIPE,\
+		stdout=subprocess.PIPE,close_fds=True)
+	output=myproc.communicate(data)[0]
+	if myproc.returncode != 0:
+		raise SeekableError,"'"+" ".join(mycmd)+"' failed"
+	return output
+
+class FrameJob(threading.Thread):
+	"""Filter one frame in the background, result() waits for it"""
+	def __init__(self,mycmd,data):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.mycmd=mycmd
+		self.data=data
+		self.output=None
+		self.error=None
+		self.start()
+
+	def run(self):
+		try:
+			self.output=_run_filter(self.mycmd,self.data)
+		except:
+			self.error=sys.exc_info()
+		self.data=None
+
+	def result(self):
+		self.join()
+		if self.error:
+			raise self.error[0],self.error[1],self.error[2]
+		return self.output
+
+def filter_frames(mycmd,frames,jobs):
+	"""
+	Yield the output of mycmd for every data block of frames, in order,
+	running up to jobs of them at once.
+	"""
+	pending=[]
+	for x in frames:
+		pending.append(FrameJob(mycmd,x))
+		if len(pending) >= max(1,jobs):
+			yield pending.pop(0).result()
+	while pending:
+		yield pending.pop(0).result()
+
+def skippable_frame(payload,magic=SKIPPABLE_MAGIC):
+	return struct.pack("<II",magic,len(payload))+payload
+
+class _WriterInput:
+	def __init__(self,writer):
+		self.writer=writer
+
+	def write(self,data):
+		self.writer.write(data)
+
+	def close(self):
+		self.writer.close()
+
+class _WriterOutput:
+	def __init__(self,writer):
+		self.writer=writer
+
+	def read(self,size):
+		return self.writer.read(size)
+
+	def close(self):
+		self.writer.abort()
+
+class SeekableWriter:
+	"""
+	A stand-in for a compressor process: the tarball is written to stdin and
+	the seekable archive read back from stdout. Frames are compressed with
+	mycmd, up to jobs of them at once. Members are indexed with add_member()
+	as the tarball is written.
+	"""
+	def __init__(self,mycmd,jobs=1):
+		self.mycmd=mycmd
+		self.stdin=_WriterInput(self)
+		self.stdout=_WriterOutput(self)
+		self.buffer=[]
+		self.buffered=0
+		self.in_flight=Queue.Queue(max(1,jobs))
+		self.output=""
+		self.offset=0
+		self.frames=[]
+		self.members=[]
+		self.done=False
+		self.aborted=False
+		self.error=None
+
+	def add_member(self,tarinfo):
+		"""index a member, tarinfo as read from the tarball by tarfile"""
+		if self.members:
+			self.members[-1][1]=tarinfo.offset
+		end=tarinfo.offset_data+((tarinfo.size+511)//512)*512
+		self.members.append([tarinfo.offset,end,tarinfo.name])
+
+	def write(self,data):
+		self.buffer.append(data)
+		self.buffered+=len(data)
+		self.offset+=len(data)
+		while self.buffered >= FRAME_SIZE:
+			data="".join(self.buffer)
+			self.buffer=[data[FRAME_SIZE:]]
+			self.buffered=len(self.buffer[0])
+			self.submit(data[:FRAME_SIZE])
+
+	def submit(self,data):
+		self.put([FrameJob(self.mycmd,data),len(data)])
+
+	def put(self,item):
+		""" Wait for room in the queue, unless the reader has gone away """
+		while True:
+			if self.aborted:
+				raise SeekableError,"Compression was aborted"
+			try:
+				self.in_flight.put(item,True,1)
+				return
+			except Queue.Full:
+				pass
+
+	def close(self):
+		if self.aborted:
+			return
+		if self.buffered:
+			self.submit("".join(self.buffer))
+			self.buffer=[]
+			self.buffered=0
+		self.put(None)
+
+	def abort(self):
+		""" The reader is gone, stop the writer if it has not finished """
+		if not self.done:
+			self.aborted=True
+
+	def read(self,size):
+		while len(self.output) < size and not self.done:
+			self.output+=self.next_frame()
+		data=self.output[:size]
+		self.output=self.output[size:]
+		return data
+
+	def next_frame(self):
+		myjob=self.in_flight.get()
+		if myjob == None:
+			self.done=True
+			return self.trailer()
+		try:
+			data=myjob[0].result()
+		except:
+			self.error=sys.exc_info()
+			self.aborted=True
+			raise
+		self.frames.append([len(data),myjob[1]])
+		return data
+
+	def trailer(self):
+		"""the member index and the seek table, which must come last"""
+		myindex=[INDEX_TAG]
+		for x in self.members:
+			myindex.append(struct.pack(INDEX_ENTRY,x[0],x[1],len(x[2]))+x[2])
+		myindex=skippable_frame("".join(myindex))
+		self.frames.append([len(myindex),0])
+		mytable=[]
+		for x in self.frames:
+			mytable.append(struct.pack("<II",x[0],x[1]))
+		mytable.append(struct.pack("<IBI",len(self.frames),0,SEEKABLE_MAGIC))
+		return myindex+skippable_frame("".join(mytable),SEEK_TABLE_MAGIC)
+
+	def wait(self):
+		if self.error or self.aborted:
+			return 1
+		return 0
+
+class SeekableArchive:
+	"""
+	Read access to a seekable archive. frames lists [compressed offset,
+	compressed size, offset, size] for every frame, members [offset, end,
+	name] for every member of the tarball.
+	"""
+	def __init__(self,path):
+		self.path=path
+		self.frames=[]
+		self.members=[]
+		myf=open(path,"rb")
+		try:
+			myf.seek(0,2)
+			length=myf.tell()
+			if length < SEEK_TABLE_FOOTER_SIZE+8:
+				raise SeekableError,path+" is not a seekable archive"
+			myf.seek(length-SEEK_TABLE_FOOTER_SIZE)
+			count,descriptor,magic=struct.unpack("<IBI",\
+				myf.read(SEEK_TABLE_FOOTER_SIZE))
+			if magic != SEEKABLE_MAGIC:
+				raise SeekableError,path+" is not a seekable archive"
+			entry_size=8
+			if descriptor & 0x80:
+				entry_size=12
+			table_size=count*entry_size+SEEK_TABLE_FOOTER_SIZE
+			if table_size+8 > length:
+				raise SeekableError,"Corrupt seek table in "+path
+			myf.seek(length-table_size-8)
+			magic,size=struct.unpack("<II",myf.read(8))
+			if magic != SEEK_TABLE_MAGIC or size != table_size:
+				raise SeekableError,"Corrupt seek table in "+path
+			mytable=myf.read(count*entry_size)
+			compressed=offset=0
+			for x in range(0,count):
+				sizes=struct.unpack("<II",mytable[x*entry_size:x*entry_size+8])
+				self.frames.append([compressed,sizes[0],offset,sizes[1]])
+				compressed+=sizes[0]
+				offset+=sizes[1]
+
+			""" The member index is the last frame """
+			if self.frames and self.frames[-1][3] == 0:
+				myf.seek(self.frames[-1][0])
+				myindex=myf.read(self.frames[-1][1])[8:]
+				if myindex.startswith(INDEX_TAG):
+					self.read_index(myindex[len(INDEX_TAG):])
+		finally:
+			myf.close()
+		self.frames=[x for x in self.frames if x[3] > 0]
+
+	def read_index(self,myindex):
+		i=0
+		entry_size=struct.calcsize(INDEX_ENTRY)
+		while i+entry_size <= len(myindex):
+			offset,end,name_len=struct.unpack(INDEX_ENTRY,\
+				myindex[i:i+entry_size])
+			i+=entry_size
+			self.members.append([offset,end,myindex[i:i+name_len]])
+			i+=name_len
+
+	def names(self):
+		return [x[2] for x in self.members]
+
+	def find_members(self,paths):
+		"""
+		The members that are one of paths, or below one of them. Leading
+		'./' and '/' do not matter.
+		"""
+		wanted=[x.strip("/") for x in paths]
+		found=[]
+		for x in self.members:
+			name=x[2]
+			while name.startswith("./"):
+				name=name[2:]
+			name=name.strip("/")
+			for y in wanted:
+				if y == "." or name == y or name.startswith(y+"/"):
+					found.append(x)
+					break
+		return found
+
+	def read_frames(self,frames,decompressor,jobs):
+		"""yield [frame,data] for frames, decompressed jobs at a time"""
+		def compressed():
+			myf=open(self.path,"rb")
+			try:
+				for x in frames:
+					myf.seek(x[0])
+					yield myf.read(x[1])
+			finally:
+				myf.close()
+		i=0
+		for data in filter_frames(decompressor,compressed(),jobs):
+			if len(data) != frames[i][3]:
+				raise SeekableError,"Corrupt frame at offset "+\
+					str(frames[i][0])+" of "+self.path
+			yield [frames[i],data]
+			i+=1
+
+	def read_ranges(self,ranges,decompressor,jobs=1):
+		"""
+		Yield the data of the tarball in ranges, [offset, end] pairs sorted
+		by offset that do not overlap, only decompressing the frames they
+		touch.
+		"""
+		myframes=[]
+		i=0
+		for x in self.frames:
+			while i < len(ranges) and ranges[i][1] <= x[2]:
+				i+=1
+			if i < len(ranges) and ranges[i][0] < x[2]+x[3]:
+				myframes.append(x)
+		i=0
+		for myframe,data in self.read_frames(myframes,decompressor,jobs):
+			while i < len(ranges) and ranges[i][1] <= myframe[2]:
+				i+=1
+			j=i
+			while j < len(ranges) and ranges[j][0] < myframe[2]+myframe[3]:
+				start=max(ranges[j][0],myframe[2])
+				end=min(ranges[j][1],myframe[2]+myframe[3])
+				if start < end:
+					yield data[start-myframe[2]:end-myframe[2]]
+				j+=1
+
+	def tar_members(self,decompressor,jobs=1):
+		"""
+		Yield tarfile's TarInfo for every member, parsed from the start of
+		the member alone, so that frames holding nothing but file data are
+		not decompressed.
+		"""
+		ranges=[[x[0],min(x[1],x[0]+HEADER_READ)] for x in self.members]
+		i=0
+		mydata=[]
+		mylen=0
+		for data in self.read_ranges(ranges,decompressor,jobs):
+			mydata.append(data)
+			mylen+=len(data)
+			if mylen == ranges[i][1]-ranges[i][0]:
+				yield self.member_info(self.members[i],"".join(mydata),\
+					decompressor)
+				i+=1
+				mydata=[]
+				mylen=0
+
+	def member_info(self,member,data,decompressor):
+		"""The TarInfo of member, data being its start"""
+		import tarfile
+		import cStringIO
+		tarinfo=None
+		try:
+			mytar=tarfile.open(fileobj=cStringIO.StringIO(data+"\0"*1024),\
+				mode="r:")
+			tarinfo=mytar.next()
+		except tarfile.TarError:
+			pass
+		if tarinfo == None or tarinfo.offset_data > len(data):
+			""" Headers longer than HEADER_READ, read the whole member """
+			if len(data) == member[1]-member[0]:
+				raise SeekableError,"Corrupt member at offset "+\
+					str(member[0])+" of "+self.path
+			return self.member_info(member,\
+				"".join(self.read_ranges([member[:2]],decompressor)),\
+				decompressor)
+		return tarinfo
+
+	def read_member(self,name,decompressor):
+		"""the contents of the file name in the tarball, None if there is none"""
+		import tarfile
+		import cStringIO
+		for x in self.find_members([name]):
+			data="".join(self.read_ranges([x[:2]],decompressor))
+			mytar=tarfile.open(fileobj=cStringIO.StringIO(data+"\0"*1024),\
+				mode="r:")
+			tarinfo=mytar.next()
+			if tarinfo.isreg():
+				return mytar.extractfile(tarinfo).read()
+		return None
+
+	def extract(self,destdir,decompressor,tar_args=[],paths=None,jobs=1):
+		"""
+		Extract the tarball, or only paths in it, into destdir, decompressing
+		up to jobs frames at once.
+		"""
+		if paths == None:
+			ranges=[[0,sum([x[3] for x in self.frames])]]
+		else:
+			ranges=[]
+			for x in self.find_members(paths):
+				if ranges and ranges[-1][1] == x[0]:
+					ranges[-1][1]=x[1]
+				else:
+					ranges.append(x[:2])
+			if not ranges:
+				raise SeekableError,"Nothing matches "+" ".join(paths)+\
+					" in "+self.path
+		mytar=subprocess.Popen(["tar"]+tar_args+["-xpf","-","-C",destdir],\
+			stdin=subprocess.PIPE,close_fds=True)
+		try:
+			try:
+				for data in self.read_ranges(ranges,decompressor,jobs):
+					mytar.stdin.write(data)
+				if paths != None:
+					""" End of archive marker """
+					mytar.stdin.write("\0"*1024)
+			finally:
+				mytar.stdin.close()
+		finally:
+			if mytar.wait() != 0:
+				raise SeekableError,"Extracting "+self.path+" failed"
+
+def is_seekable(path):
+	"""does path end with a seek table"""
+	try:
+		myf=open(path,"rb")
+		try:
+			myf.seek(0,2)
+			if myf.tell() < SEEK_TABLE_FOOTER_SIZE:
+				return False
+			myf.seek(-4,2)
+			return struct.unpack("<I",myf.read(4))[0] == SEEKABLE_MAGIC
+		finally:
+			myf.close()
+	except IOError:
+		return False
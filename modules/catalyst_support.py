@@ -1,5 +1,8 @@
 
-import sys,string,os,types,re,signal,traceback,time
+import sys,string,os,types,re,signal,traceback,time,hashlib,zlib,threading
+import subprocess,tarfile,stat,shutil,errno,select,bisect
+import catalyst_iso
+import catalyst_seekable
 #import md5,sha
 selinux_capable = False
 #userpriv_capable = (os.getuid() == 0)
@@ -64,18 +67,34 @@ def hexify(str):
 	return r
 # hexify()
 
-def generate_contents(file,contents_function="auto",verbose=False):
+def generate_contents(file,contents_function="auto",verbose=False,outfile=None):
+	"""
+	List the contents of file. With outfile, the listing is streamed into it
+	line by line and nothing is returned, otherwise it is returned as one
+	string.
+	"""
 	try:
 		_ = contents_function
 		if _ == 'auto' and file.endswith('.iso'):
 			_ = 'isoinfo-l'
+		if _ == 'auto' and file.endswith('.squashfs'):
+			_ = 'unsquashfs-l'
 		if (_ in ['tar-tv','auto']):
 			if file.endswith('.tgz') or file.endswith('.tar.gz'):
 				_ = 'tar-tvz'
 			elif file.endswith('.tbz2') or file.endswith('.tar.bz2'):
 				_ = 'tar-tvj'
+			elif file.endswith('.txz') or file.endswith('.tar.xz'):
+				_ = 'tar-tvJ'
+			elif file.endswith('.tar.zst'):
+				_ = 'tar-tvzst'
+			elif file.endswith('.tar.lz4'):
+				_ = 'tar-tvlz4'
 			elif file.endswith('.tar'):
 				_ = 'tar-tv'
+		if _ == 'auto':
+			""" Unknown extension, go by what the file starts with """
+			_ = contents_sniff_map.get(sniff_format(file),'auto')
 
 		if _ == 'auto':
 			warn('File %r has unknown type for automatic detection.' % (file, ))
@@ -83,16 +102,27 @@ def generate_contents(file,contents_function="auto",verbose=False):
 		else:
 			contents_function = _
 			_ = contents_map[contents_function]
-			return _[0](file,_[1],verbose)
+			if outfile == None:
+				return _[0](file,_[1],verbose)
+			_[0](file,_[1],verbose,outfile)
+			return None
 	except:
 		raise CatalystError,\
 			"Error generating contents, is appropriate utility (%s) installed on your system?" \
 			% (contents_function, )
 
-def calc_contents(file,cmd,verbose):
+def calc_contents(file,cmd,verbose,outfile=None):
 	args={ 'file': file }
 	cmd=cmd % dict(args)
 	a=os.popen(cmd)
+	if outfile != None:
+		for line in a:
+			outfile.write(line)
+			if verbose:
+				print line,
+		if a.close():
+			raise CatalystError,"Command failed: "+cmd
+		return None
 	mylines=a.readlines()
 	a.close()
 	result="".join(mylines)
@@ -100,6 +130,748 @@ def calc_contents(file,cmd,verbose):
 		print result
 	return result
 
+# Parallel decompressors, fastest first, that read stdin and write stdout.
+# Key,[command,...]
+decompressor_map={
+	"bz2":[["lbzip2","-dc"],["pbzip2","-dc"],["bzip2","-dc"]],
+	"gz":[["pigz","-dc"],["gzip","-dc"]],
+	"xz":[["pixz","-d"],["xz","-T0","-dc"]],
+	"zstd":[["zstd","-T0","-dc"]],
+	"lz4":[["lz4","-dc"]],
+	}
+
+# What files start with, to tell formats apart whatever their name.
+# Format,offset,magic
+magic_map=[
+	["bz2",0,"BZh"],
+	["gz",0,"\x1f\x8b"],
+	["xz",0,"\xfd7zXZ\x00"],
+	["zstd",0,"\x28\xb5\x2f\xfd"],
+	["lz4",0,"\x04\x22\x4d\x18"],
+	["squashfs",0,"hsqs"],
+	["tar",257,"ustar"],
+	["iso",32769,"CD001"],
+	]
+
+def sniff_format(file):
+	"""return the format of file according to magic_map, or None"""
+	try:
+		myf=open(file,"rb")
+		try:
+			header=myf.read(max([x[1]+len(x[2]) for x in magic_map]))
+		finally:
+			myf.close()
+	except IOError:
+		return None
+	for x in magic_map:
+		if header[x[1]:x[1]+len(x[2])] == x[2]:
+			return x[0]
+	return None
+
+def find_decompressor(format):
+	"""return the command of the fastest decompressor installed for format"""
+	if format in decompressor_map:
+		for x in decompressor_map[format]:
+			mybinary=find_binary(x[0])
+			if mybinary != None:
+				return [mybinary]+x[1:]
+	return None
+
+# Compressors that read stdin and write stdout.
+# Binary,[format,arguments,level option,threads option]
+compressor_tools={
+	"lbzip2":["bz2",["-c"],"-%d","-n%d"],
+	"pbzip2":["bz2",["-c"],"-%d","-p%d"],
+	"bzip2":["bz2",["-c"],"-%d",None],
+	"pigz":["gz",["-c"],"-%d","-p%d"],
+	"gzip":["gz",["-c"],"-%d",None],
+	"pixz":["xz",[],"-%d","-p%d"],
+	"xz":["xz",["-c"],"-%d","-T%d"],
+	"zstd":["zstd",["-c","--long"],"-%d","-T%d"],
+	}
+
+# The compressors of every format, fastest first
+compressor_map={
+	"bz2":["lbzip2","pbzip2","bzip2"],
+	"gz":["pigz","gzip"],
+	"xz":["pixz","xz"],
+	"zstd":["zstd"],
+	}
+
+# Values of the compression option that name a format rather than a tool
+compression_formats={
+	"bzip2":"bz2",
+	"gzip":"gz",
+	"xz":"xz",
+	"zstd":"zstd",
+	"zstd-seekable":"zstd",
+	}
+
+# Compressions that write seekable archives, see catalyst_seekable
+seekable_compressions=["zstd-seekable"]
+
+# Tarball extensions, the first one of a format is the one catalyst writes
+tarball_extensions=[
+	[".tar.bz2","bz2"],
+	[".tbz2","bz2"],
+	[".tar.gz","gz"],
+	[".tgz","gz"],
+	[".tar.xz","xz"],
+	[".txz","xz"],
+	[".tar.zst","zstd"],
+	[".tar.lz4","lz4"],
+	[".tar",None],
+	]
+
+# How mksquashfs compresses the formats squashfs supports.
+# Format,[-comp name,level option]
+squashfs_compressors={
+	"gz":["gzip","-Xcompression-level"],
+	"xz":["xz",None],
+	"zstd":["zstd","-Xcompression-level"],
+	"lz4":["lz4",None],
+	}
+
+def compression_format(compression):
+	"""the format written by a compression option value, None if unknown"""
+	if compression in compression_formats:
+		return compression_formats[compression]
+	if compression in compressor_tools:
+		return compressor_tools[compression][0]
+	if compression in compressor_map:
+		return compression
+	return None
+
+def compression_extension(compression):
+	format=compression_format(compression)
+	for x in tarball_extensions:
+		if x[1] == format:
+			return x[0]
+	return None
+
+def tarball_format(file):
+	"""the compression format of a tarball, going by its name"""
+	for x in tarball_extensions:
+		if file.endswith(x[0]):
+			return x[1]
+	return None
+
+def find_compressor(compression,level=None,threads=None):
+	"""
+	Return the command of the fastest compressor installed for compression,
+	which is either a format, so any tool for it will do, or a tool.
+	level and threads are passed on to tools that understand them.
+	"""
+	if compression in compressor_tools and compression not in compression_formats:
+		candidates=[compression]
+	else:
+		candidates=compressor_map.get(compression_format(compression),[])
+	for x in candidates:
+		mybinary=find_binary(x)
+		if mybinary == None:
+			continue
+		mytool=compressor_tools[x]
+		mycmd=[mybinary]+mytool[1]
+		if level != None:
+			if x == "zstd" and int(level) > 19:
+				mycmd.append("--ultra")
+			mycmd.append(mytool[2] % int(level))
+		if threads != None and mytool[3] != None:
+			mycmd.append(mytool[3] % int(threads))
+		return mycmd
+	return None
+
+def squashfs_command(source,target,compression,level=None,threads=None):
+	"""
+	The mksquashfs command making target an image of the directory source,
+	compressed in the format of compression when squashfs supports it and
+	with gzip, its default, otherwise.
+	"""
+	mycmd=["mksquashfs",source,target,"-noappend"]
+	format=compression_format(compression)
+	if format in squashfs_compressors:
+		mycomp=squashfs_compressors[format]
+		mycmd.extend(["-comp",mycomp[0]])
+		if level != None and mycomp[1] != None:
+			mycmd.extend([mycomp[1],str(level)])
+	if threads != None:
+		mycmd.extend(["-processors",str(threads)])
+	return " ".join(mycmd)
+
+def tar_decompress_option(file):
+	"""
+	The -I option that makes tar extract file with the fastest decompressor
+	installed for what file really is, or nothing to let tar pick one.
+	"""
+	mycmd=find_decompressor(sniff_format(file))
+	if mycmd == None:
+		return ""
+	return "-I '"+" ".join(mycmd)+"' "
+
+# tar options that keep file capabilities, PaX markings and SELinux labels
+tar_xattr_args=["--xattrs","--xattrs-include=security.capability",\
+	"--xattrs-include=user.pax.flags","--selinux"]
+
+def unpack_command(file,destdir,tar_args=[]):
+	"""
+	The command extracting the seed or snapshot file into destdir, which is
+	a tarball in any format catalyst knows, or a squashfs image.
+	"""
+	if sniff_format(file) == "squashfs":
+		return "unsquashfs -f -d "+destdir+" "+file
+	return "tar "+" ".join(tar_args+[tar_decompress_option(file)])+"-xpf "+\
+		file+" -C "+destdir
+
+def is_seekable(file):
+	return catalyst_seekable.is_seekable(file)
+
+def extract_seekable(file,destdir,tar_args=[],jobs=1,myexc=""):
+	"""
+	Extract a seekable archive into destdir, decompressing jobs frames at
+	once instead of the whole stream in one thread.
+	"""
+	try:
+		catalyst_seekable.SeekableArchive(file).extract(destdir,\
+			find_decompressor("zstd"),tar_args,jobs=jobs)
+	except catalyst_seekable.SeekableError,e:
+		raise CatalystError,myexc+" "+str(e)
+
+def read_archive_member(file,name):
+	"""
+	The contents of the file name in the tarball file, None if it has no
+	such file. Seekable archives only decompress the frames holding it.
+	"""
+	if is_seekable(file):
+		return catalyst_seekable.SeekableArchive(file).read_member(name,\
+			find_decompressor("zstd"))
+	myproc=open_decompressor(file)
+	if myproc != None:
+		mytar=tarfile.open(fileobj=myproc.stdout,mode="r|")
+	else:
+		mytar=tarfile.open(file,"r|*")
+	try:
+		wanted=name.strip("/")
+		for tarinfo in mytar:
+			mytar.members=[]
+			myname=tarinfo.name
+			while myname.startswith("./"):
+				myname=myname[2:]
+			if myname.strip("/") == wanted and tarinfo.isreg():
+				return mytar.extractfile(tarinfo).read()
+	finally:
+		mytar.close()
+		if myproc != None:
+			myproc.stdout.close()
+			myproc.wait()
+	return None
+
+def open_decompressor(file,format=None):
+	"""
+	start a decompressor for file, returns its Popen object or None. The
+	format is detected from the data unless given.
+	"""
+	if format == None:
+		format=sniff_format(file)
+	mycmd=find_decompressor(format)
+	if mycmd == None:
+		return None
+	myf=open(file,"rb")
+	try:
+		return subprocess.Popen(mycmd,stdin=myf,stdout=subprocess.PIPE,\
+			close_fds=True)
+	finally:
+		myf.close()
+
+def _tar_mode_string(tarinfo):
+	if tarinfo.isdir():
+		mytype="d"
+	elif tarinfo.type == tarfile.LNKTYPE:
+		mytype="h"
+	elif tarinfo.type == tarfile.SYMTYPE:
+		mytype="l"
+	elif tarinfo.type == tarfile.CHRTYPE:
+		mytype="c"
+	elif tarinfo.type == tarfile.BLKTYPE:
+		mytype="b"
+	elif tarinfo.type == tarfile.FIFOTYPE:
+		mytype="p"
+	elif tarinfo.type == tarfile.CONTTYPE:
+		mytype="C"
+	else:
+		mytype="-"
+	mode=tarinfo.mode
+	myperms=list("rwxrwxrwx")
+	for x in range(0,9):
+		if not mode & (0400 >> x):
+			myperms[x]="-"
+	for bit,pos,char in ((stat.S_ISUID,2,"s"),(stat.S_ISGID,5,"s"),\
+		(stat.S_ISVTX,8,"t")):
+		if mode & bit:
+			if myperms[pos] == "x":
+				myperms[pos]=char
+			else:
+				myperms[pos]=char.upper()
+	return mytype+"".join(myperms)
+
+_tar_escapes={"\a":"\\a","\b":"\\b","\f":"\\f","\n":"\\n","\r":"\\r",\
+	"\t":"\\t","\v":"\\v","\\":"\\\\"}
+
+def _utf8_locale():
+	for x in ("LC_ALL","LC_CTYPE","LANG"):
+		if os.environ.get(x):
+			return os.environ[x].lower().replace("-","").endswith("utf8")
+	return False
+
+def _tar_quote(name):
+	"""
+	Quote a name the way GNU tar's default 'escape' style does. Like tar,
+	non-ASCII names are only printed as is in a UTF-8 locale.
+	"""
+	escape_high=True
+	if _utf8_locale():
+		try:
+			name.decode("utf-8")
+			escape_high=False
+		except UnicodeError:
+			pass
+	result=[]
+	for ch in name:
+		if ch in _tar_escapes:
+			result.append(_tar_escapes[ch])
+		elif ord(ch) < 32 or ord(ch) == 127 or (escape_high and ord(ch) > 127):
+			result.append("\\%03o" % ord(ch))
+		else:
+			result.append(ch)
+	return "".join(result)
+
+def tar_contents_line(tarinfo,widths):
+	"""
+	Format a member like 'tar --xattrs -tv' does. widths holds GNU tar's
+	user/group/size and date column widths, which only ever grow while a
+	listing is printed.
+	"""
+	user=tarinfo.uname or str(tarinfo.uid)
+	group=tarinfo.gname or str(tarinfo.gid)
+	if tarinfo.type in (tarfile.CHRTYPE,tarfile.BLKTYPE):
+		size=str(tarinfo.devmajor)+","+str(tarinfo.devminor)
+	else:
+		size=str(tarinfo.size)
+	pad=len(user)+1+len(group)+1+len(size)
+	if pad > widths[0]:
+		widths[0]=pad
+	mytime=time.strftime("%Y-%m-%d %H:%M",time.localtime(tarinfo.mtime))
+	if len(mytime) > widths[1]:
+		widths[1]=len(mytime)
+	name=tarinfo.name
+	if tarinfo.isdir():
+		name=name+"/"
+	line="%s  %s/%s %*s %-*s %s" % (_tar_mode_string(tarinfo),user,group,\
+		widths[0]-pad+len(size),size,widths[1],mytime,_tar_quote(name))
+	if tarinfo.issym():
+		line+=" -> "+_tar_quote(tarinfo.linkname)
+	elif tarinfo.islnk():
+		line+=" link to "+_tar_quote(tarinfo.linkname)
+	return line+"\n"
+
+def write_contents(mylines,verbose,outfile=None):
+	"""
+	Write the lines of a listing to outfile as they are generated, or
+	return them joined if there is no outfile.
+	"""
+	result=[]
+	for line in mylines:
+		if verbose:
+			print line,
+		if outfile != None:
+			outfile.write(line)
+		else:
+			result.append(line)
+	if outfile == None:
+		return "".join(result)
+	return None
+
+def tar_members(file,format=None):
+	"""
+	Yield the members of a tarball, reading it with tarfile as a stream from
+	the fastest available decompressor, so memory use does not depend on
+	its size.
+	"""
+	if is_seekable(file) and find_decompressor("zstd") != None:
+		""" The index of a seekable archive says where the headers are """
+		try:
+			myarchive=catalyst_seekable.SeekableArchive(file)
+			if myarchive.members:
+				for tarinfo in myarchive.tar_members(\
+					find_decompressor("zstd"),cpu_count()):
+					yield tarinfo
+				return
+		except catalyst_seekable.SeekableError,e:
+			raise CatalystError,str(e)
+
+	myproc=None
+	sniffed=sniff_format(file)
+	if sniffed == "tar" or sniffed in decompressor_map:
+		""" Trust the data over the name or the contents option """
+		format=sniffed
+	if format == "tar":
+		mytar=tarfile.open(file,"r|")
+	else:
+		myproc=open_decompressor(file,format)
+		if myproc != None:
+			mytar=tarfile.open(fileobj=myproc.stdout,mode="r|")
+		elif format in ("gz","bz2"):
+			mytar=tarfile.open(file,"r|"+format)
+		else:
+			raise CatalystError,"No decompressor found for "+file
+
+	try:
+		for tarinfo in mytar:
+			""" Don't let tarfile remember every member it has seen """
+			mytar.members=[]
+			yield tarinfo
+	finally:
+		mytar.close()
+		if myproc != None:
+			myproc.stdout.close()
+			if myproc.wait() != 0:
+				raise CatalystError,"Decompressing "+file+" failed"
+
+def tar_contents_lines(file,format):
+	"""Yield the listing of a tarball, see tar_members()"""
+	widths=[19,16]
+	for tarinfo in tar_members(file,format):
+		yield tar_contents_line(tarinfo,widths)
+
+def calc_tar_contents(file,format,verbose,outfile=None):
+	return write_contents(tar_contents_lines(file,format),verbose,outfile)
+
+class _TeeReader:
+	"""file object for tarfile that copies everything it reads to sink"""
+	def __init__(self,source,sink):
+		self.source=source
+		self.sink=sink
+
+	def read(self,size):
+		data=self.source.read(size)
+		if data:
+			self.sink.write(data)
+		return data
+
+def capture_tarball(target,source,members,tar_args,compression,level=None,\
+	threads=None,contents_file=None,hash_functions=[],verbose=False,env=None):
+	"""
+	Create the tarball target from members of the directory source,
+	compressed with compression (see find_compressor), in a single pass.
+	tar's output is listed (into contents_file, like tar-tv would) on its
+	way to the compressor, and the compressed stream is digested with every
+	native algorithm of hash_functions on its way to disk. Returns
+	{hash function: hexdigest} for those algorithms.
+	"""
+	seekable=compression in seekable_compressions
+	if seekable:
+		""" Frames are compressed in parallel rather than with threads """
+		mycompressor=find_compressor(compression,level)
+	else:
+		mycompressor=find_compressor(compression,level,threads)
+	if mycompressor == None:
+		raise CatalystError,"No compressor found for "+compression
+	digests={}
+	for x in hash_functions:
+		mydigest=new_native_hash(x)
+		if mydigest != None:
+			digests[x]=mydigest
+
+	mytar=subprocess.Popen(["tar"]+tar_args+["-cpf","-","-C",source]+members,\
+		stdout=subprocess.PIPE,close_fds=True,env=env)
+	if seekable:
+		myproc=catalyst_seekable.SeekableWriter(mycompressor,\
+			int(threads or cpu_count()))
+	else:
+		myproc=subprocess.Popen(mycompressor,stdin=subprocess.PIPE,\
+			stdout=subprocess.PIPE,close_fds=True,env=env)
+	errors=[]
+
+	def feed():
+		""" tar -> listing -> compressor, while the caller writes target """
+		try:
+			try:
+				myreader=_TeeReader(mytar.stdout,myproc.stdin)
+				if contents_file != None or seekable:
+					mylisting=tarfile.open(mode="r|",fileobj=myreader,\
+						bufsize=HASH_BLOCK_SIZE)
+					widths=[19,16]
+					for tarinfo in mylisting:
+						mylisting.members=[]
+						if seekable:
+							myproc.add_member(tarinfo)
+						if contents_file == None:
+							continue
+						line=tar_contents_line(tarinfo,widths)
+						if verbose:
+							print line,
+						contents_file.write(line)
+				""" Pass on whatever follows the end of archive marker """
+				while myreader.read(HASH_BLOCK_SIZE):
+					pass
+			except:
+				errors.append(sys.exc_info())
+		finally:
+			mytar.stdout.close()
+			myproc.stdin.close()
+
+	myfeeder=threading.Thread(target=feed)
+	myfeeder.setDaemon(True)
+	myfeeder.start()
+	try:
+		myf=open(target,"wb")
+		try:
+			while True:
+				data=myproc.stdout.read(HASH_BLOCK_SIZE)
+				if not data:
+					break
+				myf.write(data)
+				for x in digests.values():
+					x.update(data)
+		finally:
+			myf.close()
+	finally:
+		myproc.stdout.close()
+		myfeeder.join()
+		tar_status=mytar.wait()
+		compressor_status=myproc.wait()
+	if tar_status != 0:
+		raise CatalystError,"Couldn't create tarball "+target
+	if compressor_status != 0:
+		raise CatalystError,"Compressing "+target+" failed"
+	if errors:
+		raise errors[0][0],errors[0][1],errors[0][2]
+
+	results={}
+	for x in digests.keys():
+		results[x]=digests[x].hexdigest()
+	return results
+
+# Snapshot deltas. An index maps every path of a tree to what tells its
+# versions apart: the type, the permissions, and the size and mtime of files
+# (rsync's quick check) or the target of symlinks.
+def _index_value(mode,size,mtime,linkname):
+	if stat.S_ISDIR(mode):
+		return "d %o" % stat.S_IMODE(mode)
+	if stat.S_ISLNK(mode):
+		return "l "+linkname
+	if stat.S_ISREG(mode):
+		return "f %o %d %d" % (stat.S_IMODE(mode),size,int(mtime))
+	return "o %o" % mode
+
+def tree_index(top,name,myfilter=None):
+	"""
+	the index of the directory top, as if it was called name: its paths
+	are name, name/file... Paths for which myfilter(path,lstat) is false
+	are left out, with everything below them.
+	"""
+	myindex={}
+	mytop=normpath(top).rstrip("/")
+	for dirpath,dirnames,filenames in os.walk(mytop):
+		myrel=name+dirpath[len(mytop):]
+		if dirpath == mytop:
+			mystat=os.lstat(dirpath)
+			myindex[name]=_index_value(mystat.st_mode,0,0,"")
+		for x in dirnames[:]+filenames:
+			mystat=os.lstat(dirpath+"/"+x)
+			if myfilter != None and not myfilter(myrel+"/"+x,mystat):
+				if x in dirnames:
+					dirnames.remove(x)
+				continue
+			mylink=""
+			if stat.S_ISLNK(mystat.st_mode):
+				mylink=os.readlink(dirpath+"/"+x)
+			myindex[myrel+"/"+x]=_index_value(mystat.st_mode,\
+				mystat.st_size,mystat.st_mtime,mylink)
+	return myindex
+
+def tarball_index(file):
+	"""
+	the index of the tree a tarball holds. A hard link is indexed like the
+	file it links to, as it is on disk.
+	"""
+	def member_name(name):
+		while name.startswith("./"):
+			name=name[2:]
+		return name.strip("/")
+	myindex={}
+	for tarinfo in tar_members(file):
+		myname=member_name(tarinfo.name)
+		if not myname or myname == ".":
+			continue
+		if tarinfo.islnk() and member_name(tarinfo.linkname) in myindex:
+			myindex[myname]=myindex[member_name(tarinfo.linkname)]
+			continue
+		if tarinfo.isdir():
+			mymode=stat.S_IFDIR
+		elif tarinfo.issym():
+			mymode=stat.S_IFLNK
+		elif tarinfo.isreg() or tarinfo.islnk():
+			mymode=stat.S_IFREG
+		else:
+			mymode=0
+		myindex[myname]=_index_value(mymode|stat.S_IMODE(tarinfo.mode),\
+			tarinfo.size,tarinfo.mtime,tarinfo.linkname)
+	return myindex
+
+def write_index(file,myindex):
+	mykeys=myindex.keys()
+	mykeys.sort()
+	myf=open(file+".tmp","w")
+	for x in mykeys:
+		myf.write(x+"\t"+myindex[x]+"\n")
+	myf.close()
+	os.rename(file+".tmp",file)
+
+def read_index(file):
+	myindex={}
+	myf=open(file,"r")
+	try:
+		for line in myf:
+			mysplit=line[:-1].split("\t",1)
+			if len(mysplit) == 2:
+				myindex[mysplit[0]]=mysplit[1]
+	finally:
+		myf.close()
+	return myindex
+
+def index_delta(old,new):
+	"""
+	Returns (changed,deleted): the paths of new that are not the same in
+	old, and the paths to remove from old first, which are those not in
+	new and those whose type changed. Paths below a deleted directory are
+	left out, they go with it.
+	"""
+	changed=[x for x in new.keys() if old.get(x) != new[x]]
+	changed.sort()
+	mydeleted={}
+	for x in old.keys():
+		if x not in new or old[x][0] != new[x][0]:
+			mydeleted[x]=1
+	deleted=[x for x in mydeleted.keys() if os.path.dirname(x) not in mydeleted]
+	deleted.sort()
+	return (changed,deleted)
+
+DELTA_MANIFEST_TAG="# catalyst snapshot delta\n"
+
+def write_delta_manifest(file,snapshot,base,changed,deleted):
+	"""
+	The manifest of the delta of snapshot to base, which is [snapshot,
+	hash function,digest id] of the base snapshot's tarball.
+	"""
+	myf=open(file,"w")
+	myf.write(DELTA_MANIFEST_TAG)
+	myf.write("snapshot "+snapshot+"\n")
+	myf.write("base "+" ".join(base)+"\n")
+	for x in deleted:
+		myf.write("deleted "+x+"\n")
+	for x in changed:
+		myf.write("changed "+x+"\n")
+	myf.close()
+
+def read_delta_manifest(file):
+	"""
+	Returns {"snapshot":name,"base":[name,hash function,digest id],
+	"changed":[paths],"deleted":[paths]}
+	"""
+	mymanifest={"changed":[],"deleted":[]}
+	myf=open(file,"r")
+	try:
+		if myf.readline() != DELTA_MANIFEST_TAG:
+			raise CatalystError,file+" is not a snapshot delta manifest"
+		for line in myf:
+			mysplit=line[:-1].split(" ",1)
+			if mysplit[0] in ["changed","deleted"]:
+				if mysplit[1].startswith("/") or \
+					".." in mysplit[1].split("/"):
+					raise CatalystError,"Bad path "+mysplit[1]+" in "+file
+				mymanifest[mysplit[0]].append(mysplit[1])
+			elif mysplit[0] == "snapshot":
+				mymanifest["snapshot"]=mysplit[1]
+			elif mysplit[0] == "base":
+				mymanifest["base"]=mysplit[1].split()
+	finally:
+		myf.close()
+	if "snapshot" not in mymanifest or len(mymanifest.get("base",[])) != 3:
+		raise CatalystError,file+" is not a snapshot delta manifest"
+	return mymanifest
+
+def remove_delta_paths(mymanifest,destdir):
+	"""
+	Prepare the base tree in destdir for the delta archive: remove what
+	the delta deletes, and unlink what it changes, so that files the tree
+	shares with others through hard links are never written to.
+	"""
+	for x in mymanifest["deleted"]:
+		mypath=normpath(destdir+"/"+x)
+		if os.path.isdir(mypath) and not os.path.islink(mypath):
+			shutil.rmtree(mypath)
+		elif os.path.lexists(mypath):
+			os.unlink(mypath)
+	for x in mymanifest["changed"]:
+		mypath=normpath(destdir+"/"+x)
+		if os.path.lexists(mypath) and \
+			not (os.path.isdir(mypath) and not os.path.islink(mypath)):
+			os.unlink(mypath)
+
+def iso_contents_lines(file,mode):
+	"""
+	Yield the listing of an ISO like 'isoinfo -l' or 'isoinfo -f' (mode).
+	The 'l' listing goes on with the contents of the livecd's squashfs image
+	when unsquashfs is there to read it.
+	"""
+	for line in catalyst_iso.isoinfo_listing(file,find=(mode=="f")):
+		yield line
+	if mode == "l" and find_binary("unsquashfs"):
+		for line in squashfs_contents_lines(file,"."):
+			yield line
+
+def calc_iso_contents(file,mode,verbose,outfile=None):
+	return write_contents(iso_contents_lines(file,mode),verbose,outfile)
+
+# Where create-iso.sh may have put the squashfs image of a livecd
+iso_squashfs_paths=["/image.squashfs","/loopback/image.squashfs"]
+
+def squashfs_contents_lines(file,prefix):
+	"""
+	Yield the 'unsquashfs -lls' listing of a squashfs image, or of the
+	squashfs image embedded in an ISO. unsquashfs reads it in place, at its
+	offset within the ISO, without extracting anything.
+	"""
+	offset=0
+	if file.endswith(".iso"):
+		location=None
+		for x in iso_squashfs_paths:
+			location=catalyst_iso.find_file_offset(file,x)
+			if location != None:
+				prefix=x
+				offset=location[0]
+				break
+		if location == None:
+			return
+	mycmd=[find_binary("unsquashfs") or "unsquashfs","-lls","-d",prefix]
+	if offset:
+		mycmd.extend(["-o",str(offset)])
+	mycmd.append(file)
+	myproc=subprocess.Popen(mycmd,stdout=subprocess.PIPE,close_fds=True)
+	listing=re.compile("^[-dlcbps][-rwxsStT]{9} ")
+	try:
+		for line in myproc.stdout:
+			""" Skip unsquashfs' chatter about processors and inodes """
+			if listing.match(line):
+				yield line
+	finally:
+		myproc.stdout.close()
+		if myproc.wait() != 0:
+			raise CatalystError,"unsquashfs failed to list "+file
+
+def calc_squashfs_contents(file,prefix,verbose,outfile=None):
+	return write_contents(squashfs_contents_lines(file,prefix),verbose,outfile)
+
 # This has map must be defined after the function calc_content
 # It is possible to call different functions from this but they must be defined
 # before hash_map
@@ -108,16 +880,34 @@ contents_map={
 	# 'find' is disabled because it requires the source path, which is not
 	# always available
 	#"find"		:[calc_contents,"find %(path)s"],
-	"tar-tv":[calc_contents,"tar --xattrs tvf %(file)s"],
-	"tar-tvz":[calc_contents,"tar --xattrs tvzf %(file)s"],
-	"tar-tvj":[calc_contents,"tar --xattrs -I lbzip2 -tvf %(file)s"],
-	"isoinfo-l":[calc_contents,"isoinfo -l -i %(file)s"],
+	"tar-tv":[calc_tar_contents,"tar"],
+	"tar-tvz":[calc_tar_contents,"gz"],
+	"tar-tvj":[calc_tar_contents,"bz2"],
+	"tar-tvJ":[calc_tar_contents,"xz"],
+	"tar-tvzst":[calc_tar_contents,"zstd"],
+	"tar-tvlz4":[calc_tar_contents,"lz4"],
+	"isoinfo-l":[calc_iso_contents,"l"],
 	# isoinfo-f should be a last resort only
-	"isoinfo-f":[calc_contents,"isoinfo -f -i %(file)s"],
+	"isoinfo-f":[calc_iso_contents,"f"],
+	"unsquashfs-l":[calc_squashfs_contents,"."],
+}
+
+# The automatic contents function for every format sniff_format() detects
+contents_sniff_map={
+	"tar":"tar-tv",
+	"gz":"tar-tvz",
+	"bz2":"tar-tvj",
+	"xz":"tar-tvJ",
+	"zstd":"tar-tvzst",
+	"lz4":"tar-tvlz4",
+	"iso":"isoinfo-l",
+	"squashfs":"unsquashfs-l",
 }
 
 def generate_hash(file,hash_function="crc32",verbose=False):
 	try:
+		if hash_is_native(hash_function):
+			return generate_hashes(file,[hash_function],verbose)
 		return hash_map[hash_function][0](file,hash_map[hash_function][1],hash_map[hash_function][2],\
 			hash_map[hash_function][3],verbose)
 	except:
@@ -179,6 +969,187 @@ hash_map={
 	 "whirlpool":[calc_hash2,"shash","-a WHIRLPOOL","WHIRLPOOL"],\
 	 }
 
+# Block size used when feeding files through the in-process digests.
+HASH_BLOCK_SIZE=4*1024*1024
+
+# Bit-reversal table used to compute the (non-reflected) ethernet CRC32 that
+# shash calls CRC32 on top of zlib's reflected crc32.
+_bitrev_table="".join([chr(int("{0:08b}".format(x)[::-1],2)) for x in range(256)])
+
+def _bitrev32(x):
+	return int("{0:032b}".format(x & 0xffffffff)[::-1],2)
+
+class zlib_checksum:
+	"""
+	hashlib-like wrapper around the zlib checksum functions, so they can be
+	fed alongside the hashlib digests.
+	"""
+	def __init__(self,function,initial,reflect=False):
+		self.function=function
+		self.value=initial
+		self.reflect=reflect
+
+	def update(self,data):
+		if self.reflect:
+			data=data.translate(_bitrev_table)
+		self.value=self.function(data,self.value)
+
+	def hexdigest(self):
+		value=self.value & 0xffffffff
+		if self.reflect:
+			value=_bitrev32(value)
+		return "%08x" % value
+
+def _new_adler32():
+	return zlib_checksum(zlib.adler32,1)
+
+def _new_crc32():
+	return zlib_checksum(zlib.crc32,0,reflect=True)
+
+def _new_crc32b():
+	return zlib_checksum(zlib.crc32,0)
+
+def _new_hashlib(name):
+	return hashlib.new(name)
+
+# Digests that can be computed in-process, without forking shash.
+# Key,constructor,constructor args
+native_hash_map={
+	"adler32":[_new_adler32],\
+	"crc32":[_new_crc32],\
+	"crc32b":[_new_crc32b],\
+	"md4":[_new_hashlib,"md4"],\
+	"md5":[_new_hashlib,"md5"],\
+	"ripemd160":[_new_hashlib,"ripemd160"],\
+	"sha1":[_new_hashlib,"sha1"],\
+	"sha224":[_new_hashlib,"sha224"],\
+	"sha256":[_new_hashlib,"sha256"],\
+	"sha384":[_new_hashlib,"sha384"],\
+	"sha512":[_new_hashlib,"sha512"],\
+	"whirlpool":[_new_hashlib,"whirlpool"],\
+	}
+
+def new_native_hash(hash_function):
+	"""return a fresh in-process digest object, or None if unsupported"""
+	if hash_function not in native_hash_map:
+		return None
+	try:
+		return native_hash_map[hash_function][0](*native_hash_map[hash_function][1:])
+	except ValueError:
+		# hashlib only offers what the linked OpenSSL provides
+		return None
+
+def hash_is_native(hash_function):
+	return new_native_hash(hash_function) != None
+
+def format_hash(file,hash_function,hexdigest,verbose=False):
+	"""format a digest the same way calc_hash2 formats shash output"""
+	header="# "+hash_map[hash_function][3]+" HASH\n"
+	short_file=os.path.split(file)[1]
+	result=header+hexdigest+"  "+short_file+"\n"
+	if verbose:
+		print header+" (%s) = %s" % (short_file, result)
+	return result
+
+def native_digests(file,hash_functions,known={}):
+	"""
+	{hash function: hexdigest} of file for the algorithms of hash_functions
+	that can be computed in-process and are not in known, reading it once
+	"""
+	digests={}
+	for x in hash_functions:
+		if x not in hash_map:
+			raise CatalystError,"Unknown hash function "+x
+		if x in known:
+			continue
+		mydigest=new_native_hash(x)
+		if mydigest != None:
+			digests[x]=mydigest
+
+	if digests:
+		try:
+			myf=open(file,"rb")
+		except IOError:
+			raise CatalystError,"Could not open "+file+" for hashing"
+		try:
+			while True:
+				data=myf.read(HASH_BLOCK_SIZE)
+				if not data:
+					break
+				for x in digests.values():
+					x.update(data)
+		finally:
+			myf.close()
+	for x in digests.keys():
+		digests[x]=digests[x].hexdigest()
+	return digests
+
+def generate_hashes(file,hash_functions,verbose=False,known={}):
+	"""
+	Digest file with every algorithm in hash_functions, reading it only
+	once. Algorithms that cannot be computed in-process are handed to shash.
+	known holds hexdigests that were already computed, they are used as is.
+	Returns the concatenated results, in the order of hash_functions.
+	"""
+	digests=native_digests(file,hash_functions,known)
+	results=[]
+	for x in hash_functions:
+		if x in known:
+			results.append(format_hash(file,x,known[x],verbose))
+		elif x in digests:
+			results.append(format_hash(file,x,digests[x],verbose))
+		else:
+			results.append(hash_map[x][0](file,hash_map[x][1],hash_map[x][2],\
+				hash_map[x][3],verbose))
+	return "".join(results)
+
+def cpu_count():
+	try:
+		return max(1,os.sysconf("SC_NPROCESSORS_ONLN"))
+	except (ValueError,OSError,AttributeError):
+		return 1
+
+def parallel_map(function,items,jobs=1):
+	"""
+	Call function(item) for every item, running up to jobs calls at once in
+	worker threads. Returns one [result,error] pair per item, in the order of
+	items; error is the sys.exc_info() of a failed call, or None.
+	"""
+	results=[[None,None] for x in items]
+	if jobs <= 1 or len(items) <= 1:
+		for x in range(0,len(items)):
+			try:
+				results[x][0]=function(items[x])
+			except SystemExit:
+				raise
+			except:
+				results[x][1]=sys.exc_info()
+		return results
+
+	next_item=[0]
+	next_lock=threading.Lock()
+	def worker():
+		while True:
+			next_lock.acquire()
+			x=next_item[0]
+			next_item[0]+=1
+			next_lock.release()
+			if x >= len(items):
+				return
+			try:
+				results[x][0]=function(items[x])
+			except:
+				results[x][1]=sys.exc_info()
+
+	workers=[]
+	for x in range(0,min(jobs,len(items))):
+		workers.append(threading.Thread(target=worker))
+		workers[-1].setDaemon(True)
+		workers[-1].start()
+	for x in workers:
+		x.join()
+	return results
+
 def read_from_clst(file):
 	line = ''
 	myline = ''
@@ -206,6 +1177,7 @@ required_config_file_values=["storedir","sharedir","distdir","portdir"]
 valid_config_file_values=required_config_file_values[:]
 valid_config_file_values.append("PKGCACHE")
 valid_config_file_values.append("KERNCACHE")
+valid_config_file_values.append("NAMESPACES")
 valid_config_file_values.append("CCACHE")
 valid_config_file_values.append("DISTCC")
 valid_config_file_values.append("ICECREAM")
@@ -223,6 +1195,20 @@ valid_config_file_values.append("snapshot_cache")
 valid_config_file_values.append("hash_function")
 valid_config_file_values.append("digests")
 valid_config_file_values.append("contents")
+valid_config_file_values.append("digest_jobs")
+valid_config_file_values.append("compression")
+valid_config_file_values.append("compression_level")
+valid_config_file_values.append("compression_threads")
+valid_config_file_values.append("seed_mode")
+valid_config_file_values.append("snapshot_format")
+valid_config_file_values.append("snapshot_method")
+valid_config_file_values.append("snapshot_freeze")
+valid_config_file_values.append("snapshot_cache_size")
+valid_config_file_values.append("pkgcache_size")
+valid_config_file_values.append("kerncache_size")
+valid_config_file_values.append("seed_cache_size")
+valid_config_file_values.append("kill_timeout")
+valid_config_file_values.append("lock_wait")
 valid_config_file_values.append("SEEDCACHE")
 
 verbosity=1
@@ -280,17 +1266,29 @@ def die(msg=None):
 def warn(msg):
 	print "!!! catalyst: "+msg
 
-def find_binary(myc):
-	"""look through the environmental path for an executable file named whatever myc is"""
-        # this sucks. badly.
-        p=os.getenv("PATH")
-        if p == None:
-                return None
-        for x in p.split(":"):
-                #if it exists, and is executable
-                if os.path.exists("%s/%s" % (x,myc)) and os.stat("%s/%s" % (x,myc))[0] & 0x0248:
-                        return "%s/%s" % (x,myc)
-        return None
+# (PATH,name) -> where find_binary found name
+found_binaries={}
+
+def find_binary(myc,p=None):
+	"""look through the environmental path, or p, for an executable file named whatever myc is"""
+	if p == None:
+		p=os.getenv("PATH")
+	if p == None:
+		return None
+	""" A binary found before only costs one access() to check it is still there """
+	mybinary=found_binaries.get((p,myc))
+	if mybinary != None and os.access(mybinary,os.X_OK):
+		return mybinary
+	for x in p.split(":"):
+		#if it exists, and is executable
+		if os.path.exists("%s/%s" % (x,myc)) and os.stat("%s/%s" % (x,myc))[0] & 0x0248:
+			found_binaries[(p,myc)]="%s/%s" % (x,myc)
+			return "%s/%s" % (x,myc)
+	return None
+
+# Commands made of these characters only mean the same to bash as split on
+# whitespace: no quoting, expansions, redirections or control operators
+plain_command=re.compile("^[A-Za-z0-9_./,:=+@%-]+([ \t]+[A-Za-z0-9_./,:=+@%-]+)*$")
 
 def spawn_bash(mycommand,env={},debug=False,opt_name=None,**keywords):
 	"""spawn mycommand as an arguement to bash"""
@@ -299,12 +1297,151 @@ def spawn_bash(mycommand,env={},debug=False,opt_name=None,**keywords):
 	    opt_name=mycommand.split()[0]
 	if "BASH_ENV" not in env:
 	    env["BASH_ENV"] = "/etc/spork/is/not/valid/profile.env"
+	mysplit=mycommand.split()
+	if not debug and plain_command.match(mycommand.strip()) and \
+		"=" not in mysplit[0]:
+		"""
+		Bash would only run the binary, so run it directly. Builtins and
+		functions are not found as binaries and still go through bash, as
+		do commands whose env has no PATH to find them in.
+		"""
+		mybinary=None
+		if "/" in mysplit[0]:
+			mybinary=mysplit[0]
+			if not os.access(mybinary,os.X_OK) or os.path.isdir(mybinary):
+				mybinary=None
+		elif env.get("PATH"):
+			mybinary=find_binary(mysplit[0],env["PATH"])
+		if mybinary != None:
+			return spawn([mybinary]+mysplit[1:],env=env,opt_name=opt_name,\
+				**keywords)
 	if debug:
 	    args.append("-x")
 	args.append("-c")
 	args.append(mycommand)
 	return spawn(args,env=env,opt_name=opt_name,**keywords)
 
+try:
+	import ctypes
+	_libc=ctypes.CDLL(None,use_errno=True)
+except SystemExit, e:
+	raise
+except:
+	_libc=None
+
+# close_range(2) is syscall 436 everywhere but alpha, where it is 546
+if os.uname()[4] == "alpha":
+	NR_close_range=546
+else:
+	NR_close_range=436
+
+def close_range(first,last):
+	"""close fds first to last, returns False if the kernel can't"""
+	if _libc == None:
+		return False
+	if hasattr(_libc,"close_range"):
+		retval=_libc.close_range(ctypes.c_uint(first),ctypes.c_uint(last),\
+			ctypes.c_int(0))
+	else:
+		retval=_libc.syscall(ctypes.c_long(NR_close_range),\
+			ctypes.c_uint(first),ctypes.c_uint(last),ctypes.c_int(0))
+	return retval == 0
+
+def close_fds(keep):
+	"""
+	Close every fd but those in keep, without trying every fd number up to
+	max_fd_limit when that can be helped: with close_range(2), or else
+	only the fds /proc/self/fd lists
+	"""
+	mykeep=[x for x in keep if x >= 0]
+	mykeep.sort()
+	myfirst=0
+	for x in mykeep+[0xffffffff]:
+		if myfirst < x and not close_range(myfirst,x-1):
+			break
+		myfirst=x+1
+	else:
+		return
+	try:
+		myfds=[int(x) for x in os.listdir("/proc/self/fd")]
+	except OSError:
+		myfds=range(0,max_fd_limit)
+	for x in myfds:
+		if x not in keep:
+			try:
+				os.close(x)
+			except OSError:
+				pass
+
+# While action steps run at the same time, what each thread prints goes to
+# the file of the step it runs, see catalyst_actions
+step_output=threading.local()
+
+def step_fd(fd):
+	""" Where output for fd goes in this thread """
+	myf=getattr(step_output,"file",None)
+	if myf == None:
+		return fd
+	return myf.fileno()
+
+class StepOutput:
+	"""
+	Stands in for sys.stdout and sys.stderr while steps run at the same
+	time, writing to the file of the step the calling thread runs
+	"""
+	def __init__(self,stream):
+		self.stream=stream
+
+	def target(self):
+		myf=getattr(step_output,"file",None)
+		if myf == None:
+			return self.stream
+		return myf
+
+	def write(self,data):
+		self.target().write(data)
+
+	def flush(self):
+		self.target().flush()
+
+	def fileno(self):
+		return self.target().fileno()
+
+	def __getattr__(self,name):
+		return getattr(self.stream,name)
+
+class LogTee(threading.Thread):
+	"""
+	Copy what is written to the pipe fd to stdout and logfile, in place of
+	a tee process
+	"""
+	def __init__(self,fd,logfile):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.fd=fd
+		self.out=step_fd(1)
+		self.log=os.open(logfile,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0644)
+		self.start()
+
+	def run(self):
+		try:
+			while True:
+				try:
+					data=os.read(self.fd,65536)
+				except OSError, e:
+					if e.errno == errno.EINTR:
+						continue
+					raise
+				if not data:
+					break
+				for x in [self.out,self.log]:
+					mywritten=0
+					while mywritten < len(data):
+						mywritten+=os.write(x,data[mywritten:])
+		finally:
+			os.close(self.fd)
+			os.close(self.log)
+
 #def spawn_get_output(mycommand,spawn_type=spawn,raw_exit_code=False,emulate_gso=True, \
 #        collect_fds=[1],fd_pipes=None,**keywords):
 
@@ -372,8 +1509,8 @@ def spawn(mycommand,env={},raw_exit_code=False,opt_name=None,fd_pipes=None,retur
 	raise_signals is questionable.  Basically throw an exception if signal'd.  No exception is thrown
 	if raw_input is on.
 
-	logfile overloads the specified fd's to write to a tee process which logs to logfile
-	returnpid returns the relevant pids (a list, including the logging process if logfile is on).
+	logfile overloads the specified fd's to write to a tee thread which logs to logfile
+	returnpid returns the relevant pids (a list of the one spawned process; the tee thread is not in it).
 
 	non-returnpid calls to spawn will block till the process has exited, returning the exitcode/signal
 	raw_exit_code controls whether the actual waitpid result is returned, or intrepretted."""
@@ -390,15 +1527,12 @@ def spawn(mycommand,env={},raw_exit_code=False,opt_name=None,fd_pipes=None,retur
 			if myc == None:
 			    return None
         mypid=[]
+	if fd_pipes == None and step_fd(1) != 1:
+		fd_pipes={0:0,1:step_fd(1),2:step_fd(2)}
+	mytee=None
 	if logfile:
 		pr,pw=os.pipe()
-		mypid.extend(spawn(('tee','-i','-a',logfile),returnpid=True,fd_pipes={0:pr,1:1,2:2}))
-		retval=os.waitpid(mypid[-1],os.WNOHANG)[1]
-		if retval != 0:
-			# he's dead jim.
-			if raw_exit_code:
-				return retval
-			return process_exit_code(retval)
+		mytee=LogTee(pr,logfile)
 
 		if fd_pipes == None:
 			fd_pipes={}
@@ -457,14 +1591,7 @@ def spawn(mycommand,env={},raw_exit_code=False,opt_name=None,fd_pipes=None,retur
 			trg_fd=[0,1,2]
 
 		# wax all open descriptors that weren't requested be left open.
-		for x in range(0,max_fd_limit):
-			if x not in trg_fd:
-				try:
-					os.close(x)
-                                except SystemExit, e:
-                                        raise
-                                except:
-                                        pass
+		close_fds(trg_fd)
 
                 # note this order must be preserved- can't change gid/groups if you change uid first.
                 if selinux_capable and selinux_context:
@@ -509,20 +1636,22 @@ def spawn(mycommand,env={},raw_exit_code=False,opt_name=None,fd_pipes=None,retur
                 sys.exit(1)
                 return # should never get reached
 
-        # if we were logging, kill the pipes.
+        # if we were logging, close our end of the pipe, the tee thread
+        # closes its own once the child is done writing.
         if logfile:
-                os.close(pr)
                 os.close(pw)
 
         if returnpid:
                 return mypid
 
-        # loop through pids (typically one, unless logging), either waiting on their death, or waxing them
+        # loop through pids (just the one), either waiting on their death, or waxing them
         # if the main pid (mycommand) returned badly.
         while len(mypid):
                 retval=os.waitpid(mypid[-1],0)[1]
                 if retval != 0:
                         cleanup(mypid[0:-1],block_exceptions=False)
+                        if mytee != None:
+                                mytee.join()
                         # at this point we've killed all other kid pids generated via this call.
                         # return now.
                         if raw_exit_code:
@@ -531,6 +1660,8 @@ def spawn(mycommand,env={},raw_exit_code=False,opt_name=None,fd_pipes=None,retur
                 else:
                         mypid.pop(-1)
         cleanup(mypid)
+        if mytee != None:
+                mytee.join()
         return 0
 
 def cmd(mycmd,myexc="",env={}):
@@ -616,7 +1747,23 @@ def parse_makeconf(mylines):
 			    mymakeconf[mobj.group(1)]=clean_string
 	return mymakeconf
 
-def read_makeconf(mymakeconffile):
+def read_makeconf(mymakeconffile,archive=None):
+	"""
+	The variables mymakeconffile sets. With archive, mymakeconffile is read
+	out of that tarball, see read_archive_member().
+	"""
+	if archive != None:
+		import tempfile
+		mydata=read_archive_member(archive,mymakeconffile)
+		if mydata == None:
+			return {}
+		myfd,mytmp=tempfile.mkstemp(prefix="catalyst-make.conf-")
+		try:
+			os.write(myfd,mydata)
+			os.close(myfd)
+			return read_makeconf(mytmp)
+		finally:
+			os.unlink(mytmp)
 	if os.path.exists(mymakeconffile):
 		try:
 			try:
@@ -657,8 +1804,97 @@ def pathcompare(path1,path2):
 		return 1
 	return 0
 
+def _unescape_mountinfo(field):
+	""" mountinfo writes spaces, tabs, newlines and backslashes as \\ooo """
+	return re.sub(r"\\([0-7]{3})",lambda m: chr(int(m.group(1),8)),field)
+
+def _mount_key(path):
+	""" The path as the kernel names a mount on it """
+	mypath=os.path.realpath(path)
+	if mypath != "/":
+		mypath=mypath.rstrip("/")
+	return mypath
+
+class MountTable:
+	"""
+	The mount points of this mount namespace, read from
+	/proc/self/mountinfo. The kernel flags the open file with POLLPRI when
+	anything is mounted or unmounted, so it is only read again after a
+	change. mountpoints is kept sorted, the mounts below a directory are
+	one slice of it.
+	"""
+	def __init__(self,path="/proc/self/mountinfo"):
+		self.path=path
+		self.fd=None
+		self.poller=None
+		self.mounts={}
+		self.mountpoints=[]
+
+	def refresh(self):
+		""" Read the table again if it changed, False if there is none """
+		if self.fd == None:
+			try:
+				self.fd=os.open(self.path,os.O_RDONLY)
+			except OSError:
+				return False
+			self.poller=select.poll()
+			self.poller.register(self.fd,select.POLLPRI|select.POLLERR)
+			self.poller.poll(0)
+		elif not self.poller.poll(0):
+			return True
+		self.read()
+		return True
+
+	def read(self):
+		os.lseek(self.fd,0,0)
+		mydata=[]
+		while True:
+			data=os.read(self.fd,65536)
+			if not data:
+				break
+			mydata.append(data)
+		mymounts={}
+		for line in "".join(mydata).splitlines():
+			mysplit=line.split(" ")
+			if len(mysplit) < 10 or "-" not in mysplit[6:]:
+				continue
+			mysep=mysplit.index("-",6)
+			mypoint=_unescape_mountinfo(mysplit[4])
+			""" Mounts stacked on the same point, the last one is visible """
+			mymounts.setdefault(mypoint,[]).append({"id":mysplit[0],\
+				"root":_unescape_mountinfo(mysplit[3]),\
+				"options":mysplit[5],"fstype":mysplit[mysep+1],\
+				"source":_unescape_mountinfo(mysplit[mysep+2])})
+		self.mounts=mymounts
+		self.mountpoints=mymounts.keys()
+		self.mountpoints.sort()
+
+	def ismount(self,path):
+		return _mount_key(path) in self.mounts
+
+	def mounts_under(self,path):
+		"""the mount points below path, not path itself, parents first"""
+		mypath=_mount_key(path)
+		if mypath == "/":
+			return [x for x in self.mountpoints if x != "/"]
+		""" "0" is the character after "/" """
+		return self.mountpoints[bisect.bisect_left(self.mountpoints,mypath+"/"):\
+			bisect.bisect_left(self.mountpoints,mypath+"0")]
+
+mount_table=MountTable()
+
+def mounts_under(path):
+	"""the mount points below path, parents first, [] if they are unknown"""
+	if not mount_table.refresh():
+		return []
+	return mount_table.mounts_under(path)
+
 def ismount(path):
 	"enhanced to handle bind mounts"
+	if mount_table.refresh():
+		if mount_table.ismount(path):
+			return 1
+		return 0
 	if os.path.ismount(path):
 		return 1
 	a=os.popen("mount")
@@ -670,6 +1906,244 @@ def ismount(path):
 			return 1
 	return 0
 
+def digest_id(mydigest):
+	"""
+	The bare digest in the output of generate_hash(), without its header
+	and file name, to name things after. "unknown" if there is none.
+	"""
+	if mydigest:
+		for line in mydigest.split("\n"):
+			if line and not line.startswith("#"):
+				return line.split()[0]
+	return "unknown"
+
+def pid_exists(pid):
+	try:
+		os.kill(pid,0)
+	except OSError, e:
+		return e.errno == errno.EPERM
+	return True
+
+# pidfd_open(2) is syscall 434 everywhere but alpha, where it is 544
+if os.uname()[4] == "alpha":
+	NR_pidfd_open=544
+else:
+	NR_pidfd_open=434
+
+def pidfd_open(pid):
+	"""an fd that polls readable once pid has exited, None if unavailable"""
+	if _libc == None:
+		return None
+	myfd=_libc.syscall(ctypes.c_long(NR_pidfd_open),ctypes.c_int(pid),\
+		ctypes.c_uint(0))
+	if myfd < 0:
+		return None
+	return myfd
+
+def _proc_link(pid,name):
+	try:
+		return os.readlink("/proc/"+pid+"/"+name)
+	except OSError:
+		return None
+
+def chroot_pids(chroot_path):
+	"""
+	[pid,exe] for the processes whose root or executable is in
+	chroot_path, in one pass over /proc
+	"""
+	mychroot=os.path.realpath(chroot_path).rstrip("/")
+	if not mychroot:
+		raise CatalystError,"Refusing to look for processes in /"
+	mypids=[]
+	for x in os.listdir("/proc"):
+		if not x.isdigit() or int(x) == os.getpid():
+			continue
+		myroot=_proc_link(x,"root")
+		myexe=_proc_link(x,"exe")
+		for y in [myroot,myexe]:
+			if y != None and (y == mychroot or y.startswith(mychroot+"/")):
+				mypids.append([int(x),myexe])
+				break
+	return mypids
+
+def wait_pids(pids,timeout):
+	"""
+	Wait up to timeout seconds for pids to exit, on pidfds where the
+	kernel has them. Returns the pids still running.
+	"""
+	mypoller=select.poll()
+	myfds={}
+	mywaiting=[]
+	for x in pids:
+		myfd=pidfd_open(x)
+		if myfd != None:
+			myfds[myfd]=x
+			mypoller.register(myfd,select.POLLIN)
+		elif pid_exists(x):
+			mywaiting.append(x)
+	try:
+		myend=time.time()+timeout
+		while myfds or mywaiting:
+			myleft=myend-time.time()
+			if myleft <= 0:
+				break
+			if mywaiting:
+				""" Without pidfds all we can do is look again shortly """
+				myleft=min(myleft,0.1)
+			for myfd,myevent in mypoller.poll(int(myleft*1000)+1):
+				mypoller.unregister(myfd)
+				os.close(myfd)
+				del myfds[myfd]
+			mywaiting=[x for x in mywaiting if pid_exists(x)]
+		return myfds.values()+mywaiting
+	finally:
+		for x in myfds.keys():
+			os.close(x)
+
+def kill_chroot_processes(chroot_path,timeout=10):
+	"""
+	TERM the processes running in chroot_path, KILL those still there after
+	timeout seconds. Returns how many were found.
+	"""
+	mypids=chroot_pids(chroot_path)
+	if not mypids:
+		return 0
+	print "Killing process(es) in "+chroot_path
+	print "pid: process name"
+	for x in mypids:
+		print str(x[0])+": "+str(x[1])
+		try:
+			os.kill(x[0],signal.SIGTERM)
+		except OSError, e:
+			if e.errno != errno.ESRCH:
+				raise
+	myleft=wait_pids([x[0] for x in mypids],timeout)
+	for x in myleft:
+		print str(x)+" did not exit within "+str(timeout)+"s, killing it"
+		try:
+			os.kill(x,signal.SIGKILL)
+		except OSError, e:
+			if e.errno != errno.ESRCH:
+				raise
+	myleft=wait_pids(myleft,timeout)
+	if myleft:
+		warn("Still running in "+chroot_path+": "+\
+			string.join([str(x) for x in myleft]))
+	return len(mypids)
+
+def filesystem_supported(fstype):
+	"""can this kernel mount filesystems of type fstype"""
+	try:
+		myf=open("/proc/filesystems","r")
+		try:
+			for line in myf:
+				if line.split()[-1:] == [fstype]:
+					return True
+		finally:
+			myf.close()
+	except IOError:
+		pass
+	return False
+
+def overlay_supported():
+	"""can this kernel mount overlayfs"""
+	return filesystem_supported("overlay")
+
+def squashfs_mount_supported():
+	"""
+	can squashfs images be mounted read-only with a writable overlay on
+	top, instead of being extracted
+	"""
+	return os.uname()[0] == "Linux" and filesystem_supported("squashfs") \
+		and overlay_supported()
+
+def reflink_supported(source,dest):
+	"""
+	can files under source be cloned with reflinks to dest, which must be on
+	the same btrfs or XFS filesystem
+	"""
+	for x in [source,dest]:
+		if not os.path.exists(x):
+			os.makedirs(x,0755)
+	probe=normpath(source+"/.catalyst-reflink-probe-"+str(os.getpid()))
+	clone=normpath(dest+"/.catalyst-reflink-probe-"+str(os.getpid()))
+	try:
+		try:
+			myf=open(probe,"w")
+			myf.write("catalyst")
+			myf.close()
+		except IOError:
+			return False
+		mynull=open(os.devnull,"w")
+		try:
+			return subprocess.call(["cp","--reflink=always",probe,clone],\
+				stdout=mynull,stderr=mynull) == 0
+		finally:
+			mynull.close()
+	finally:
+		for x in [probe,clone]:
+			if os.path.exists(x):
+				os.unlink(x)
+
+# A chroot instantiated from a seed with overlayfs has the seed recorded in
+# CHROOT.overlay, its changes in CHROOT.upper and overlayfs' in CHROOT.work
+def overlay_paths(path):
+	"""returns (config file, upper dir, work dir) of the overlay chroot path"""
+	path=normpath(path).rstrip("/")
+	return (path+".overlay",path+".upper",path+".work")
+
+def overlay_layers(path):
+	"""
+	The directories whose union is the chroot (or seed directory) at path,
+	topmost first. A chroot whose seed is itself an overlay chroot simply
+	has more layers, so overlays never need to be stacked.
+	"""
+	myconfig,myupper,mywork=overlay_paths(path)
+	if not os.path.exists(myconfig):
+		return [normpath(path).rstrip("/")]
+	myf=open(myconfig,"r")
+	lower=myf.readline().strip()
+	myf.close()
+	return [myupper]+overlay_layers(lower)
+
+def create_overlay_chroot(path,lower):
+	"""Make path a copy-on-write view of the directory lower, and mount it"""
+	myconfig,myupper,mywork=overlay_paths(path)
+	for x in [path,myupper,mywork]:
+		if not os.path.exists(x):
+			os.makedirs(x,0755)
+	myf=open(myconfig,"w")
+	myf.write(normpath(lower)+"\n")
+	myf.close()
+	mount_overlay_chroot(path)
+
+def mount_overlay_chroot(path):
+	"""
+	Mount the overlay chroot at path unless it already is, mounts do not
+	survive a reboot. Does nothing for plain directories.
+	"""
+	myconfig,myupper,mywork=overlay_paths(path)
+	if not os.path.exists(myconfig) or ismount(path):
+		return
+	cmd("mount -t overlay overlay -o lowerdir="+\
+		":".join(overlay_layers(path)[1:])+",upperdir="+myupper+\
+		",workdir="+mywork+" "+path,"Couldn't mount the overlay at "+path)
+
+def remove_overlay_chroot(path):
+	"""
+	Unmount the overlay chroot at path and forget its seed, leaving an
+	empty directory. Does nothing for plain directories.
+	"""
+	myconfig,myupper,mywork=overlay_paths(path)
+	if not os.path.exists(myconfig):
+		return
+	if ismount(path):
+		cmd("umount "+path,"Couldn't unmount the overlay at "+path)
+	for x in [myupper,mywork]:
+		if os.path.exists(x):
+			shutil.rmtree(x)
+	os.unlink(myconfig)
+
 def addl_arg_parse(myspec,addlargs,requiredspec,validspec):
 	"helper function to help targets parse additional arguments"
 	global valid_config_file_values
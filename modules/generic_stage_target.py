@@ -1,8 +1,14 @@
-import os,string,imp,types,shutil
+import os,string,imp,types,shutil,glob
 from catalyst_support import *
 from generic_target import *
 from stat import *
 import catalyst_lock
+import catalyst_hashcache
+import catalyst_cachegc
+import catalyst_pkgstore
+import catalyst_kernstore
+import catalyst_fileops
+import catalyst_actions
 
 class generic_stage_target(generic_target):
 	"""
@@ -129,9 +135,12 @@ class generic_stage_target(generic_target):
 		self.set_source_subpath()
 
 		""" Set paths """
+		self.set_compression()
+		self.set_hash_cache()
 		self.set_snapshot_path()
 		self.set_root_path()
 		self.set_source_path()
+		self.set_lock_wait()
 		self.set_snapcache_path()
 		self.set_chroot_path()
 		self.set_autoresume_path()
@@ -140,6 +149,7 @@ class generic_stage_target(generic_target):
 		self.set_target_path()
 
 		self.set_controller_file()
+		self.set_action_dependencies()
 		self.set_action_sequence()
 		self.set_use()
 		self.set_cleanables()
@@ -160,6 +170,8 @@ class generic_stage_target(generic_target):
 		self.set_overlay()
 		self.set_portage_overlay()
 		self.set_root_overlay()
+		self.set_digest_jobs()
+		self.set_seed_mode()
 
 		"""
 		This next line checks to make sure that the specified variables exist
@@ -177,7 +189,7 @@ class generic_stage_target(generic_target):
 			self.mounts=["/proc", "/dev", "/usr/portage",
 				"/usr/portage/distfiles", "/var/tmp/portage"]
 			self.mountmap={"/proc":"/proc","/dev":"/dev","/dev/pts":"/dev/pts",\
-				"/usr/portage":self.settings["snapshot_cache_path"]+"/portage",\
+				"/usr/portage":"snapcache",\
 				"/usr/portage/distfiles":self.settings["distdir"],"/var/tmp/portage":"tmpfs",
 				"/dev/shm": "shmfs"}
 		else:
@@ -186,6 +198,12 @@ class generic_stage_target(generic_target):
 			self.mountmap={"/proc":"/proc","/dev":"/dev","/dev/pts":"/dev/pts",\
 				"/usr/portage/distfiles":self.settings["distdir"],"/var/tmp/portage":"tmpfs",
 				"/dev/shm": "shmfs"}
+		if self.snapshot_mountable():
+			""" The squashfs snapshot is mounted rather than unpacked """
+			if "/usr/portage" not in self.mounts:
+				self.mounts.insert(self.mounts.index("/usr/portage/distfiles"),\
+					"/usr/portage")
+			self.mountmap["/usr/portage"]="squashfs"
 		if os.uname()[0] == "Linux":
 			self.mounts.append("/dev/pts")
 			self.mounts.append("/dev/shm")
@@ -300,7 +318,8 @@ class generic_stage_target(generic_target):
 
 	def set_target_path(self):
 		self.settings["target_path"]=normpath(self.settings["storedir"]+\
-			"/builds/"+self.settings["target_subpath"]+".tar.bz2")
+			"/builds/"+self.settings["target_subpath"]+\
+			self.settings["compression_extension"])
 		if "AUTORESUME" in self.settings\
 			and os.path.exists(self.settings["autoresume_path"]+\
 				"setup_target_path"):
@@ -385,22 +404,93 @@ class generic_stage_target(generic_target):
 			self.settings["source_path"]=normpath(self.settings["storedir"]+\
 				"/tmp/"+self.settings["source_subpath"]+"/")
 		else:
-			self.settings["source_path"]=normpath(self.settings["storedir"]+\
-				"/builds/"+self.settings["source_subpath"]+".tar.bz2")
+			self.settings["source_path"]=self.find_tarball(\
+				normpath(self.settings["storedir"]+"/builds/"+\
+				self.settings["source_subpath"]))
 			if os.path.isfile(self.settings["source_path"]):
 				# XXX: Is this even necessary if the previous check passes?
 				if os.path.exists(self.settings["source_path"]):
-					self.settings["source_path_hash"]=\
-						generate_hash(self.settings["source_path"],\
-						hash_function=self.settings["hash_function"],\
-						verbose=False)
+					self.start_path_hash("source_path_hash",\
+						self.settings["source_path"])
 		print "Source path set to "+self.settings["source_path"]
 		if os.path.isdir(self.settings["source_path"]):
 			print "\tIf this is not desired, remove this directory or turn off"
 			print "\tseedcache in the options of catalyst.conf the source path"
 			print "\twill then be "+\
-				normpath(self.settings["storedir"]+"/builds/"+\
-				self.settings["source_subpath"]+".tar.bz2\n")
+				self.find_tarball(normpath(self.settings["storedir"]+\
+				"/builds/"+self.settings["source_subpath"]))+"\n"
+
+	def set_compression(self):
+		"""
+		How tarballs are compressed: compression is a format (bzip2, gzip,
+		xz, zstd) or a tool for one (lbzip2, pigz, pixz...), it decides the
+		extension of target_path. compression_level and compression_threads
+		are passed on to the compressor.
+		"""
+		if "compression" not in self.settings:
+			self.settings["compression"]="bzip2"
+		if compression_format(self.settings["compression"]) == None:
+			raise CatalystError,"Unknown compression "+\
+				self.settings["compression"]+", pick from: "+\
+				string.join(sorted(compression_formats.keys()+\
+				compressor_tools.keys()))
+		for x in ["compression_level","compression_threads"]:
+			if x in self.settings:
+				try:
+					if int(self.settings[x]) < 0:
+						raise ValueError
+				except ValueError:
+					raise CatalystError,x+" must be a number, not "+\
+						str(self.settings[x])
+		if "compression_threads" not in self.settings:
+			self.settings["compression_threads"]=str(cpu_count())
+		self.settings["compression_extension"]=\
+			compression_extension(self.settings["compression"])
+
+	def find_tarball(self,path):
+		"""
+		The tarball path+extension to read, preferring the extension of the
+		configured compression, then any other one that exists.
+		"""
+		mypath=path+self.settings["compression_extension"]
+		if os.path.exists(mypath):
+			return mypath
+		for x in tarball_extensions:
+			if os.path.exists(path+x[0]):
+				return path+x[0]
+		return mypath
+
+	def set_hash_cache(self):
+		""" Digests of seeds and snapshots are cached across runs """
+		self.settings["hash_cache_path"]=normpath(self.settings["storedir"]+\
+			"/hashcache/")
+		self.hash_cache=\
+			catalyst_hashcache.HashCache(self.settings["hash_cache_path"])
+		self.path_hashes={}
+
+	def start_path_hash(self,key,path):
+		"""
+		Schedule the digest of path to be available as get_path_hash(key).
+		Hashing starts in the background right away, so it overlaps with the
+		rest of the setup, unless we are only purging or fetching and are
+		unlikely to look at the digest; it is computed when asked for then.
+		"""
+		if key in self.settings:
+			del self.settings[key]
+		self.path_hashes[key]=catalyst_hashcache.HashJob(self.hash_cache,\
+			path,self.settings["hash_function"])
+		if "PURGEONLY" not in self.settings \
+			and "PURGETMPONLY" not in self.settings \
+			and "FETCH" not in self.settings:
+			self.path_hashes[key].start()
+
+	def get_path_hash(self,key):
+		""" Wait for a digest scheduled by start_path_hash(), None if none was """
+		if key not in self.path_hashes:
+			return None
+		if key not in self.settings:
+			self.settings[key]=self.path_hashes[key].result()
+		return self.settings[key]
 
 	def set_dest_path(self):
 		if "root_path" in self.settings:
@@ -414,21 +504,83 @@ class generic_stage_target(generic_target):
 			"/root/*","/usr/portage"]
 
 	def set_snapshot_path(self):
-		self.settings["snapshot_path"]=normpath(self.settings["storedir"]+\
-			"/snapshots/portage-"+self.settings["snapshot"]+".tar.xz")
+		"""
+		A squashfs snapshot is preferred when this host can mount it, it
+		does not need unpacking at all. Otherwise it is only used when there
+		is no snapshot tarball, and unpacked like one.
+		"""
+		mypath=normpath(self.settings["storedir"]+"/snapshots/portage-"+\
+			self.settings["snapshot"])
+		self.settings["snapshot_path"]=self.find_tarball(mypath)
+		if os.path.exists(mypath+".squashfs") and (squashfs_mount_supported() \
+			or not os.path.exists(self.settings["snapshot_path"])):
+			self.settings["snapshot_path"]=mypath+".squashfs"
+		else:
+			self.set_snapshot_delta(mypath)
 
 		if os.path.exists(self.settings["snapshot_path"]):
-			self.settings["snapshot_path_hash"]=\
-				generate_hash(self.settings["snapshot_path"],\
-				hash_function=self.settings["hash_function"],verbose=False)
-		else:
-			self.settings["snapshot_path"]=normpath(self.settings["storedir"]+\
-				"/snapshots/portage-"+self.settings["snapshot"]+".tar.bz2")
+			self.start_path_hash("snapshot_path_hash",\
+				self.settings["snapshot_path"])
+
+	def set_snapshot_delta(self,mypath):
+		"""
+		Use a delta of the snapshot rather than the snapshot itself when
+		the base of the delta is in the snapshot cache, or when there is no
+		full snapshot at all but the base one is there.
+		"""
+		if os.path.exists(self.settings["snapshot_path"]) \
+			and "SNAPCACHE" not in self.settings:
+			return
+		mymanifests=glob.glob(mypath+".delta-*.manifest")
+		mymanifests.sort()
+		for x in mymanifests:
+			myarchive=self.find_tarball(x[:-len(".manifest")])
+			if not os.path.exists(myarchive):
+				continue
+			mybase=self.snapshot_delta_base(read_delta_manifest(x))
+			if mybase == None:
+				continue
+			if os.path.exists(self.settings["snapshot_path"]) \
+				and not os.path.isdir(mybase):
+				continue
+			if not os.path.isdir(mybase):
+				""" Checked against the manifest when it is unpacked """
+				self.start_path_hash("snapshot_delta_base_hash",mybase)
+			print "Using snapshot delta "+myarchive+" on top of "+mybase
+			self.settings["snapshot_path"]=myarchive
+			self.settings["snapshot_delta_manifest"]=x
+			return
 
-			if os.path.exists(self.settings["snapshot_path"]):
-				self.settings["snapshot_path_hash"]=\
-					generate_hash(self.settings["snapshot_path"],\
-					hash_function=self.settings["hash_function"],verbose=False)
+	def snapshot_delta_base(self,mymanifest):
+		"""
+		The base of a delta: its directory in the snapshot cache if it is
+		there, its tarball otherwise, None if the base is nowhere to be found.
+		The digest of the tarball is checked by check_snapshot_delta_base().
+		"""
+		mybase,myhash,mydigest=mymanifest["base"]
+		if myhash != self.settings["hash_function"]:
+			return None
+		if "SNAPCACHE" in self.settings:
+			mycached=normpath(self.settings["snapshot_cache"]+"/"+mybase+\
+				"/"+mydigest+"/")
+			if os.path.isdir(mycached):
+				return mycached
+		mytarball=self.find_tarball(normpath(self.settings["storedir"]+\
+			"/snapshots/portage-"+mybase))
+		if os.path.exists(mytarball):
+			return mytarball
+		return None
+
+	def check_snapshot_delta_base(self,mymanifest,mytarball):
+		""" Raise unless mytarball is the base the delta was made against """
+		if self.path_hashes.get("snapshot_delta_base_hash") == None or \
+			self.path_hashes["snapshot_delta_base_hash"].path != mytarball:
+			self.start_path_hash("snapshot_delta_base_hash",mytarball)
+		if digest_id(self.get_path_hash("snapshot_delta_base_hash")) != \
+			mymanifest["base"][2]:
+			raise CatalystError,"The base snapshot "+mytarball+" of "+\
+				self.settings["snapshot_path"]+" is not the one the delta "+\
+				"was made against"
 
 	def set_snapcache_path(self):
 		if "SNAPCACHE" in self.settings:
@@ -439,6 +591,36 @@ class generic_stage_target(generic_target):
 				catalyst_lock.LockDir(self.settings["snapshot_cache_path"])
 			print "Caching snapshot to "+self.settings["snapshot_cache_path"]
 
+	def set_lock_wait(self):
+		"""
+		How long to wait for locks other builds hold before giving up, by
+		default a build fails at once
+		"""
+		if "lock_wait" in self.settings:
+			try:
+				catalyst_lock.LockDir.lock_wait=float(self.settings["lock_wait"])
+			except ValueError:
+				raise CatalystError,"lock_wait must be a number of seconds"
+
+	def record_lock_wait(self,name,mylock):
+		"""
+		Log how long the build waited for name to storedir/lock-wait.log,
+		as "time target_subpath name seconds" lines appended in one write
+		"""
+		if mylock.waited >= 1:
+			print "Waited %.1f seconds for the %s" % (mylock.waited,name)
+		line="%d %s %s %.3f\n" % (int(time.time()),\
+			self.settings["target_subpath"],name.replace(" ","_"),mylock.waited)
+		try:
+			myfd=os.open(normpath(self.settings["storedir"]+"/lock-wait.log"),\
+				os.O_WRONLY|os.O_APPEND|os.O_CREAT,0644)
+			try:
+				os.write(myfd,line)
+			finally:
+				os.close(myfd)
+		except OSError, e:
+			warn("Couldn't log the wait for the "+name+": "+str(e))
+
 	def set_chroot_path(self):
 		"""
 		NOTE: the trailing slash is very important!
@@ -473,6 +655,24 @@ class generic_stage_target(generic_target):
 		else:
 			self.settings["iso_volume_id"]="catalyst "+self.settings["snapshot"]
 
+	def set_action_dependencies(self):
+		"""
+		The steps of action_sequence that need only some of the steps before
+		them, and the steps they need. Other steps need every step before
+		them. Steps whose needs are met run at the same time, see
+		catalyst_actions. Targets add their own steps, or steps these need,
+		in set_action_sequence.
+		"""
+		self.action_dependencies={
+			"config_profile_link":["unpack"],
+			# A portage_confdir may bring its own make.profile
+			"setup_confdir":["unpack","config_profile_link"],
+			"portage_overlay":["unpack"],
+			}
+		if "SNAPCACHE" in self.settings:
+			""" The snapshot is unpacked to the cache, not into the chroot """
+			self.action_dependencies["unpack_snapshot"]=[]
+
 	def set_action_sequence(self):
 		""" Default action sequence for run method """
 		self.settings["action_sequence"]=["unpack","unpack_snapshot",\
@@ -555,6 +755,30 @@ class generic_stage_target(generic_target):
 					self.settings[self.settings["spec_prefix"]+\
 					"/root_overlay"].split()
 
+	def set_digest_jobs(self):
+		""" How many files gen_contents_file/gen_digest_file may run on at once """
+		if "digest_jobs" in self.settings:
+			try:
+				if int(self.settings["digest_jobs"]) < 1:
+					raise ValueError
+			except ValueError:
+				raise CatalystError,"digest_jobs must be a positive number, not "+\
+					str(self.settings["digest_jobs"])
+		else:
+			self.settings["digest_jobs"]=str(cpu_count())
+
+	def set_seed_mode(self):
+		"""
+		How unpack turns the seed into the chroot: copy it (rsync or tar),
+		clone it with reflinks, mount it as the lower layer of an overlayfs,
+		or auto to pick the fastest of those that works here.
+		"""
+		if "seed_mode" not in self.settings:
+			self.settings["seed_mode"]="copy"
+		if self.settings["seed_mode"] not in ["copy","overlay","reflink","auto"]:
+			raise CatalystError,"seed_mode must be one of copy, overlay, "+\
+				"reflink or auto, not "+str(self.settings["seed_mode"])
+
 	def set_root_path(self):
 		""" ROOT= variable for emerges """
 		self.settings["root_path"]="/"
@@ -594,17 +818,15 @@ class generic_stage_target(generic_target):
 
 	def kill_chroot_pids(self):
 		print "Checking for processes running in chroot and killing them."
-
-		"""
-		Force environment variables to be exported so script can see them
-		"""
-		self.setup_environment()
-
-		if os.path.exists(self.settings["sharedir"]+\
-			"/targets/support/kill-chroot-pids.sh"):
-			cmd("/bin/bash "+self.settings["sharedir"]+\
-				"/targets/support/kill-chroot-pids.sh",\
-				"kill-chroot-pids script failed.",env=self.env)
+		if not os.path.exists(self.settings["chroot_path"]):
+			return
+		mytimeout=10
+		if "kill_timeout" in self.settings:
+			try:
+				mytimeout=float(self.settings["kill_timeout"])
+			except ValueError:
+				raise CatalystError,"kill_timeout must be a number of seconds"
+		kill_chroot_processes(self.settings["chroot_path"],mytimeout)
 
 	def mount_safety_check(self):
 		mypath=self.settings["chroot_path"]
@@ -635,6 +857,16 @@ class generic_stage_target(generic_target):
 				except CatalystError:
 					raise CatalystError, "Unable to auto-unbind "+x
 
+		""" Mounts we did not make, left over from an earlier build """
+		if mounts_under(mypath):
+			print "Something is still mounted in "+mypath+\
+				"; performing auto-bind-umount...",
+			self.unbind()
+			if mounts_under(mypath):
+				raise CatalystError, "Unable to auto-unbind "+\
+					string.join(mounts_under(mypath))
+			print "Auto-unbind successful..."
+
 	def unpack(self):
 		unpack=True
 
@@ -659,12 +891,8 @@ class generic_stage_target(generic_target):
 					self.settings["source_path"]+"\nto "+\
 					self.settings["chroot_path"]+\
 						" (This may take some time) ...\n"
-				if "bz2" == self.settings["chroot_path"][-3:]:
-					unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["source_path"]+" -C "+\
-						self.settings["chroot_path"]
-				else:
-					unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["source_path"]+" -C "+\
-						self.settings["chroot_path"]
+				unpack_cmd=unpack_command(self.settings["source_path"],\
+					self.settings["chroot_path"],tar_xattr_args)
 				error_msg="Tarball extraction of "+\
 					self.settings["source_path"]+" to "+\
 					self.settings["chroot_path"]+" failed."
@@ -674,12 +902,8 @@ class generic_stage_target(generic_target):
 				self.settings["source_path"]+"\nto "+\
 				self.settings["chroot_path"]+\
 				" (This may take some time) ...\n"
-			if "bz2" == self.settings["chroot_path"][-3:]:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["source_path"]+" -C "+\
-					self.settings["chroot_path"]
-			else:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["source_path"]+" -C "+\
-					self.settings["chroot_path"]
+			unpack_cmd=unpack_command(self.settings["source_path"],\
+				self.settings["chroot_path"],tar_xattr_args)
 			error_msg="Tarball extraction of "+self.settings["source_path"]+\
 				" to "+self.settings["chroot_path"]+" failed."
 
@@ -691,7 +915,7 @@ class generic_stage_target(generic_target):
 				invalid_snapshot=False
 
 			elif os.path.isfile(self.settings["source_path"]) \
-				and self.settings["source_path_hash"]==clst_unpack_hash:
+				and self.get_path_hash("source_path_hash")==clst_unpack_hash:
 				""" Autoresume is valid, tarball is valid """
 				unpack=False
 				invalid_snapshot=True
@@ -704,7 +928,7 @@ class generic_stage_target(generic_target):
 				invalid_snapshot=False
 
 			elif os.path.isfile(self.settings["source_path"]) \
-				and self.settings["source_path_hash"]!=clst_unpack_hash:
+				and self.get_path_hash("source_path_hash")!=clst_unpack_hash:
 				""" Autoresume is invalid, tarball """
 				unpack=True
 				invalid_snapshot=True
@@ -755,67 +979,163 @@ class generic_stage_target(generic_target):
 					os.makedirs(self.settings["kerncache_path"],0755)
 
 			print display_msg
-			cmd(unpack_cmd,error_msg,env=self.env)
+			mymode=self.seed_instantiation()
+			if mymode == "copy":
+				""" The seed directory may be an overlay chroot itself """
+				if os.path.isdir(self.settings["source_path"]):
+					mount_overlay_chroot(self.settings["source_path"])
+				self.run_unpack(self.settings["source_path"],\
+					self.settings["chroot_path"],unpack_cmd,error_msg)
+			else:
+				self.instantiate_seed(mymode)
 
-			if "source_path_hash" in self.settings:
+			if self.get_path_hash("source_path_hash"):
 				myf=open(self.settings["autoresume_path"]+"unpack","w")
-				myf.write(self.settings["source_path_hash"])
+				myf.write(self.get_path_hash("source_path_hash"))
 				myf.close()
 			else:
 				touch(self.settings["autoresume_path"]+"unpack")
 		else:
+			mount_overlay_chroot(self.settings["chroot_path"])
 			print "Resume point detected, skipping unpack operation..."
 
+	def seed_directory(self):
+		"""
+		The directory holding the seed: the seed cache directory, or where
+		the seed tarball is unpacked once to be shared by all the chroots
+		instantiated from it.
+		"""
+		if os.path.isdir(self.settings["source_path"]):
+			return self.settings["source_path"]
+		return normpath(self.settings["storedir"]+"/tmp/seeds/"+\
+			os.path.basename(self.settings["source_path"])+"-"+\
+			digest_id(self.get_path_hash("source_path_hash"))+"/")
+
+	def seed_instantiation(self):
+		"""Which seed_mode to use for this chroot, resolving auto"""
+		mymode=self.settings["seed_mode"]
+		if mymode == "copy":
+			return mymode
+		myseed=self.seed_directory()
+		if mymode in ["reflink","auto"] \
+			and len(overlay_layers(myseed)) == 1 \
+			and reflink_supported(os.path.dirname(myseed.rstrip("/")),\
+				os.path.dirname(self.settings["chroot_path"].rstrip("/"))):
+			return "reflink"
+		if mymode == "reflink":
+			warn("Can't clone "+myseed+" with reflinks, copying it instead")
+			return "copy"
+		if overlay_supported():
+			return "overlay"
+		if mymode == "overlay":
+			raise CatalystError,"seed_mode is overlay but this kernel has "+\
+				"no overlayfs"
+		return "copy"
+
+	def instantiate_seed(self,mymode):
+		"""
+		Make the chroot a copy-on-write view or clone of the seed. Seeds
+		unpacked to the seeds directory are read locked until the chroot is
+		cloned, or recorded as a user of them, so that the cache GC leaves
+		them alone.
+		"""
+		myseed=self.seed_directory()
+		mylocks=[]
+		try:
+			for x in overlay_layers(myseed):
+				if os.path.dirname(normpath(x).rstrip("/")) == \
+					catalyst_cachegc.seeds_dir(self.settings):
+					mylock=catalyst_lock.LockDir(\
+						catalyst_cachegc.inuse_lockdir(x))
+					""" Others only hold it to remove the seed """
+					mylock.read_lock(max(catalyst_lock.LockDir.lock_wait,60))
+					self.record_lock_wait("seed lock",mylock)
+					mylocks.append([x,mylock])
+
+			if os.path.isfile(self.settings["source_path"]):
+				myhit=os.path.isdir(myseed)
+				if not myhit:
+					print "Unpacking seed to "+myseed+" for reuse..."
+					""" A dot name, which the cache GC does not look at """
+					mytmp=normpath(os.path.dirname(myseed.rstrip("/"))+\
+						"/."+os.path.basename(myseed.rstrip("/"))+".tmp-"+\
+						str(os.getpid()))
+					if os.path.exists(mytmp):
+						shutil.rmtree(mytmp)
+					os.makedirs(mytmp,0755)
+					self.run_unpack(self.settings["source_path"],mytmp,\
+						unpack_command(self.settings["source_path"],mytmp,\
+						tar_xattr_args),"Couldn't unpack the seed to "+mytmp)
+					os.rename(mytmp,myseed.rstrip("/"))
+				catalyst_cachegc.record_cache_use(self.settings,"seeds",\
+					myseed,myhit)
+
+			self.clear_chroot()
+			if mymode == "reflink":
+				print "Cloning "+myseed+" to "+self.settings["chroot_path"]+\
+					" with reflinks..."
+				cmd("cp -a --reflink=always "+myseed+"/. "+\
+					self.settings["chroot_path"],"Couldn't clone "+myseed+\
+					" to "+self.settings["chroot_path"],env=self.env)
+			else:
+				print "Mounting "+myseed+" as the lower layer of "+\
+					self.settings["chroot_path"]+"..."
+				for x,mylock in mylocks:
+					catalyst_cachegc.add_seed_user(x,\
+						self.settings["chroot_path"])
+				create_overlay_chroot(self.settings["chroot_path"],myseed)
+		finally:
+			for x,mylock in mylocks:
+				mylock.unlock()
+
+	def run_unpack(self,file,destdir,unpack_cmd,error_msg):
+		""" Seekable archives are extracted by catalyst, many frames at once """
+		if os.path.isfile(file) and is_seekable(file):
+			extract_seekable(file,destdir,tar_xattr_args,\
+				int(self.settings["compression_threads"]),error_msg)
+		else:
+			cmd(unpack_cmd,error_msg,env=self.env)
+
+	def snapshot_unpack_command(self,destdir):
+		"""
+		Snapshot tarballs hold a portage/ directory to extract in destdir,
+		squashfs snapshots are the contents of that directory.
+		"""
+		if sniff_format(self.settings["snapshot_path"]) == "squashfs":
+			destdir=normpath(destdir+"/portage")
+		return unpack_command(self.settings["snapshot_path"],destdir,\
+			tar_xattr_args)
+
 	def unpack_snapshot(self):
 		unpack=True
 		snapshot_hash=read_from_clst(self.settings["autoresume_path"]+\
 			"unpack_portage")
 
+		if self.mountmap.get("/usr/portage") == "squashfs":
+			print "Mounting squashfs snapshot, skipping unpack of portage tree..."
+			return
+
 		if "SNAPCACHE" in self.settings:
-			snapshot_cache_hash=\
-				read_from_clst(self.settings["snapshot_cache_path"]+\
-				"catalyst-hash")
-			destdir=self.settings["snapshot_cache_path"]
-			if "bz2" == self.settings["chroot_path"][-3:]:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["snapshot_path"]+" -C "+destdir
-			else:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -xpf "+self.settings["snapshot_path"]+" -C "+destdir
-			unpack_errmsg="Error unpacking snapshot"
-			cleanup_msg="Cleaning up invalid snapshot cache at \n\t"+\
-				self.settings["snapshot_cache_path"]+\
-				" (This can take a long time)..."
-			cleanup_errmsg="Error removing existing snapshot cache directory."
-			self.snapshot_lock_object=self.snapcache_lock
-
-			if self.settings["snapshot_path_hash"]==snapshot_cache_hash:
-				print "Valid snapshot cache, skipping unpack of portage tree..."
+			self.unpack_snapshot_cache()
+			return
+
+		destdir=normpath(self.settings["chroot_path"]+"/usr/portage")
+		cleanup_errmsg="Error removing existing snapshot directory."
+		cleanup_msg=\
+			"Cleaning up existing portage tree (This can take a long time)..."
+		unpack_dir=normpath(self.settings["chroot_path"]+"/usr")
+
+		if "AUTORESUME" in self.settings \
+			and os.path.exists(self.settings["chroot_path"]+\
+				"/usr/portage/") \
+			and os.path.exists(self.settings["autoresume_path"]\
+				+"unpack_portage") \
+			and self.get_path_hash("snapshot_path_hash") == snapshot_hash:
+				print \
+					"Valid Resume point detected, skipping unpack of portage tree..."
 				unpack=False
-		else:
-			destdir=normpath(self.settings["chroot_path"]+"/usr/portage")
-			cleanup_errmsg="Error removing existing snapshot directory."
-			cleanup_msg=\
-				"Cleaning up existing portage tree (This can take a long time)..."
-			if "bz2" == self.settings["chroot_path"][-3:]:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -xpf "+self.settings["snapshot_path"]+" -C "+\
-					self.settings["chroot_path"]+"/usr"
-			else:
-				unpack_cmd="tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -xpf "+self.settings["snapshot_path"]+" -C "+\
-					self.settings["chroot_path"]+"/usr"
-			unpack_errmsg="Error unpacking snapshot"
-
-			if "AUTORESUME" in self.settings \
-				and os.path.exists(self.settings["chroot_path"]+\
-					"/usr/portage/") \
-				and os.path.exists(self.settings["autoresume_path"]\
-					+"unpack_portage") \
-				and self.settings["snapshot_path_hash"] == snapshot_hash:
-					print \
-						"Valid Resume point detected, skipping unpack of portage tree..."
-					unpack=False
 
 		if unpack:
-			if "SNAPCACHE" in self.settings:
-				self.snapshot_lock_object.write_lock()
 			if os.path.exists(destdir):
 				print cleanup_msg
 				cleanup_cmd="rm -rf "+destdir
@@ -824,20 +1144,233 @@ class generic_stage_target(generic_target):
 				os.makedirs(destdir,0755)
 
 			print "Unpacking portage tree (This can take a long time) ..."
-			cmd(unpack_cmd,unpack_errmsg,env=self.env)
+			self.unpack_snapshot_tree(unpack_dir)
 
-			if "SNAPCACHE" in self.settings:
-				myf=open(self.settings["snapshot_cache_path"]+"catalyst-hash","w")
-				myf.write(self.settings["snapshot_path_hash"])
-				myf.close()
+			print "Setting snapshot autoresume point"
+			myf=open(self.settings["autoresume_path"]+"unpack_portage","w")
+			myf.write(self.get_path_hash("snapshot_path_hash"))
+			myf.close()
+
+	def unpack_snapshot_tree(self,destdir):
+		"""
+		Unpack the snapshot into destdir, or its delta on top of the base
+		snapshot. A base from the snapshot cache is copied with hard links,
+		the delta replaces files rather than writing to them.
+		"""
+		if "snapshot_delta_manifest" not in self.settings:
+			self.run_unpack(self.settings["snapshot_path"],destdir,\
+				self.snapshot_unpack_command(destdir),"Error unpacking snapshot")
+			return
+
+		mymanifest=read_delta_manifest(self.settings["snapshot_delta_manifest"])
+		mybase=self.snapshot_delta_base(mymanifest)
+		if mybase == None:
+			raise CatalystError,"The base snapshot "+mymanifest["base"][0]+\
+				" of "+self.settings["snapshot_path"]+" is gone"
+		if os.path.isdir(mybase):
+			print "Copying cached base snapshot "+mymanifest["base"][0]+"..."
+			if not os.path.exists(destdir+"/portage"):
+				os.makedirs(destdir+"/portage",0755)
+			if os.system("cp -al "+mybase+"/portage/. "+destdir+"/portage/") != 0:
+				"""
+				Not on the same filesystem. Start over, cp -a would write
+				to the files already linked to the cache.
+				"""
+				shutil.rmtree(destdir+"/portage")
+				os.makedirs(destdir+"/portage",0755)
+				cmd("cp -a "+mybase+"/portage/. "+destdir+"/portage/",\
+					"Error copying base snapshot "+mybase,env=self.env)
+		else:
+			self.check_snapshot_delta_base(mymanifest,mybase)
+			self.run_unpack(mybase,destdir,unpack_command(mybase,destdir,\
+				tar_xattr_args),"Error unpacking base snapshot "+mybase)
+
+		print "Applying snapshot delta "+self.settings["snapshot_path"]+"..."
+		remove_delta_paths(mymanifest,destdir)
+		self.run_unpack(self.settings["snapshot_path"],destdir,\
+			unpack_command(self.settings["snapshot_path"],destdir,\
+			tar_xattr_args),"Error applying snapshot delta")
+
+	def snapshot_cache_entry(self):
+		""" The directory the snapshot with the current digest is cached in """
+		return normpath(self.settings["snapshot_cache_path"]+"/"+\
+			digest_id(self.get_path_hash("snapshot_path_hash"))+"/")
+
+	def lock_snapshot_cache_entry(self):
+		"""
+		Read lock the snapshot cache entry of our digest until unbind, from
+		before it is looked up or published, so that neither pruning nor
+		the cache GC remove it under us
+		"""
+		if getattr(self,"snapshot_lock_object",None) == None:
+			self.snapshot_lock_object=catalyst_lock.LockDir(\
+				catalyst_cachegc.inuse_lockdir(\
+				self.snapshot_cache_entry()))
+		if not self.snapshot_lock_object.islocked():
+			""" Others only hold it to rename the entry away """
+			self.snapshot_lock_object.read_lock(\
+				max(catalyst_lock.LockDir.lock_wait,60))
+			self.record_lock_wait("snapshot cache lock",\
+				self.snapshot_lock_object)
+
+	def unpack_snapshot_cache(self):
+		"""
+		Every snapshot digest gets its own directory in the snapshot cache,
+		which is never modified once it has been published with a rename.
+		Builds still using an older one are not disturbed by a new snapshot,
+		and nobody has to wait for anybody else's unpack.
+		"""
+		self.lock_snapshot_cache_entry()
+		myentry=self.snapshot_cache_entry()
+		catalyst_cachegc.record_cache_use(self.settings,"snapshot_cache",\
+			myentry,os.path.isdir(myentry))
+		if os.path.isdir(myentry):
+			print "Valid snapshot cache, skipping unpack of portage tree..."
+		else:
+			mytmp=normpath(self.settings["snapshot_cache_path"]+"/.tmp-"+\
+				os.path.basename(myentry.rstrip("/"))+"-"+str(os.getpid()))
+			if os.path.exists(mytmp):
+				shutil.rmtree(mytmp)
+			os.makedirs(mytmp,0755)
+			print "Unpacking portage tree to "+myentry+\
+				" (This can take a long time) ..."
+			self.unpack_snapshot_tree(mytmp)
+			try:
+				os.rename(mytmp,myentry.rstrip("/"))
+			except OSError:
+				if not os.path.isdir(myentry):
+					raise
+				""" Another catalyst published the same snapshot first """
+				shutil.rmtree(mytmp)
+		self.prune_snapshot_cache(myentry)
+
+	def prune_snapshot_cache(self,myentry):
+		"""
+		Remove the other snapshots of the cache directory, unless a build
+		holds the lock of one of them. They are only renamed while we hold
+		their lock, and deleted after it is released. The lock of the cache
+		directory keeps two builds from pruning at once.
+		"""
+		try:
+			self.snapcache_lock.write_lock(0)
+		except LockInUse:
+			return
+		mystale=[]
+		try:
+			for x in os.listdir(self.settings["snapshot_cache_path"]):
+				if x == os.path.basename(myentry.rstrip("/")) \
+					or x.startswith(".catalyst"):
+					continue
+				if x.startswith(".tmp-") and \
+					x.split("-")[-1].isdigit() and \
+					pid_exists(int(x.split("-")[-1])):
+					""" Somebody is unpacking it right now """
+					continue
+				mypath=normpath(self.settings["snapshot_cache_path"]+"/"+x)
+				if not x.startswith(".old-"):
+					if not self.rename_snapshot_cache_entry(mypath,\
+						normpath(self.settings["snapshot_cache_path"]+\
+						"/.old-"+x+"-"+str(os.getpid()))):
+						continue
+					mypath=normpath(self.settings["snapshot_cache_path"]+\
+						"/.old-"+x+"-"+str(os.getpid()))
+				mystale.append(mypath)
+		finally:
+			self.snapcache_lock.unlock()
+		for x in mystale:
+			print "Removing old snapshot cache "+x
+			if os.path.isdir(x):
+				shutil.rmtree(x)
 			else:
-				print "Setting snapshot autoresume point"
-				myf=open(self.settings["autoresume_path"]+"unpack_portage","w")
-				myf.write(self.settings["snapshot_path_hash"])
-				myf.close()
+				os.unlink(x)
 
-			if "SNAPCACHE" in self.settings:
-				self.snapshot_lock_object.unlock()
+	def rename_snapshot_cache_entry(self,mypath,mynewpath):
+		""" False if a build is using the entry, or it is gone already """
+		mylock=catalyst_lock.LockDir(\
+			catalyst_cachegc.inuse_lockdir(mypath))
+		try:
+			mylock.write_lock(0)
+		except LockInUse:
+			return False
+		try:
+			try:
+				os.rename(mypath,mynewpath)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+				mynewpath=None
+			""" Nothing is left for it to guard """
+			mylock.remove()
+		finally:
+			if mylock.islocked():
+				mylock.unlock()
+		return mynewpath != None
+
+	def snapshot_overlay_dirs(self):
+		""" The upper and work dirs of this build's /usr/portage overlay """
+		mybase=normpath(self.settings["storedir"]+"/tmp/"+\
+			self.settings["target_subpath"]).rstrip("/")+".portage"
+		return (mybase+".upper",mybase+".work")
+
+	def snapshot_overlay_commands(self,src,target):
+		"""
+		Mount the shared snapshot cache at target with an overlay, so that
+		whatever the build writes to /usr/portage stays out of the cache.
+		"""
+		for x in self.snapshot_overlay_dirs():
+			if os.path.exists(x) and not ismount(x):
+				shutil.rmtree(x)
+			os.makedirs(x,0755)
+		myupper,mywork=self.snapshot_overlay_dirs()
+		return ["mount -t overlay overlay -o lowerdir="+src+\
+			",upperdir="+myupper+",workdir="+mywork+" "+target]
+
+	def snapshot_mountable(self):
+		""" Is the snapshot a squashfs image this host can mount """
+		return os.path.exists(self.settings["snapshot_path"]) \
+			and sniff_format(self.settings["snapshot_path"]) == "squashfs" \
+			and squashfs_mount_supported()
+
+	def snapshot_squashfs_dirs(self):
+		"""
+		Where this build mounts the squashfs snapshot, and the tmpfs holding
+		the upper and work dirs of the overlay on top of it
+		"""
+		mybase=normpath(self.settings["storedir"]+"/tmp/"+\
+			self.settings["target_subpath"]).rstrip("/")+".portage"
+		return (mybase+".squashfs",mybase+".rw")
+
+	def snapshot_squashfs_commands(self,target):
+		"""
+		Loop-mount the squashfs snapshot read-only and put a tmpfs overlay
+		on top of it at target, for the metadata and whatever else the
+		build writes to /usr/portage. Mounts made in a namespace are gone
+		after every step, the upper dir is then kept on disk instead.
+		"""
+		mysquashfs,myrw=self.snapshot_squashfs_dirs()
+		for x in [mysquashfs,myrw]:
+			if not os.path.exists(x):
+				os.makedirs(x,0755)
+		mycommands=[]
+		if "NAMESPACES" in self.settings or not ismount(mysquashfs):
+			mycommands.append("mount -t squashfs -o loop,ro "+\
+				self.settings["snapshot_path"]+" "+mysquashfs)
+		if "NAMESPACES" not in self.settings and not ismount(myrw):
+			mycommands.append("mount -t tmpfs -o mode=0755 tmpfs "+myrw)
+		mycommands.append("mkdir -p "+myrw+"/upper "+myrw+"/work")
+		mycommands.append("mount -t overlay overlay -o lowerdir="+mysquashfs+\
+			",upperdir="+myrw+"/upper,workdir="+myrw+"/work "+target)
+		return mycommands
+
+	def umount_snapshot_squashfs(self):
+		""" Unmount what snapshot_squashfs_commands() mounted besides target """
+		ouch=0
+		for x in self.snapshot_squashfs_dirs():
+			if os.path.exists(x) and ismount(x):
+				if os.system("umount "+x) != 0:
+					ouch=1
+					warn("Couldn't umount "+x)
+		return ouch
 
 	def config_profile_link(self):
 		if "AUTORESUME" in self.settings \
@@ -849,13 +1382,12 @@ class generic_stage_target(generic_target):
 			# TODO: zmedico and I discussed making this a directory and pushing
 			# in a parent file, as well as other user-specified configuration.
 			print "Configuring profile link..."
-			cmd("rm -f "+self.settings["chroot_path"]+"/etc/portage/make.profile",\
-					"Error zapping profile link",env=self.env)
-			cmd("mkdir -p "+self.settings["chroot_path"]+"/etc/portage/")
-			cmd("ln -sf ../../usr/portage/profiles/"+\
-				self.settings["target_profile"]+" "+\
+			catalyst_fileops.makedirs(self.settings["chroot_path"]+\
+				"/etc/portage/")
+			catalyst_fileops.symlink("../../usr/portage/profiles/"+\
+				self.settings["target_profile"],\
 				self.settings["chroot_path"]+"/etc/portage/make.profile",\
-				"Error creating profile link",env=self.env)
+				"Error creating profile link")
 			touch(self.settings["autoresume_path"]+"config_profile_link")
 
 	def setup_confdir(self):
@@ -877,12 +1409,12 @@ class generic_stage_target(generic_target):
 			for x in self.settings["portage_overlay"]:
 				if os.path.exists(x):
 					print "Copying overlay dir " +x
-					cmd("mkdir -p "+self.settings["chroot_path"]+\
-						"/usr/local/portage",\
-						"Could not make portage_overlay dir",env=self.env)
-					cmd("cp -R "+x+"/* "+self.settings["chroot_path"]+\
-						"/usr/local/portage",\
-						"Could not copy portage_overlay",env=self.env)
+					catalyst_fileops.makedirs(self.settings["chroot_path"]+\
+						"/usr/local/portage",0755,\
+						"Could not make portage_overlay dir")
+					catalyst_fileops.copy_contents(x,\
+						self.settings["chroot_path"]+"/usr/local/portage",\
+						"Could not copy portage_overlay")
 
 	def root_overlay(self):
 		""" Copy over the root_overlay """
@@ -899,44 +1431,142 @@ class generic_stage_target(generic_target):
 	def base_dirs(self):
 		pass
 
+	def mount_source(self,x):
+		"""
+		mountmap[x], with snapcache resolved to the snapshot cache entry of
+		the snapshot's digest, which is only known once it is hashed
+		"""
+		if self.mountmap[x] == "snapcache":
+			return normpath(self.snapshot_cache_entry()+"/portage").rstrip("/")
+		return self.mountmap[x]
+
+	def mount_commands(self,x):
+		""" The commands mounting mountmap[x] at x in the chroot """
+		src=self.mount_source(x)
+		mytarget=self.settings["chroot_path"]+x
+		if os.uname()[0] == "FreeBSD":
+			if src == "/dev":
+				return ["mount -t devfs none "+mytarget]
+			return ["mount_nullfs "+src+" "+mytarget]
+		if src == "tmpfs":
+			if "var_tmpfs_portage" in self.settings:
+				return ["mount -t tmpfs -o size="+\
+					self.settings["var_tmpfs_portage"]+"G "+src+" "+mytarget]
+			return []
+		if src == "shmfs":
+			return ["mount -t tmpfs -o noexec,nosuid,nodev shm "+mytarget]
+		if src == "squashfs":
+			return self.snapshot_squashfs_commands(mytarget)
+		if "SNAPCACHE" in self.settings and x == "/usr/portage" \
+			and overlay_supported():
+			return self.snapshot_overlay_commands(src,mytarget)
+		if "NAMESPACES" in self.settings and src == "/proc":
+			""" The proc of the new PID namespace, showing only its processes """
+			return ["mount -t proc proc "+mytarget]
+		return ["mount --bind "+src+" "+mytarget]
+
 	def bind(self):
+		mynamespace_mounts=[]
 		for x in self.mounts:
 			if not os.path.exists(self.settings["chroot_path"]+x):
 				os.makedirs(self.settings["chroot_path"]+x,0755)
 
 			if not os.path.exists(self.mountmap[x]):
-				if self.mountmap[x] != "tmpfs" and self.mountmap[x] != "shmfs":
+				if self.mountmap[x] not in ["tmpfs","shmfs","squashfs",\
+					"snapcache"]:
 					os.makedirs(self.mountmap[x],0755)
 
-			src=self.mountmap[x]
-			if "SNAPCACHE" in self.settings and x == "/usr/portage":
-				self.snapshot_lock_object.read_lock()
-			if os.uname()[0] == "FreeBSD":
-				if src == "/dev":
-					retval=os.system("mount -t devfs none "+\
-						self.settings["chroot_path"]+x)
-				else:
-					retval=os.system("mount_nullfs "+src+" "+\
-						self.settings["chroot_path"]+x)
-			else:
-				if src == "tmpfs":
-					if "var_tmpfs_portage" in self.settings:
-						retval=os.system("mount -t tmpfs -o size="+\
-							self.settings["var_tmpfs_portage"]+"G "+src+" "+\
-							self.settings["chroot_path"]+x)
-				elif src == "shmfs":
-					retval=os.system("mount -t tmpfs -o noexec,nosuid,nodev shm "+\
-						self.settings["chroot_path"]+x)
-				else:
-					retval=os.system("mount --bind "+src+" "+\
-						self.settings["chroot_path"]+x)
+			src=self.mount_source(x)
+			if src != self.mountmap[x]:
+				self.lock_snapshot_cache_entry()
+			if "NAMESPACES" in self.settings:
+				mynamespace_mounts.extend(self.mount_commands(x))
+				continue
+			retval=0
+			for mycommand in self.mount_commands(x):
+				retval=os.system(mycommand)
+				if retval != 0:
+					break
 			if retval!=0:
 				self.unbind()
 				raise CatalystError,"Couldn't bind mount "+src
+		if "NAMESPACES" in self.settings:
+			self.namespace_controller(mynamespace_mounts)
+
+	def namespace_controller(self,mounts):
+		"""
+		Run controller steps in new mount, PID and IPC namespaces, where a
+		wrapper makes the mounts before it runs the controller. The mounts
+		and whatever the step leaves running go away with the namespace
+		when the step ends, the host never sees them.
+		"""
+		if os.uname()[0] != "Linux" or not find_binary("unshare"):
+			raise CatalystError,\
+				"The namespaces option needs Linux and unshare(1)"
+		if "host_controller_file" not in self.settings:
+			self.settings["host_controller_file"]=\
+				self.settings["controller_file"]
+		mywrapper=normpath(self.settings["storedir"]+"/tmp/"+\
+			self.settings["target_subpath"]).rstrip("/")+".namespace.sh"
+		mylines=["#!/bin/bash",\
+			"# Generated by catalyst, runs the controller in new namespaces",\
+			"if [ -z \"${clst_namespace_wrapper}\" ]",\
+			"then",\
+			"\texport clst_namespace_wrapper=1",\
+			"\texec unshare --mount --pid --ipc --fork --propagation private"+\
+			" -- /bin/bash \"$0\" \"$@\"",\
+			"fi",\
+			"unset clst_namespace_wrapper"]
+		for x in mounts:
+			mylines.append(x+" || exit 1")
+		mylines.append("exec /bin/bash "+\
+			self.settings["host_controller_file"]+" \"$@\"")
+		if not os.path.exists(os.path.dirname(mywrapper)):
+			os.makedirs(os.path.dirname(mywrapper),0755)
+		myf=open(mywrapper,"w")
+		myf.write(string.join(mylines,"\n")+"\n")
+		myf.close()
+		self.settings["controller_file"]=mywrapper
+
+	def chroot_host_path(self,path):
+		"""
+		Where the host finds path of the chroot. With namespaces nothing is
+		mounted in the chroot outside of controller steps, so a path below
+		a bind mount is found in what is bind-mounted there, and a path
+		below the squashfs snapshot in its overlay's upper dir or else in
+		the squashfs, which is mounted on the host for that until unbind.
+		"""
+		if "NAMESPACES" in self.settings:
+			mymounts=self.mounts[:]
+			mymounts.sort(lambda a,b: cmp(len(b),len(a)))
+			for x in mymounts:
+				src=self.mount_source(x)
+				if src in ["tmpfs","shmfs"]:
+					continue
+				if path != x and not path.startswith(x.rstrip("/")+"/"):
+					continue
+				if src != "squashfs":
+					return src+path[len(x):]
+				mysquashfs,myrw=self.snapshot_squashfs_dirs()
+				if os.path.lexists(myrw+"/upper"+path[len(x):]):
+					return myrw+"/upper"+path[len(x):]
+				if not os.path.exists(mysquashfs):
+					os.makedirs(mysquashfs,0755)
+				if not ismount(mysquashfs):
+					cmd("mount -t squashfs -o loop,ro "+\
+						self.settings["snapshot_path"]+" "+mysquashfs,\
+						"Couldn't mount the squashfs snapshot on the host",\
+						env=self.env)
+				return mysquashfs+path[len(x):]
+		return self.settings["chroot_path"]+path
 
 	def unbind(self):
 		ouch=0
 		mypath=self.settings["chroot_path"]
+		if "host_controller_file" in self.settings:
+			""" Steps after unbind run outside of any namespace """
+			self.settings["controller_file"]=\
+				self.settings["host_controller_file"]
 		myrevmounts=self.mounts[:]
 		myrevmounts.reverse()
 		""" Unmount in reverse order for nested bind-mounts """
@@ -961,16 +1591,25 @@ class generic_stage_target(generic_target):
 					ouch=1
 					warn("Couldn't umount bind mount: "+mypath+x)
 
-			if "SNAPCACHE" in self.settings and x == "/usr/portage":
-				try:
-					"""
-					It's possible the snapshot lock object isn't created yet.
-					This is because mount safety check calls unbind before the
-					target is fully initialized
-					"""
-					self.snapshot_lock_object.unlock()
-				except:
-					pass
+		""" Whatever else is still mounted in the chroot, deepest first """
+		for x in mounts_under(mypath)[::-1]:
+			if spawn(["umount",x]) != 0:
+				ouch=1
+				warn("Couldn't umount stray mount: "+x)
+
+		if self.umount_snapshot_squashfs():
+			ouch=1
+
+		"""
+		The snapshot cache entry is mounted inside the build's namespace when
+		there is one, so it is unlocked whether or not the host sees it
+		mounted. Mount safety check calls unbind before it was locked.
+		"""
+		mylock=getattr(self,"snapshot_lock_object",None)
+		if mylock != None and mylock.islocked():
+			mylock.unlock()
+		if not ouch:
+			self.ingest_pkgcache()
 		if ouch:
 			"""
 			if any bind mounts really failed, then we need to raise
@@ -980,14 +1619,60 @@ class generic_stage_target(generic_target):
 			raise CatalystError,\
 				"Couldn't umount one or more bind-mounts; aborting for safety."
 
+	def pkgstore(self):
+		if "PKGSTORE" not in self.settings or "PKGCACHE" not in self.settings:
+			return None
+		return catalyst_pkgstore.PackageStore(self.settings["storedir"]+\
+			"/pkgstore")
+
+	def populate_pkgcache(self):
+		"""
+		Link the binpkgs other targets built with the same CHOST and flags
+		into our package cache. Portage decides about USE itself.
+		"""
+		mystore=self.pkgstore()
+		if mystore == None:
+			return
+		mycount=mystore.populate(self.settings["pkgcache_path"],self.settings)
+		print "Linked "+str(mycount)+" binary packages from the package store"
+
+	def ingest_pkgcache(self):
+		""" Share the binpkgs this build made with other targets """
+		mystore=self.pkgstore()
+		if mystore == None or \
+			not os.path.isdir(self.settings.get("pkgcache_path","")):
+			return
+		mycount=mystore.ingest(self.settings["pkgcache_path"],\
+			self.settings)
+		if mycount:
+			print "Added "+str(mycount)+" binary packages to the package store"
+
+	def seed_makeconf(self):
+		"""
+		The make.conf the seed came with. A resumed chroot_setup finds the
+		one in the chroot rewritten from the spec already, so it is read
+		from the unpacked seed, or out of a seekable seed tarball, which
+		only decompresses the frames holding it.
+		"""
+		mymakeconf="/etc/portage/make.conf"
+		mysource=self.settings["source_path"]
+		if os.path.isfile(mysource):
+			myseed=self.seed_directory()
+			if self.get_path_hash("source_path_hash") and \
+				os.path.exists(myseed+mymakeconf):
+				return read_makeconf(myseed+mymakeconf)
+			if is_seekable(mysource):
+				return read_makeconf(mymakeconf,archive=mysource)
+		return read_makeconf(self.settings["chroot_path"]+mymakeconf)
+
 	def chroot_setup(self):
-		self.makeconf=read_makeconf(self.settings["chroot_path"]+\
-			"/etc/portage/make.conf")
+		self.makeconf=self.seed_makeconf()
 		self.override_cbuild()
 		self.override_chost()
 		self.override_cflags()
 		self.override_cxxflags()
 		self.override_ldflags()
+		self.populate_pkgcache()
 		if "AUTORESUME" in self.settings \
 			and os.path.exists(self.settings["autoresume_path"]+"chroot_setup"):
 			print "Resume point detected, skipping chroot_setup operation..."
@@ -996,8 +1681,9 @@ class generic_stage_target(generic_target):
 
 			#self.makeconf=read_makeconf(self.settings["chroot_path"]+"/etc/portage/make.conf")
 
-			cmd("cp /etc/resolv.conf " + self.settings["chroot_path"] + "/etc/",
-				"Could not copy resolv.conf into place.",env=self.env)
+			catalyst_fileops.copy_file("/etc/resolv.conf",\
+				self.settings["chroot_path"]+"/etc/",\
+				"Could not copy resolv.conf into place.")
 
 			""" Copy over the envscript, if applicable """
 			if "ENVSCRIPT" in self.settings:
@@ -1013,25 +1699,25 @@ class generic_stage_target(generic_target):
 				print "\tCatalyst Maintainers use VERY minimal envscripts if used at all"
 				print "\tYou have been warned\n"
 
-				cmd("cp "+self.settings["ENVSCRIPT"]+" "+\
+				catalyst_fileops.copy_file(self.settings["ENVSCRIPT"],\
 					self.settings["chroot_path"]+"/tmp/envscript",\
-					"Could not copy envscript into place.",env=self.env)
+					"Could not copy envscript into place.")
 
 			"""
 			Copy over /etc/hosts from the host in case there are any
 			specialties in there
 			"""
 			if os.path.exists(self.settings["chroot_path"]+"/etc/hosts"):
-				cmd("mv "+self.settings["chroot_path"]+"/etc/hosts "+\
-					self.settings["chroot_path"]+"/etc/hosts.catalyst",\
-					"Could not backup /etc/hosts",env=self.env)
-				cmd("cp /etc/hosts "+self.settings["chroot_path"]+"/etc/hosts",\
-					"Could not copy /etc/hosts",env=self.env)
+				catalyst_fileops.move(self.settings["chroot_path"]+\
+					"/etc/hosts",self.settings["chroot_path"]+\
+					"/etc/hosts.catalyst","Could not backup /etc/hosts")
+				catalyst_fileops.copy_file("/etc/hosts",\
+					self.settings["chroot_path"]+"/etc/hosts",\
+					"Could not copy /etc/hosts")
 
 			""" Modify and write out make.conf (for the chroot) """
-			cmd("rm -f "+self.settings["chroot_path"]+"/etc/portage/make.conf",\
-				"Could not remove "+self.settings["chroot_path"]+\
-				"/etc/portage/make.conf",env=self.env)
+			catalyst_fileops.remove(self.settings["chroot_path"]+\
+				"/etc/portage/make.conf")
 			myf=open(self.settings["chroot_path"]+"/etc/portage/make.conf","w")
 			myf.write("# These settings were set by the catalyst build script that automatically\n# built this stage.\n")
 			myf.write("# Please consult /usr/share/portage/config/make.conf.example for a more\n# detailed example.\n")
@@ -1091,9 +1777,10 @@ class generic_stage_target(generic_target):
 				myf.write('PORTDIR_OVERLAY="/usr/local/portage"\n')
 
 			myf.close()
-			cmd("cp "+self.settings["chroot_path"]+"/etc/portage/make.conf "+\
-				self.settings["chroot_path"]+"/etc/portage/make.conf.catalyst",\
-				"Could not backup /etc/portage/make.conf",env=self.env)
+			catalyst_fileops.copy_file(self.settings["chroot_path"]+\
+				"/etc/portage/make.conf",self.settings["chroot_path"]+\
+				"/etc/portage/make.conf.catalyst",\
+				"Could not backup /etc/portage/make.conf")
 			touch(self.settings["autoresume_path"]+"chroot_setup")
 
 	def fsscript(self):
@@ -1124,19 +1811,19 @@ class generic_stage_target(generic_target):
 		else:
 			for x in self.settings["cleanables"]:
 				print "Cleaning chroot: "+x+"... "
-				cmd("rm -rf "+self.settings["destpath"]+x,"Couldn't clean "+\
-					x,env=self.env)
+				for y in glob.glob(self.settings["destpath"]+x):
+					catalyst_fileops.remove(y,True,"Couldn't clean "+x)
 
 		""" Put /etc/hosts back into place """
 		if os.path.exists(self.settings["chroot_path"]+"/etc/hosts.catalyst"):
-			cmd("mv -f "+self.settings["chroot_path"]+"/etc/hosts.catalyst "+\
-				self.settings["chroot_path"]+"/etc/hosts",\
-				"Could not replace /etc/hosts",env=self.env)
+			catalyst_fileops.move(self.settings["chroot_path"]+\
+				"/etc/hosts.catalyst",self.settings["chroot_path"]+"/etc/hosts",\
+				"Could not replace /etc/hosts")
 
 		""" Remove our overlay """
 		if os.path.exists(self.settings["chroot_path"]+"/usr/local/portage"):
-			cmd("rm -rf "+self.settings["chroot_path"]+"/usr/local/portage",\
-				"Could not remove /usr/local/portage",env=self.env)
+			catalyst_fileops.remove(self.settings["chroot_path"]+\
+				"/usr/local/portage",True,"Could not remove /usr/local/portage")
 			cmd("sed -i '/^PORTDIR_OVERLAY/d' "+self.settings["chroot_path"]+\
 				"/etc/portage/make.conf",\
 				"Could not remove PORTDIR_OVERLAY from make.conf",env=self.env)
@@ -1233,15 +1920,55 @@ class generic_stage_target(generic_target):
 
 			print "Creating stage tarball..."
 
-			cmd("tar --xattrs --xattrs-include=security.capability --xattrs-include=user.pax.flags --selinux -I lbzip2 -cpf "+self.settings["target_path"]+" -C "+\
-				self.settings["stage_path"]+" .",\
-				"Couldn't create stage tarball",env=self.env)
-
-			self.gen_contents_file(self.settings["target_path"])
-			self.gen_digest_file(self.settings["target_path"])
+			self.capture_tarball(self.settings["target_path"],\
+				self.settings["stage_path"],["."],tar_xattr_args)
 
 			touch(self.settings["autoresume_path"]+"capture")
 
+	def capture_tarball(self,target,source,members,tar_args):
+		"""
+		Create the tarball of members of source, compressed as configured,
+		with its .CONTENTS and its .DIGESTS in a single pass over the data.
+		Contents functions other than the tar listing, and digests shash has
+		to compute, still need the finished tarball.
+		"""
+		contents=self.sorted_setting("contents")
+		digests=self.digest_functions()
+		streamed=len(contents) == 1 and (contents[0] == "auto" or \
+			contents[0].startswith("tar-tv"))
+
+		if os.path.exists(target+".CONTENTS"):
+			os.remove(target+".CONTENTS")
+		myf=None
+		if streamed:
+			myf=open(target+".CONTENTS","w")
+		try:
+			known=capture_tarball(target,source,members,tar_args,\
+				self.settings["compression"],\
+				level=self.settings.get("compression_level"),\
+				threads=self.settings.get("compression_threads"),\
+				contents_file=myf,hash_functions=digests,\
+				verbose="VERBOSE" in self.settings,env=self.env)
+		finally:
+			if myf != None:
+				myf.close()
+
+		if not streamed:
+			self.gen_contents_and_digest_files(target,known=known)
+		else:
+			self.gen_digest_file(target,known=known)
+
+	def sorted_setting(self,key):
+		"""the unique, sorted words of a setting, [] if it is not set"""
+		if key not in self.settings:
+			return []
+		keys={}
+		for i in self.settings[key].split():
+			keys[i]=1
+		array=keys.keys()
+		array.sort()
+		return array
+
 	def run_local(self):
 		if "AUTORESUME" in self.settings \
 			and os.path.exists(self.settings["autoresume_path"]+"run_local"):
@@ -1305,9 +2032,11 @@ class generic_stage_target(generic_target):
 
 	def run(self):
 		self.chroot_lock.write_lock()
+		self.record_lock_wait("chroot lock",self.chroot_lock)
 
 		""" Kill any pids in the chroot "" """
-		self.kill_chroot_pids()
+		if "NAMESPACES" not in self.settings:
+			self.kill_chroot_pids()
 
 		""" Check for mounts right away and abort if we cannot unmount them """
 		self.mount_safety_check()
@@ -1326,17 +2055,45 @@ class generic_stage_target(generic_target):
 		if "PURGE" in self.settings:
 			self.purge()
 
-		for x in self.settings["action_sequence"]:
-			print "--- Running action sequence: "+x
-			sys.stdout.flush()
-			try:
-				apply(getattr(self,x))
-			except:
-				self.mount_safety_check()
-				raise
+		self.lock_caches()
+		try:
+			catalyst_actions.run_actions(self.settings["action_sequence"],\
+				catalyst_actions.action_graph(self.settings["action_sequence"],\
+				self.action_dependencies),self.run_action)
+		except:
+			self.mount_safety_check()
+			raise
 
+		for x in self.cache_locks:
+			x.unlock()
 		self.chroot_lock.unlock()
 
+	def run_action(self,x):
+		print "--- Running action sequence: "+x
+		sys.stdout.flush()
+		apply(getattr(self,x))
+
+	def lock_caches(self):
+		"""
+		Hold a read lock on the package and kernel caches for the whole
+		build, so that catalyst --cache-gc leaves them alone, and log their
+		use. The snapshot cache is locked when it is mounted.
+		"""
+		self.cache_locks=[]
+		for x in [["PKGCACHE","pkgcache","pkgcache_path"],\
+			["KERNCACHE","kerncache","kerncache_path"]]:
+			if x[0] not in self.settings:
+				continue
+			mypath=self.settings[x[2]]
+			myhit=os.path.isdir(mypath) and \
+				len([y for y in os.listdir(mypath) if not y.startswith(".")]) > 0
+			catalyst_cachegc.record_cache_use(self.settings,x[1],mypath,myhit)
+			if not os.path.exists(mypath):
+				os.makedirs(mypath,0755)
+			mylock=catalyst_lock.LockDir(mypath)
+			mylock.read_lock()
+			self.cache_locks.append(mylock)
+
 	def unmerge(self):
 		if "AUTORESUME" in self.settings \
 			and os.path.exists(self.settings["autoresume_path"]+"unmerge"):
@@ -1404,8 +2161,7 @@ class generic_stage_target(generic_target):
 				cmd("/bin/bash "+self.settings["controller_file"]+" iso "+\
 					self.settings["iso"],"ISO creation script failed.",\
 					env=self.env)
-				self.gen_contents_file(self.settings["iso"])
-				self.gen_digest_file(self.settings["iso"])
+				self.gen_contents_and_digest_files(self.settings["iso"])
 				touch(self.settings["autoresume_path"]+"create_iso")
 			else:
 				print "WARNING: livecd/iso was not defined."
@@ -1495,17 +2251,46 @@ class generic_stage_target(generic_target):
 
 		self._copy_initramfs_overlay(kname=kname)
 
+		mystore=self.kernel_store()
+		if mystore != None and \
+			self.settings.get("boot/kernel/"+kname+"/packages"):
+			""" The packages are built against the kernel in the chroot """
+			mystore=None
+		myenv=self.env
+		myentry=None
+		if mystore != None:
+			myinputs=self.kernel_inputs(kname)
+			mykey=mystore.key(myinputs)
+			myentry=mystore.lookup(mykey)
+			catalyst_cachegc.record_cache_use(self.settings,"kerncache",\
+				mystore.entry(mykey),myentry != None)
+			if myentry != None:
+				print "Installing kernel "+kname+" from the kernel store"
+				self.install_stored_kernel(kname,myentry)
+				"""
+				The kernel step still merges the sources, it only leaves
+				out genkernel
+				"""
+				myenv=self.env.copy()
+				myenv["clst_kernel_stored"]="1"
+
 		""" Execute the script that builds the kernel """
 		cmd("/bin/bash "+self.settings["controller_file"]+\
 			" kernel "+kname,\
-			"Runscript kernel build failed",env=self.env)
+			"Runscript kernel build failed",env=myenv)
+
+		if mystore != None and myentry == None:
+			myartifacts={}
+			for x in catalyst_kernstore.kernel_artifacts:
+				myartifacts[x]=self.kernel_artifact(kname,x)
+			mystore.store(mykey,myinputs,myartifacts)
 
 		if "boot/kernel/"+kname+"/initramfs_overlay" in self.settings:
 			if os.path.exists(self.settings["chroot_path"]+\
 				"/tmp/initramfs_overlay/"):
 				print "Cleaning up temporary overlay dir"
-				cmd("rm -R "+self.settings["chroot_path"]+\
-					"/tmp/initramfs_overlay/",env=self.env)
+				catalyst_fileops.remove(self.settings["chroot_path"]+\
+					"/tmp/initramfs_overlay",True)
 
 		touch(self.settings["autoresume_path"]+\
 			"build_kernel_"+kname)
@@ -1518,6 +2303,96 @@ class generic_stage_target(generic_target):
 			" post-kmerge ",
 			"Runscript post-kmerge failed",env=self.env)
 
+	def kernel_store(self):
+		if "KERNCACHE" not in self.settings:
+			return None
+		return catalyst_kernstore.KernelStore(self.settings["storedir"]+\
+			"/kernels")
+
+	def kernel_artifact(self,kname,artifact):
+		return self.chroot_host_path("/tmp/kerncache/"+kname+"-"+\
+			artifact+"-"+self.settings["version_stamp"]+".tar.bz2")
+
+	def kernel_inputs(self,kname):
+		"""
+		Everything the kernel kname is built from, one input per line: every
+		clst_ setting the kernel step of kmerge.sh reads (setup_gk_args and
+		genkernel_compile), the make.conf and profile it builds with, digests
+		of the files they name, the ebuilds the sources can come from and
+		the toolchain in the chroot.
+		"""
+		def value(key):
+			myvalue=self.settings.get(key,"")
+			if type(myvalue)!=types.StringType:
+				myvalue=string.join(myvalue)
+			return myvalue
+		myprefix="boot/kernel/"+kname+"/"
+		myinputs=[]
+		for x in ["CHOST","CFLAGS","CXXFLAGS","LDFLAGS","HOSTUSE","use",\
+			"target_profile","hostarch","gk_mainargs","livecd/type",\
+			"splash_theme","merge_path"]:
+			myinputs.append(x+"="+value(x))
+		myinputs.append("netboot="+str(value("target") == "netboot2"))
+		myinputs.append("ccache="+str("CCACHE" in self.settings))
+		for x in ["sources","use","packages","gk_kernargs","extraversion"]:
+			myinputs.append(myprefix+x+"="+value(myprefix+x))
+		for x in [myprefix+"config",myprefix+"initramfs_overlay","linuxrc",\
+			"busybox_config","ENVSCRIPT"]:
+			if x in self.settings and os.path.exists(value(x)):
+				myinputs.append(x+"="+\
+					catalyst_kernstore.tree_digest(value(x)))
+		if value("target") == "netboot2" and value("merge_path"):
+			""" The image so far goes into the initramfs """
+			mydir=self.chroot_host_path(value("merge_path"))
+			if os.path.isdir(mydir):
+				myinputs.append("merge_path/contents="+\
+					catalyst_kernstore.tree_digest(mydir))
+		mysources=value(myprefix+"sources") or "virtual/linux-sources"
+		for x in mysources.split():
+			mypackage=catalyst_kernstore.atom_package(x)
+			mydir=self.chroot_host_path("/usr/portage/"+mypackage)
+			if os.path.isdir(mydir):
+				myinputs.append("portage/"+mypackage+"="+\
+					catalyst_kernstore.tree_digest(mydir))
+		for x in ["sys-kernel/genkernel","sys-devel/gcc","sys-devel/binutils",\
+			"sys-libs/glibc"]:
+			myinstalled=glob.glob(self.settings["chroot_path"]+"/var/db/pkg/"+\
+				x+"-[0-9]*")
+			myinstalled.sort()
+			myinputs.append("installed/"+x+"="+\
+				string.join([os.path.basename(y) for y in myinstalled]))
+		return myinputs
+
+	def install_stored_kernel(self,kname,myentry):
+		"""
+		Put the stored kernel where the kernel step would have left it: the
+		tarballs in /tmp/kerncache, the kernel in /boot and the modules in
+		/lib/modules
+		"""
+		mylock=catalyst_lock.LockDir(myentry)
+		mylock.read_lock()
+		try:
+			mydir=self.chroot_host_path("/tmp/kerncache")
+			if not os.path.exists(mydir):
+				os.makedirs(mydir,0755)
+			for x in catalyst_kernstore.kernel_artifacts:
+				mysource=myentry+"/"+x+".tar.bz2"
+				if not os.path.exists(mysource):
+					continue
+				shutil.copy2(mysource,self.kernel_artifact(kname,x))
+			if not os.path.exists(self.settings["chroot_path"]+"/boot"):
+				os.makedirs(self.settings["chroot_path"]+"/boot",0755)
+			cmd("tar -xjpf "+myentry+"/kernel-initrd.tar.bz2 -C "+\
+				self.settings["chroot_path"]+"/boot",\
+				"Couldn't install the stored kernel "+kname,env=self.env)
+			if os.path.exists(myentry+"/modules.tar.bz2"):
+				cmd("tar -xjpf "+myentry+"/modules.tar.bz2 -C "+\
+					self.settings["chroot_path"],\
+					"Couldn't install the stored modules of "+kname,\
+					env=self.env)
+		finally:
+			mylock.unlock()
+
 	def _copy_kernel_config(self, kname):
 		if "boot/kernel/"+kname+"/config" in self.settings:
 			if not os.path.exists(self.settings["boot/kernel/"+kname+"/config"]):
@@ -1528,13 +2403,13 @@ class generic_stage_target(generic_target):
 					"/config"]
 
 			try:
-				cmd("cp "+self.settings["boot/kernel/"+kname+\
-					"/config"]+" "+\
+				catalyst_fileops.copy_file(self.settings["boot/kernel/"+\
+					kname+"/config"],\
 					self.settings["chroot_path"]+"/var/tmp/"+\
 					kname+".config",\
 					"Couldn't copy kernel config: "+\
 					self.settings["boot/kernel/"+kname+\
-					"/config"],env=self.env)
+					"/config"])
 
 			except CatalystError:
 				self.unbind()
@@ -1547,18 +2422,14 @@ class generic_stage_target(generic_target):
 					self.settings["boot/kernel/"+kname+\
 					"/initramfs_overlay"]
 
-				cmd("mkdir -p "+\
-					self.settings["chroot_path"]+\
-					"/tmp/initramfs_overlay/"+\
-					self.settings["boot/kernel/"+kname+\
-					"/initramfs_overlay"],env=self.env)
-
-				cmd("cp -R "+self.settings["boot/kernel/"+\
-					kname+"/initramfs_overlay"]+"/* "+\
+				catalyst_fileops.copy_contents(\
+					self.settings["boot/kernel/"+kname+"/initramfs_overlay"],\
 					self.settings["chroot_path"]+\
 					"/tmp/initramfs_overlay/"+\
 					self.settings["boot/kernel/"+kname+\
-					"/initramfs_overlay"],env=self.env)
+					"/initramfs_overlay"],\
+					"Couldn't copy initramfs_overlay: "+\
+					self.settings["boot/kernel/"+kname+"/initramfs_overlay"])
 
 	def bootloader(self):
 		if "AUTORESUME" in self.settings \
@@ -1591,6 +2462,10 @@ class generic_stage_target(generic_target):
 
 	def clear_chroot(self):
 		myemp=self.settings["chroot_path"]
+		remove_overlay_chroot(myemp)
+		for x in self.snapshot_overlay_dirs()+self.snapshot_squashfs_dirs():
+			if os.path.exists(x) and not ismount(x):
+				shutil.rmtree(x)
 		if os.path.isdir(myemp):
 			print "Emptying directory",myemp
 			"""
@@ -1678,35 +2553,49 @@ class generic_stage_target(generic_target):
 					array=keys.keys()
 					array.sort()
 				for j in array:
-					contents=generate_contents(file,contents_function=j,\
-						verbose="VERBOSE" in self.settings)
-					if contents:
-						myf.write(contents)
+					""" Stream the listing, it can be millions of lines """
+					generate_contents(file,contents_function=j,\
+						verbose="VERBOSE" in self.settings,outfile=myf)
 				myf.close()
 
-	def gen_digest_file(self,file):
+	def digest_functions(self):
+		array=self.sorted_setting("digests")
+		if "all" in array:
+			array=hash_map.keys()
+		return array
+
+	def gen_contents_and_digest_files(self,file,known={}):
+		"""
+		gen_contents_file and gen_digest_file, with file digested while its
+		contents are listed. Only the .CONTENTS is digested afterwards.
+		"""
+		myknown=known.copy()
+		def digest():
+			if "digests" in self.settings and os.path.exists(file):
+				myknown.update(native_digests(file,self.digest_functions(),\
+					known))
+		mysteps={"contents":lambda: self.gen_contents_file(file),\
+			"digests":digest}
+		catalyst_actions.run_actions(["contents","digests"],\
+			{"contents":[],"digests":[]},lambda x: mysteps[x]())
+		self.gen_digest_file(file,known=myknown)
+
+	def gen_digest_file(self,file,known={}):
 		if os.path.exists(file+".DIGESTS"):
 			os.remove(file+".DIGESTS")
 		if "digests" in self.settings:
 			if os.path.exists(file):
 				myf=open(file+".DIGESTS","w")
-				keys={}
-				for i in self.settings["digests"].split():
-					keys[i]=1
-					array=keys.keys()
-					array.sort()
+				array=self.digest_functions()
 				for f in [file, file+'.CONTENTS']:
 					if os.path.exists(f):
-						if "all" in array:
-							for k in hash_map.keys():
-								hash=generate_hash(f,hash_function=k,verbose=\
-									"VERBOSE" in self.settings)
-								myf.write(hash)
-						else:
-							for j in array:
-								hash=generate_hash(f,hash_function=j,verbose=\
-									"VERBOSE" in self.settings)
-								myf.write(hash)
+						""" Read each file once, feeding every digest """
+						myknown={}
+						if f == file:
+							myknown=known
+						hash=generate_hashes(f,array,verbose=\
+							"VERBOSE" in self.settings,known=myknown)
+						myf.write(hash)
 				myf.close()
 
 	def purge(self):
@@ -1725,4 +2614,7 @@ class generic_stage_target(generic_target):
 			print "clearing kerncache ..."
 			self.clear_kerncache()
 
+			print "clearing unused seeds ..."
+			catalyst_cachegc.CacheGC(self.settings).evict_unused_seeds()
+
 # vim: ts=4 sw=4 sta et sts=4 ai
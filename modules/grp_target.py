@@ -74,38 +74,48 @@ class grp_target(generic_stage_target):
             self.mountmap["/tmp/grp"]=self.settings["target_path"]
 
 	def generate_digests(self):
+		myfiles=[]
 		for pkgset in self.settings["grp"]:
 			if self.settings["grp/"+pkgset+"/type"] == "pkgset":
 				destdir=normpath(self.settings["target_path"]+"/"+pkgset+"/All")
 				print "Digesting files in the pkgset....."
-				digests=glob.glob(destdir+'/*.DIGESTS')
-				for i in digests:
-					if os.path.exists(i):
-						os.remove(i)
-
-				files=os.listdir(destdir)
-				#ignore files starting with '.' using list comprehension
-				files=[filename for filename in files if filename[0] != '.']
-				for i in files:
-					if os.path.isfile(normpath(destdir+"/"+i)):
-						self.gen_contents_file(normpath(destdir+"/"+i))
-						self.gen_digest_file(normpath(destdir+"/"+i))
+				contents=True
 			else:
 				destdir=normpath(self.settings["target_path"]+"/"+pkgset)
 				print "Digesting files in the srcset....."
-
-				digests=glob.glob(destdir+'/*.DIGESTS')
-				for i in digests:
-					if os.path.exists(i):
-						os.remove(i)
-
-				files=os.listdir(destdir)
-				#ignore files starting with '.' using list comprehension
-				files=[filename for filename in files if filename[0] != '.']
-				for i in files:
-					if os.path.isfile(normpath(destdir+"/"+i)):
-						#self.gen_contents_file(normpath(destdir+"/"+i))
-						self.gen_digest_file(normpath(destdir+"/"+i))
+				contents=False
+
+			digests=glob.glob(destdir+'/*.DIGESTS')
+			for i in digests:
+				if os.path.exists(i):
+					os.remove(i)
+
+			files=os.listdir(destdir)
+			#ignore files starting with '.' using list comprehension
+			files=[filename for filename in files if filename[0] != '.']
+			files.sort()
+			for i in files:
+				if os.path.isfile(normpath(destdir+"/"+i)):
+					myfiles.append((normpath(destdir+"/"+i),contents))
+
+		""" Each file is independent, so spread them over digest_jobs workers """
+		results=parallel_map(self.generate_file_digests,myfiles,\
+			int(self.settings["digest_jobs"]))
+		failed=0
+		for x in range(0,len(myfiles)):
+			if results[x][1]:
+				failed+=1
+				warn("Digesting "+myfiles[x][0]+" failed: "+\
+					str(results[x][1][1]))
+		if failed:
+			raise CatalystError,"Could not digest "+str(failed)+" of "+\
+				str(len(myfiles))+" GRP files."
+
+	def generate_file_digests(self,myfile):
+		if myfile[1]:
+			self.gen_contents_and_digest_files(myfile[0])
+		else:
+			self.gen_digest_file(myfile[0])
 
 	def set_action_sequence(self):
 	    self.settings["action_sequence"]=["unpack","unpack_snapshot",\
@@ -5,6 +5,7 @@ LiveCD stage1 target
 
 from catalyst_support import *
 from generic_stage_target import *
+import catalyst_fileops
 
 class livecd_stage1_target(generic_stage_target):
 	"""
@@ -31,8 +32,8 @@ class livecd_stage1_target(generic_stage_target):
 		else:
 			# first clean up any existing target stuff
 			if os.path.exists(self.settings["target_path"]):
-				cmd("rm -rf "+self.settings["target_path"],\
-					"Could not remove existing directory: "+self.settings["target_path"],env=self.env)
+				catalyst_fileops.remove(self.settings["target_path"],True,\
+					"Could not remove existing directory: "+self.settings["target_path"])
 				touch(self.settings["autoresume_path"]+"setup_target_path")
 
 			if not os.path.exists(self.settings["target_path"]):
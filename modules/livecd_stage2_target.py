@@ -6,6 +6,7 @@ LiveCD stage2 target, builds upon previous LiveCD stage1 tarball
 import os,string,types,stat,shutil
 from catalyst_support import *
 from generic_stage_target import *
+import catalyst_fileops
 
 class livecd_stage2_target(generic_stage_target):
 	"""
@@ -33,9 +34,9 @@ class livecd_stage2_target(generic_stage_target):
 		file_locate(self.settings, ["cdtar","controller_file"])
 
 	def set_source_path(self):
-		self.settings["source_path"]=normpath(self.settings["storedir"]+"/builds/"+self.settings["source_subpath"]+".tar.bz2")
+		self.settings["source_path"]=self.find_tarball(normpath(self.settings["storedir"]+"/builds/"+self.settings["source_subpath"]))
 		if os.path.isfile(self.settings["source_path"]):
-			self.settings["source_path_hash"]=generate_hash(self.settings["source_path"])
+			self.start_path_hash("source_path_hash",self.settings["source_path"])
 		else:
 			self.settings["source_path"]=normpath(self.settings["storedir"]+"/tmp/"+self.settings["source_subpath"]+"/")
 		if not os.path.exists(self.settings["source_path"]):
@@ -52,8 +53,8 @@ class livecd_stage2_target(generic_stage_target):
 		else:
 			# first clean up any existing target stuff
 			if os.path.isdir(self.settings["target_path"]):
-				cmd("rm -rf "+self.settings["target_path"],
-				"Could not remove existing directory: "+self.settings["target_path"],env=self.env)
+				catalyst_fileops.remove(self.settings["target_path"],True,
+				"Could not remove existing directory: "+self.settings["target_path"])
 				touch(self.settings["autoresume_path"]+"setup_target_path")
 			if not os.path.exists(self.settings["target_path"]):
 				os.makedirs(self.settings["target_path"])
@@ -93,8 +94,8 @@ class livecd_stage2_target(generic_stage_target):
 				os.path.exists(self.settings["autoresume_path"]+"unpack"):
 				print "Resume point detected, skipping unpack operation..."
 				unpack=False
-			elif "source_path_hash" in self.settings:
-				if self.settings["source_path_hash"] != clst_unpack_hash:
+			elif self.get_path_hash("source_path_hash"):
+				if self.get_path_hash("source_path_hash") != clst_unpack_hash:
 					invalid_snapshot=True
 
 		if unpack:
@@ -122,9 +123,9 @@ class livecd_stage2_target(generic_stage_target):
 			print display_msg
 			cmd(unpack_cmd,error_msg,env=self.env)
 
-			if "source_path_hash" in self.settings:
+			if self.get_path_hash("source_path_hash"):
 				myf=open(self.settings["autoresume_path"]+"unpack","w")
-				myf.write(self.settings["source_path_hash"])
+				myf.write(self.get_path_hash("source_path_hash"))
 				myf.close()
 			else:
 				touch(self.settings["autoresume_path"]+"unpack")
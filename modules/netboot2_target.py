@@ -6,6 +6,7 @@ netboot target, version 2
 import os,string,types
 from catalyst_support import *
 from generic_stage_target import *
+import catalyst_fileops
 
 class netboot2_target(generic_stage_target):
 	"""
@@ -51,8 +52,8 @@ class netboot2_target(generic_stage_target):
 		else:
 			# first clean up any existing target stuff
 			if os.path.isfile(self.settings["target_path"]):
-				cmd("rm -f "+self.settings["target_path"], \
-					"Could not remove existing file: "+self.settings["target_path"],env=self.env)
+				catalyst_fileops.remove(self.settings["target_path"],False,\
+					"Could not remove existing file: "+self.settings["target_path"])
 				touch(self.settings["autoresume_path"]+"setup_target_path")
 
 		if not os.path.exists(self.settings["storedir"]+"/builds/"):
@@ -12,16 +12,50 @@ class snapshot_target(generic_stage_target):
 	"""
 	def __init__(self,myspec,addlargs):
 		self.required_values=["version_stamp","target"]
-		self.valid_values=["version_stamp","target"]
+		self.valid_values=["version_stamp","target","delta_base"]
 
 		generic_target.__init__(self,myspec,addlargs)
 		self.settings=myspec
 		self.settings["target_subpath"]="portage"
+		self.set_compression()
 		st=self.settings["storedir"]
 		self.settings["snapshot_path"]=normpath(st+"/snapshots/portage-"+self.settings["version_stamp"]\
-			+".tar.bz2")
+			+self.settings["compression_extension"])
+		self.settings["snapshot_squashfs_path"]=normpath(st+\
+			"/snapshots/portage-"+self.settings["version_stamp"]+".squashfs")
+		self.set_snapshot_format()
+		self.set_snapshot_method()
 		self.settings["tmp_path"]=normpath(st+"/tmp/"+self.settings["target_subpath"])
 
+	def set_snapshot_format(self):
+		"""
+		snapshot_format is tarball (the default), squashfs, or both. Stages
+		mount squashfs snapshots at /usr/portage instead of unpacking them.
+		"""
+		if "snapshot_format" not in self.settings:
+			self.settings["snapshot_format"]="tarball"
+		if self.settings["snapshot_format"] not in ["tarball","squashfs","both"]:
+			raise CatalystError,"snapshot_format must be one of tarball, "+\
+				"squashfs or both, not "+self.settings["snapshot_format"]
+
+	def set_snapshot_method(self):
+		"""
+		snapshot_method is rsync (the default), which copies portdir to a
+		staging tree first, or stream, which reads portdir in place.
+		snapshot_freeze=bind keeps portdir read-only while it is read,
+		btrfs reads it from a read-only btrfs snapshot.
+		"""
+		if "snapshot_method" not in self.settings:
+			self.settings["snapshot_method"]="rsync"
+		if self.settings["snapshot_method"] not in ["rsync","stream"]:
+			raise CatalystError,"snapshot_method must be one of rsync or "+\
+				"stream, not "+self.settings["snapshot_method"]
+		if "snapshot_freeze" not in self.settings:
+			self.settings["snapshot_freeze"]="none"
+		if self.settings["snapshot_freeze"] not in ["none","bind","btrfs"]:
+			raise CatalystError,"snapshot_freeze must be one of none, bind "+\
+				"or btrfs, not "+self.settings["snapshot_freeze"]
+
 	def setup(self):
 		x=normpath(self.settings["storedir"]+"/snapshots")
 		if not os.path.exists(x):
@@ -35,9 +69,10 @@ class snapshot_target(generic_stage_target):
 			self.purge()
 			return
 
-		if "PURGE" in self.settings:
-			self.purge()
-
+		"""
+		PURGE leaves the staging tree alone: rsync --delete keeps it an
+		exact copy of portdir, and it is the base of the next snapshot.
+		"""
 		self.setup()
 		print "Creating Portage tree snapshot "+self.settings["version_stamp"]+\
 			" from "+self.settings["portdir"]+"..."
@@ -46,19 +81,191 @@ class snapshot_target(generic_stage_target):
 		if not os.path.exists(mytmp):
 			os.makedirs(mytmp)
 
-		cmd("rsync -a --delete --exclude /packages/ --exclude /distfiles/ --exclude /local/ --exclude CVS/ --exclude .svn --filter=H_**/files/digest-* "+\
-			self.settings["portdir"]+"/ "+mytmp+"/portage/","Snapshot failure",env=self.env)
+		self.frozen=None
+		try:
+			""" A failed freeze is undone by thaw_portdir() as well """
+			mysource=self.freeze_portdir()
+			if self.settings["snapshot_method"] == "stream":
+				""" Read portdir in place, with the rsync excludes applied here """
+				self.tree_source=mysource
+				self.tree_excluded=[]
+				print "Indexing Portage tree..."
+				myindex=tree_index(mysource,"portage",self.snapshot_filter)
+			else:
+				cmd("rsync -a --delete --exclude /packages/ --exclude /distfiles/ --exclude /local/ --exclude CVS/ --exclude .svn --filter=H_**/files/digest-* "+\
+					mysource+"/ "+mytmp+"/portage/","Snapshot failure",env=self.env)
+				self.tree_source=mytmp
+				print "Indexing Portage snapshot..."
+				myindex=tree_index(mytmp+"/portage","portage")
+			write_index(self.index_path(self.settings["version_stamp"]),myindex)
+
+			if self.settings["snapshot_format"] in ["tarball","both"]:
+				print "Compressing Portage snapshot tarball..."
+				mypaths=myindex.keys()
+				mypaths.sort()
+				self.capture_tree(self.settings["snapshot_path"],mypaths)
 
-		print "Compressing Portage snapshot tarball..."
-		cmd("tar -I lbzip2 -cf "+self.settings["snapshot_path"]+" -C "+mytmp+" portage",\
-			"Snapshot creation failure",env=self.env)
+			if self.settings["snapshot_format"] in ["squashfs","both"]:
+				print "Creating Portage snapshot squashfs image..."
+				self.capture_squashfs(self.settings["snapshot_squashfs_path"])
 
-		self.gen_contents_file(self.settings["snapshot_path"])
-		self.gen_digest_file(self.settings["snapshot_path"])
+			if "delta_base" in self.settings:
+				self.capture_delta(myindex)
+		finally:
+			self.thaw_portdir()
 
 		self.cleanup()
 		print "snapshot: complete!"
 
+	def snapshot_filter(self,path,mystat):
+		"""
+		What the rsync command of the rsync snapshot_method leaves out:
+		packages/, distfiles/ and local/ at the top, CVS/ and .svn
+		everywhere, and files/digest-*
+		"""
+		mysplit=path.split("/")
+		if (len(mysplit) == 2 and mysplit[1] in ["packages","distfiles","local"] \
+			and S_ISDIR(mystat.st_mode)) \
+			or (mysplit[-1] == "CVS" and S_ISDIR(mystat.st_mode)) \
+			or mysplit[-1] == ".svn" \
+			or (len(mysplit) > 2 and mysplit[-2] == "files" \
+			and mysplit[-1].startswith("digest-")):
+			self.tree_excluded.append("/".join(mysplit[1:]))
+			return False
+		return True
+
+	def freeze_portdir(self):
+		"""
+		Returns where to read portdir from. With snapshot_freeze=bind,
+		portdir is remounted read-only until thaw_portdir(), so nothing can
+		change it while it is read. With btrfs, it is read from a read-only
+		snapshot of its subvolume.
+		"""
+		myportdir=normpath(self.settings["portdir"]).rstrip("/")
+		self.frozen=None
+		if self.settings["snapshot_freeze"] == "bind":
+			cmd("mount --bind "+myportdir+" "+myportdir,\
+				"Couldn't bind mount "+myportdir,env=self.env)
+			self.frozen=myportdir
+			cmd("mount -o remount,ro,bind "+myportdir,\
+				"Couldn't make "+myportdir+" read-only",env=self.env)
+			return myportdir
+		if self.settings["snapshot_freeze"] == "btrfs":
+			""" Snapshots have to be on the same filesystem """
+			myfrozen=normpath(os.path.dirname(myportdir)+"/."+\
+				os.path.basename(myportdir)+"-catalyst-"+\
+				self.settings["version_stamp"]).rstrip("/")
+			if os.path.exists(myfrozen):
+				cmd("btrfs subvolume delete "+myfrozen,\
+					"Couldn't remove the old snapshot "+myfrozen,env=self.env)
+			cmd("btrfs subvolume snapshot -r "+myportdir+" "+myfrozen,\
+				"Couldn't snapshot "+myportdir+", is it a btrfs subvolume?",\
+				env=self.env)
+			self.frozen=myfrozen
+			return myfrozen
+		return myportdir
+
+	def thaw_portdir(self):
+		if self.frozen == None:
+			return
+		if self.settings["snapshot_freeze"] == "bind":
+			cmd("umount "+self.frozen,"Couldn't unmount "+self.frozen,\
+				env=self.env)
+		else:
+			cmd("btrfs subvolume delete "+self.frozen,\
+				"Couldn't remove "+self.frozen,env=self.env)
+		self.frozen=None
+
+	def tree_name(self,path):
+		""" The name tar reads path of the snapshot tree by """
+		if self.settings["snapshot_method"] == "stream":
+			return "."+path[len("portage"):]
+		return path
+
+	def capture_tree(self,target,paths):
+		"""
+		Tarball of exactly paths of the snapshot tree, in that order, read
+		from portdir or the staging tree
+		"""
+		mylist=normpath(self.settings["tmp_path"]+"/"+\
+			os.path.basename(target)+".files")
+		myf=open(mylist,"w")
+		for x in paths:
+			myf.write(self.tree_name(x)+"\0")
+		myf.close()
+		mytar_args=["--no-recursion","--null","--no-unquote"]
+		if self.settings["snapshot_method"] == "stream":
+			mytar_args.append("--transform=flags=rh;s,^\\.,portage,")
+		try:
+			self.capture_tarball(target,self.tree_source,\
+				["--files-from="+mylist],mytar_args)
+		finally:
+			os.unlink(mylist)
+
+	def index_path(self,stamp):
+		""" The index of the tree of a snapshot, kept with the staging tree """
+		return normpath(self.settings["tmp_path"]+"/portage-"+stamp+".index")
+
+	def capture_delta(self,myindex):
+		"""
+		Write the delta of the snapshot to the delta_base snapshot: an
+		archive of what changed, and a manifest listing that and what
+		was deleted. Stages can then apply it to a cached copy of the base
+		instead of unpacking the whole tree.
+		"""
+		mybase=self.settings["delta_base"]
+		mybasepath=self.find_tarball(normpath(self.settings["storedir"]+\
+			"/snapshots/portage-"+mybase))
+		if not os.path.exists(mybasepath):
+			raise CatalystError,"The delta base snapshot "+mybase+\
+				" has no tarball in "+self.settings["storedir"]+"/snapshots"
+
+		if os.path.exists(self.index_path(mybase)):
+			mybaseindex=read_index(self.index_path(mybase))
+		else:
+			print "Indexing delta base snapshot "+mybase+"..."
+			mybaseindex=tarball_index(mybasepath)
+		changed,deleted=index_delta(mybaseindex,myindex)
+		print str(len(changed))+" paths changed and "+str(len(deleted))+\
+			" deleted since snapshot "+mybase
+
+		mydelta=normpath(self.settings["storedir"]+"/snapshots/portage-"+\
+			self.settings["version_stamp"]+".delta-"+mybase)
+		print "Compressing Portage snapshot delta..."
+		self.capture_tree(mydelta+self.settings["compression_extension"],changed)
+
+		mydigest=digest_id(generate_hash(mybasepath,\
+			hash_function=self.settings["hash_function"]))
+		write_delta_manifest(mydelta+".manifest",\
+			self.settings["version_stamp"],\
+			[mybase,self.settings["hash_function"],mydigest],changed,deleted)
+
+	def capture_squashfs(self,target):
+		""" The image holds what the tarball has under portage/ """
+		if os.path.exists(target):
+			os.unlink(target)
+		mysource=normpath(self.tree_source+"/portage")
+		myexclude=None
+		if self.settings["snapshot_method"] == "stream":
+			mysource=self.tree_source
+			myexclude=normpath(self.settings["tmp_path"]+"/"+\
+				os.path.basename(target)+".exclude")
+			myf=open(myexclude,"w")
+			for x in self.tree_excluded:
+				myf.write(x+"\n")
+			myf.close()
+		mycmd=squashfs_command(mysource,target,self.settings["compression"],\
+			level=self.settings.get("compression_level"),\
+			threads=self.settings.get("compression_threads"))
+		if myexclude != None:
+			mycmd+=" -ef "+myexclude
+		try:
+			cmd(mycmd,"Couldn't create "+target,env=self.env)
+		finally:
+			if myexclude != None:
+				os.unlink(myexclude)
+		self.gen_contents_and_digest_files(target)
+
 	def kill_chroot_pids(self):
 		pass
 
@@ -117,6 +117,13 @@ genkernel_compile(){
 }
 
 build_kernel() {
+	# catalyst installed the kernel from its kernel store, only the sources
+	# are merged
+	if [ -n "${clst_kernel_stored}" ]
+	then
+		echo "Using the stored kernel ${clst_kname}"
+		return
+	fi
 	genkernel_compile
 }
 